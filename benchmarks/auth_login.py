@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Benchmarks the per-login overhead of `durotar.auth.WechatMpMixin`.
+
+The HTTP client is replaced by a stub answering immediately, so the
+numbers are the cost of the auth code itself: building URLs, chaining
+futures and decoding responses::
+
+    $ python benchmarks/auth_login.py
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import io
+import timeit
+
+from tornado import escape
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.options import define, options, parse_command_line
+
+import util  # puts the repository root on sys.path
+
+from durotar.auth import WechatMpMixin
+
+define("num", type=int, default=20000, help="logins per measurement")
+
+
+TOKEN = escape.json_encode(dict(access_token='ACCESS', expires_in=7200,
+                                refresh_token='REFRESH', openid='OPENID',
+                                scope='snsapi_userinfo'))
+USER = escape.json_encode(dict(openid='OPENID', nickname='nick', sex=1,
+                               province='', city='', country='CN',
+                               headimgurl='', privilege=[]))
+
+
+class StubClient(object):
+    """Answers token and userinfo requests without any I/O."""
+
+    def fetch(self, url, callback=None, **kwargs):
+        body = USER if '/userinfo' in url else TOKEN
+        response = HTTPResponse(HTTPRequest(url), 200,
+                                buffer=io.BytesIO(escape.utf8(body)))
+        future = Future()
+        future.set_result(response)
+        if callback is not None:
+            callback(response)
+        return future
+
+
+class LoginHandler(WechatMpMixin):
+    settings = {}
+
+    def get_auth_http_client(self):
+        return StubClient()
+
+
+def main():
+    parse_command_line()
+    handler = LoginHandler()
+    results = []
+
+    def login_future():
+        handler.get_authenticated_user(
+            redirect_uri='/auth', appid='APPID', secret='SECRET',
+            code='CODE').result()
+
+    def login_callback():
+        handler.get_authenticated_user(
+            redirect_uri='/auth', appid='APPID', secret='SECRET',
+            code='CODE', callback=results.append)
+        del results[:]
+
+    for name, fn in [('future', login_future), ('callback', login_callback)]:
+        best = min(timeit.repeat(fn, number=options.num, repeat=3))
+        print("%-9s %.1f us/login" % (name, 1e6 * best / options.num))
+
+
+if __name__ == '__main__':
+    main()
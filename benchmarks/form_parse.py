@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Benchmarks `durotar.form.Form` construction on large urlencoded posts.
+
+Compares building a form from the arguments Tornado already parsed with
+re-parsing the body through ``urlparse.parse_qs``, as Form used to do::
+
+    $ python benchmarks/form_parse.py --fields=500
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import timeit
+import urllib
+import urlparse
+
+from tornado.options import define, options, parse_command_line
+
+from util import FakeHandler, FakeRequest
+
+from durotar.form import Form
+
+define("fields", type=int, default=300, help="number of form fields")
+define("num", type=int, default=1000, help="iterations per measurement")
+
+
+def make_request(fields):
+    body = urllib.urlencode([('field%d' % i, 'value %d' % i)
+                             for i in range(fields)])
+    return FakeRequest(body, 'application/x-www-form-urlencoded')
+
+
+def main():
+    parse_command_line()
+    handler = FakeHandler(make_request(options.fields))
+
+    def reparse():
+        urlparse.parse_qs(handler.request.body, keep_blank_values=1)
+
+    def construct():
+        Form(handler)
+
+    for name, fn in [('parse_qs re-parse', reparse),
+                     ('Form(handler)', construct)]:
+        best = min(timeit.repeat(fn, number=options.num, repeat=3))
+        print("%-20s %d fields: %.1f us/form" % (
+            name, options.fields, 1e6 * best / options.num))
+
+
+if __name__ == '__main__':
+    main()
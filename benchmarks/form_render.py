@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Benchmarks re-rendering a large form page after a failed submit.
+
+Compares `durotar.form.Form.render` in ``htmlfill`` mode (render, then
+htmlfill over the whole page) with ``context`` mode (values and errors
+rendered by the template in one pass)::
+
+    $ python benchmarks/form_render.py --fields=200
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import os
+import shutil
+import tempfile
+import timeit
+import urllib
+
+from formencode import validators
+from tornado.options import define, options, parse_command_line
+
+from util import FakeHandler, FakeRequest
+
+from durotar.filters import space_compress
+from durotar.form import Form
+from durotar.template import MakoLoader
+
+define("fields", type=int, default=200, help="number of form fields")
+define("num", type=int, default=200, help="iterations per measurement")
+
+
+HTMLFILL_FIELD = """
+<p><label>Field %(i)d</label>
+  <input type="text" name="field%(i)d" value="">
+  <form:error name="field%(i)d">
+</p>"""
+
+CONTEXT_FIELD = """
+<p><label>Field %(i)d</label>
+  <input type="text" name="field%(i)d" value="${form.value('field%(i)d')}">
+  %% if form.error('field%(i)d'):
+  <span class="error">${form.error('field%(i)d')}</span>
+  %% endif
+</p>"""
+
+PAGE = """<html><body><form method="post">%s
+</form></body></html>"""
+
+
+class RenderingHandler(FakeHandler):
+    """Renders like `durotar.web.RequestHandler`."""
+
+    def __init__(self, request, loader):
+        super(RenderingHandler, self).__init__(request)
+        self.loader = loader
+
+    def render_string(self, template_name, **kwargs):
+        content = self.loader.load(template_name).generate(**kwargs)
+        return space_compress(content)
+
+
+def make_form_class(fields):
+    attrs = dict(('field%d' % i, validators.Int()) for i in range(fields))
+    return type('LargeForm', (Form,), attrs)
+
+
+def main():
+    parse_command_line()
+    root = tempfile.mkdtemp()
+    try:
+        for name, field in [('htmlfill.html', HTMLFILL_FIELD),
+                            ('context.html', CONTEXT_FIELD)]:
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(PAGE % ''.join(field % dict(i=i)
+                                       for i in range(options.fields)))
+
+        body = urllib.urlencode([('field%d' % i, 'not a number')
+                                 for i in range(options.fields)])
+        request = FakeRequest(body, 'application/x-www-form-urlencoded')
+        handler = RenderingHandler(request, MakoLoader(root))
+        form_class = make_form_class(options.fields)
+
+        for mode in ('htmlfill', 'context'):
+            def submit():
+                form = form_class(handler)
+                form.fill_mode = mode
+                form.validate()
+                form.render(mode + '.html')
+            best = min(timeit.repeat(submit, number=options.num, repeat=3))
+            print("%-9s %d fields: %.2f ms/failed submit" % (
+                mode, options.fields, 1e3 * best / options.num))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
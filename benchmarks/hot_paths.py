@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Benchmarks the per-request hot paths of Durotar.
+
+Measures the text filters (C and pure python ``space_compress``, and the
+C ``websafe`` family when the extension is built), `Route.url_for`,
+`MakoLoader` rendering, `Form.validate`, building `tornpg.Row`\\s from
+a mock cursor and `Admission.admit`. Results are in microseconds per
+call and can be saved and compared between runs::
+
+    $ python benchmarks/hot_paths.py --output=before.json
+    ... upgrade ...
+    $ python benchmarks/hot_paths.py --compare=before.json
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import os
+import shutil
+import tempfile
+import time
+import timeit
+import urllib
+
+from formencode import validators
+from tornado.options import define, options, parse_command_line
+
+from util import FakeHandler, FakeRequest, compare_results, write_results
+
+from durotar import filters
+from durotar.admission import Admission
+from durotar import tornpg
+from durotar.form import Form
+from durotar.route import Route
+from durotar.template import MakoLoader
+
+try:
+    from durotar import cfilters
+except ImportError:
+    cfilters = None
+
+define("num", type=int, default=1000, help="iterations per measurement")
+define("only", type=str, default="", help="run benchmarks containing this")
+define("output", type=str, default="", help="write the results as JSON")
+define("compare", type=str, default="",
+       help="compare with results written by an earlier run")
+
+
+HTML = u"""<div class="item">
+    <a href="/items/%(i)d">   Item   %(i)d </a>
+    <span>  caf\u00e9 &amp; "quotes" </span>
+</div>
+<!-- SCRIPT_ON --><script>  var x  =  %(i)d;  </script><!-- SCRIPT_OFF -->
+"""
+
+TEMPLATE = u"""<html><body><h1>${title}</h1><ul>
+% for item in items:
+  <li class="${'odd' if loop.odd else 'even'}">
+    <a href="/items/${item['id']}">${item['name']}</a> ${item['price']}
+  </li>
+% endfor
+</ul></body></html>"""
+
+
+def bench_filters(cases):
+    page = u''.join(HTML % dict(i=i) for i in range(100))
+    encoded = page.encode('utf-8')
+    cases.append(('space_compress python',
+                  lambda: filters.py_space_compress(encoded)))
+    if cfilters is None:
+        print("durotar.cfilters is not built, skipping the C filters")
+        return
+    cases.append(('space_compress c', lambda: filters.space_compress(encoded)))
+    cases.append(('websafe c', lambda: cfilters.websafe(encoded)))
+    cases.append(('uwebsafe c', lambda: cfilters.uwebsafe(page)))
+    cases.append(('uwebsafe_json c', lambda: cfilters.uwebsafe_json(page)))
+
+
+def bench_url_for(cases):
+    for i in range(100):
+        Route(r'/bench/%d/([0-9]+)' % i, name='bench%d' % i)(
+            type('BenchHandler%d' % i, (object,), {}))
+    cases.append(('Route.url_for 100 routes',
+                  lambda: Route.url_for('bench50', 42)))
+
+
+def bench_render(cases, root):
+    with open(os.path.join(root, 'page.html'), 'w') as f:
+        f.write(TEMPLATE.encode('utf-8'))
+    loader = MakoLoader(root)
+    items = [dict(id=i, name=u'item %d' % i, price=i * 1.5)
+             for i in range(100)]
+
+    def render():
+        loader.load('page.html').generate(title=u'Items', items=items)
+    cases.append(('MakoLoader render 100 rows', render))
+
+
+class BenchForm(Form):
+    name = validators.String(not_empty=True, max=50)
+    email = validators.Email(not_empty=True)
+    age = validators.Int(min=0, max=150)
+    url = validators.URL()
+    bio = validators.String(max=500)
+
+
+def bench_validate(cases):
+    body = urllib.urlencode(dict(name='Durotar', email='user@example.com',
+                                 age='33', url='http://example.com/',
+                                 bio='x' * 200, _xsrf='token'))
+    form = BenchForm(FakeHandler(
+        FakeRequest(body, 'application/x-www-form-urlencoded')))
+    assert form.validate(), form.errors
+    cases.append(('Form.validate 6 fields', form.validate))
+
+
+class MockCursor(object):
+    def __init__(self, columns, rows):
+        self.description = [(name,) for name in columns]
+        self.rows = rows
+        self.rowcount = len(rows)
+        self.lastrowid = None
+
+    def execute(self, query, parameters):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class MockConnection(object):
+    """Answers every query with the same rows."""
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def cursor(self):
+        return MockCursor(self.columns, self.rows)
+
+    def close(self):
+        pass
+
+
+def mock_database(columns, rows):
+    """Returns a `tornpg.Connection` on a `MockConnection`."""
+    db = tornpg.Connection.__new__(tornpg.Connection)
+    db.host = 'mock'
+    db.max_idle_time = float('inf')
+    db._db = MockConnection(columns, rows)
+    db._db_args = {}
+    db._last_use_time = time.time()
+    return db
+
+
+def bench_rows(cases):
+    columns = ['id', 'name', 'email', 'created_at', 'score']
+    rows = [(i, 'user %d' % i, 'user%d@example.com' % i, None, i * 0.5)
+            for i in range(1000)]
+    db = mock_database(columns, rows)
+    cases.append(('tornpg.query 1000 rows',
+                  lambda: db.query("SELECT * FROM users")))
+
+
+def bench_admission(cases):
+    control = Admission(route_rates={'items': (1e9, 1000)},
+                        client_rate=(1e9, 1000), max_concurrency=1000)
+    clients = ['10.0.%d.%d' % (i // 256, i % 256) for i in range(1000)]
+    state = dict(i=0)
+
+    def admit():
+        state['i'] += 1
+        control.admit('items', clients[state['i'] % 1000])
+        control.release('items')
+    cases.append(('Admission.admit 1000 clients', admit))
+
+
+def measure(fn, num):
+    return 1e6 * min(timeit.repeat(fn, number=num, repeat=3)) / num
+
+
+def main():
+    parse_command_line()
+    root = tempfile.mkdtemp()
+    try:
+        cases = []
+        bench_filters(cases)
+        bench_url_for(cases)
+        bench_render(cases, root)
+        bench_validate(cases)
+        bench_rows(cases)
+        bench_admission(cases)
+
+        results = {}
+        for name, fn in cases:
+            if options.only not in name:
+                continue
+            results[name] = measure(fn, options.num)
+            print("%-40s %10.2f us" % (name, results[name]))
+    finally:
+        shutil.rmtree(root)
+
+    if options.compare:
+        print()
+        compare_results(options.compare, results)
+    if options.output:
+        write_results(options.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Checks how long importing Durotar's modules takes against a budget.
+
+Each module of ``--modules`` is imported ``--repeat`` times in a fresh
+interpreter; the best time must stay under ``--budget`` milliseconds, and
+none of the ``--deferred`` modules (psycopg2, Mako, sqlite3 and the
+Durotar modules using them or only needed by some processes), which
+Durotar imports on first use, may be loaded by the import alone, except
+the imported module itself. The exit status is 1 if a check fails, so
+the script can gate a build; ``tests/test_import_time.py`` runs it::
+
+    $ python benchmarks/import_time.py --budget=300 --output=before.json
+
+On Python 3.7 and later the interpreter runs with ``-X importtime`` and
+the ``--top`` slowest imports below each module are listed.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import json
+import os
+import subprocess
+import sys
+
+from tornado.options import define, options, parse_command_line
+
+from util import compare_results, write_results
+
+define("modules", type=str, multiple=True,
+       default=['durotar.web', 'durotar.server', 'durotar.tasks'],
+       help="modules to import")
+define("deferred", type=str, multiple=True,
+       default=['psycopg2', 'mako', 'sqlite3',
+                'durotar.tornpg', 'durotar.template', 'durotar.filters',
+                'durotar.session', 'durotar.executor', 'durotar.httpclient',
+                'durotar.profiler', 'durotar.tasks'],
+       help="modules the imports must not load")
+define("budget", type=float, default=300, help="milliseconds per import")
+define("repeat", type=int, default=5, help="imports per module")
+define("top", type=int, default=5, help="slowest imports to list")
+define("output", type=str, default="", help="write the results as JSON")
+define("compare", type=str, default="",
+       help="compare with results written by an earlier run")
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+start = time.time()
+import %s
+seconds = time.time() - start
+modules = sorted(name for name, m in sys.modules.items() if m is not None)
+print(json.dumps(dict(seconds=seconds, modules=modules)))
+"""
+
+IMPORTTIME = sys.version_info >= (3, 7)
+
+
+def import_once(module):
+    """Returns the import time of ``module`` in seconds, the modules it
+    loaded and the ``-X importtime`` report (empty without it).
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT, env.get('PYTHONPATH', '')]).rstrip(os.pathsep)
+    args = [sys.executable]
+    if IMPORTTIME:
+        args += ['-X', 'importtime']
+    child = subprocess.Popen(args + ['-c', CHILD % module], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = child.communicate()
+    if child.returncode:
+        raise RuntimeError("Cannot import %s:\n%s" % (module, stderr))
+    result = json.loads(stdout.decode('utf-8').splitlines()[-1])
+    return result['seconds'], result['modules'], parse_importtime(stderr)
+
+
+def parse_importtime(stderr):
+    """Returns ``(self_us, name)`` pairs from an ``-X importtime``
+    report.
+    """
+    imports = []
+    for line in stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            imports.append((int(fields[0]), fields[2].strip()))
+        except ValueError:
+            pass  # the header
+    return imports
+
+
+def deferred_loaded(module, loaded):
+    """Returns the ``--deferred`` modules other than ``module`` found in
+    ``loaded``.
+    """
+    return [d for d in options.deferred if d != module and
+            any(name == d or name.startswith(d + '.') for name in loaded)]
+
+
+def main():
+    parse_command_line()
+    results = {}
+    failed = False
+    for module in options.modules:
+        runs = [import_once(module) for i in range(options.repeat)]
+        seconds, loaded, imports = min(runs, key=lambda run: run[0])
+        ms = 1e3 * seconds
+        results['import %s ms' % module] = ms
+        print("%-40s %10.2f ms" % (module, ms))
+        if ms > options.budget:
+            print("  over the budget of %.0f ms" % options.budget)
+            failed = True
+        eager = deferred_loaded(module, loaded)
+        if eager:
+            print("  loads deferred modules: %s" % ', '.join(eager))
+            failed = True
+        for us, name in sorted(imports, reverse=True)[:options.top]:
+            print("  %8.2f ms  %s" % (us / 1e3, name))
+
+    if options.compare:
+        print()
+        compare_results(options.compare, results)
+    if options.output:
+        write_results(options.output, results)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
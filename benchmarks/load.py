@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""An end-to-end load generator against the hello demo application.
+
+Starts ``durotar --settings=hello.settings`` from ``demos/`` on a local
+port, sends ``--requests`` requests to each path keeping
+``--concurrency`` in flight, and reports the time per request and the
+latency percentiles, all in milliseconds. Results can be saved and
+compared between runs like those of ``hot_paths.py``::
+
+    $ python benchmarks/load.py --workers=2 --output=before.json
+
+The client runs in this process on one IOLoop and may saturate before a
+multi-worker server does; use ``--paths`` to load one path at a time.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+
+from util import compare_results, write_results
+
+define("port", type=int, default=8765, help="port of the demo server")
+define("workers", type=int, default=1, help="demo server workers")
+define("requests", type=int, default=2000, help="requests per path")
+define("concurrency", type=int, default=20, help="requests in flight")
+define("paths", type=str, multiple=True,
+       default=['/hello', '/', '/api/items', 'POST /signup'],
+       help="paths to load, prefixed with POST to post a signup form")
+define("output", type=str, default="", help="write the results as JSON")
+define("compare", type=str, default="",
+       help="compare with results written by an earlier run")
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIGNUP = urllib.urlencode(dict(name='Durotar', email='user@example.com'))
+
+
+def start_server():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT, env.get('PYTHONPATH', '')]).rstrip(os.pathsep)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'durotar.server', '--settings=hello.settings',
+         '--port=%d' % options.port, '--workers=%d' % options.workers,
+         '--logging=warning'],
+        cwd=os.path.join(ROOT, 'demos'), env=env)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', options.port), 0.1).close()
+            return server
+        except socket.error:
+            if time.time() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError("The demo server did not start")
+            time.sleep(0.1)
+
+
+def make_request(path):
+    method = 'GET'
+    body = None
+    if path.startswith('POST '):
+        method, path = path.split(' ', 1)
+        body = SIGNUP
+    return HTTPRequest('http://127.0.0.1:%d%s' % (options.port, path),
+                       method=method, body=body)
+
+
+@gen.coroutine
+def load(client, path):
+    """Returns the total time and the sorted latencies of the requests."""
+    latencies = []
+    errors = [0]
+    remaining = [options.requests]
+
+    @gen.coroutine
+    def user():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.time()
+            # with a callback, error responses don't raise
+            response = yield gen.Task(client.fetch, make_request(path))
+            latencies.append(time.time() - start)
+            if response.code != 200:
+                errors[0] += 1
+
+    start = time.time()
+    yield [user() for i in range(options.concurrency)]
+    elapsed = time.time() - start
+    if errors[0]:
+        print("%s: %d requests failed" % (path, errors[0]))
+    raise gen.Return((elapsed, sorted(latencies)))
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+@gen.coroutine
+def run():
+    client = AsyncHTTPClient(max_clients=options.concurrency)
+    results = {}
+    for path in options.paths:
+        # warm up template and connection caches
+        yield [gen.Task(client.fetch, make_request(path))
+               for i in range(options.concurrency)]
+        elapsed, latencies = yield load(client, path)
+        results['%s ms/request' % path] = 1e3 * elapsed / len(latencies)
+        for p in (0.5, 0.9, 0.99):
+            results['%s p%d ms' % (path, p * 100)] = \
+                1e3 * percentile(latencies, p)
+        print("%-16s %8.0f req/s  p50 %6.2f ms  p90 %6.2f ms  p99 %6.2f ms"
+              % (path, len(latencies) / elapsed,
+                 results['%s p50 ms' % path], results['%s p90 ms' % path],
+                 results['%s p99 ms' % path]))
+    raise gen.Return(results)
+
+
+def main():
+    parse_command_line()
+    server = start_server()
+    try:
+        results = IOLoop.current().run_sync(run)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    if options.compare:
+        print()
+        compare_results(options.compare, results)
+    if options.output:
+        write_results(options.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Stand-ins and result files shared by the benchmarks.
+
+Importing this module puts the repository root on ``sys.path``, so the
+benchmarks run against the working tree without installing it; they
+import it before Durotar.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import json
+import os
+import platform
+import sys
+import time
+
+import tornado
+from tornado import httputil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import durotar
+
+
+class FakeRequest(object):
+    """The parts of `tornado.httputil.HTTPServerRequest` Form reads."""
+
+    def __init__(self, body, content_type, method='POST'):
+        self.method = method
+        self.body = body
+        self.headers = httputil.HTTPHeaders({'Content-Type': content_type})
+        self.body_arguments = {}
+        self.files = {}
+        httputil.parse_body_arguments(content_type, body,
+                                      self.body_arguments, self.files)
+
+
+class FakeHandler(object):
+    """A handler without a connection; ``finish`` keeps the output."""
+
+    settings = {}
+
+    def __init__(self, request):
+        self.request = request
+        self.output = None
+
+    def finish(self, chunk=None):
+        self.output = chunk
+
+
+def write_results(path, results):
+    """Writes ``results``, a dict of measurements by name, to ``path`` as
+    JSON together with the versions they were taken with.
+    """
+    with open(path, 'w') as f:
+        json.dump(dict(time=time.time(),
+                       python=platform.python_version(),
+                       tornado=tornado.version,
+                       durotar=durotar.version,
+                       results=results), f, indent=2, sort_keys=True)
+
+
+def compare_results(path, results):
+    """Prints ``results`` next to the ones stored at ``path``. Lower is
+    better for every measurement.
+    """
+    with open(path) as f:
+        previous = json.load(f)['results']
+    for name in sorted(results):
+        value = results[name]
+        before = previous.get(name)
+        if not before:
+            print("%-40s %12.2f" % (name, value))
+            continue
+        print("%-40s %12.2f %12.2f %+7.1f%%" % (
+            name, before, value, 100.0 * (value - before) / before))
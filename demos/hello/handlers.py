@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Handlers of the hello demo, one per typical kind of page."""
+
+from formencode import validators
+
+from durotar.form import Form
+from durotar.route import route
+from durotar.web import RequestHandler
+
+
+ITEMS = [dict(id=i, name=u'Item %d' % i, price=i * 1.5) for i in range(50)]
+
+
+@route(r'/', name='index')
+class IndexHandler(RequestHandler):
+    def get(self):
+        self.render('index.html', title=u'Hello', items=ITEMS)
+
+
+@route(r'/hello', name='hello')
+class HelloHandler(RequestHandler):
+    def get(self):
+        self.write('Hello, world')
+
+
+@route(r'/api/items', name='items')
+class ItemsHandler(RequestHandler):
+    def get(self):
+        self.write(dict(items=ITEMS))
+
+
+class SignupForm(Form):
+    _xsrf = validators.String(if_missing=None)
+    name = validators.String(not_empty=True, max=50)
+    email = validators.Email(not_empty=True)
+
+
+@route(r'/signup', name='signup')
+class SignupHandler(RequestHandler):
+    def post(self):
+        form = SignupForm(self)
+        if form.validate():
+            self.write(dict(ok=True, name=form.params['name']))
+        else:
+            self.set_status(400)
+            self.write(dict(ok=False, errors=form.normalized_errors))
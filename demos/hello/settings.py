@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Settings of the hello demo::
+
+    $ cd demos
+    $ durotar --settings=hello.settings --port=8000
+"""
+
+import os.path
+
+apps = ['hello']
+
+template_path = os.path.join(os.path.dirname(__file__), 'templates')
+
+cookie_secret = 'not so secret'
+
+xsrf_cookies = False
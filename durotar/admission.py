@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Admission control: rate limits, concurrency caps and load shedding.
+
+Under a traffic spike, a worker that accepts every request queues them
+until the database saturates and every request is slow. `Admission`
+rejects the surplus in `durotar.web.RequestHandler` before the handler
+runs, with an empty response and a ``Retry-After`` header:
+
+* 429 when the route or the client exceeds its rate. Routes are keyed by
+  their `~durotar.route.Route` name and clients by
+  `~durotar.web.RequestHandler.admission_key` (the remote IP by default).
+* 503 when the worker or the route already runs its maximum of
+  concurrent requests.
+* 503 when the worker is overloaded: its IOLoop runs callbacks more than
+  ``max_lag`` seconds late, its database statements recently took more
+  than ``max_db_latency`` seconds (see
+  `durotar.tornpg.Connection.latency`), or blocking calls (through
+  `durotar.executor.blocking`) wait more than ``max_pool_wait`` seconds
+  for a pool thread.
+
+Rates are ``(rate, burst)`` pairs: ``rate`` requests per second on
+average and up to ``burst`` at once. They are enforced with the generic
+cell rate algorithm, which behaves like a token bucket but keeps a single
+float per key; keys whose bucket has refilled are evicted every
+``evict_interval`` seconds, and at most ``max_keys`` keys are tracked.
+Limits are per worker process.
+
+Admission control is configured with the ``admission_route_rates`` (a
+dict of rates by route name), ``admission_client_rate``,
+``admission_max_concurrency``, ``admission_route_concurrency`` (a dict of
+caps by route name), ``admission_max_lag``,
+``admission_max_db_latency``, ``admission_max_pool_wait`` and
+``admission_exempt`` (route names never rejected) application settings,
+and is disabled when none of the limits is set.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import time
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from durotar import metrics
+
+
+_REJECTED = metrics.REGISTRY.counter(
+    'durotar_admission_rejected_total',
+    'Requests rejected by route and reason (route_rate, client_rate, '
+    'concurrency, overload).', ('route', 'reason'))
+_LAG = metrics.REGISTRY.gauge(
+    'durotar_ioloop_lag_seconds', 'Recent IOLoop callback delay.')
+
+
+class RateLimiter(object):
+    """Limits each key to ``rate`` events per second with bursts of up to
+    ``burst`` events.
+
+    For each key only the time at which its bucket will be full again is
+    kept (the theoretical arrival time of the generic cell rate
+    algorithm); a key absent from the dict has a full bucket.
+    """
+
+    def __init__(self, rate, burst=1, max_keys=100000):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._interval = 1 / self.rate
+        self._tolerance = (self.burst - 1) * self._interval
+        self._tats = {}
+        self._evicted_at = 0
+
+    def __len__(self):
+        return len(self._tats)
+
+    def take(self, key, now=None):
+        """Counts an event for ``key``. Returns 0 if it is allowed,
+        otherwise the seconds until it would be.
+        """
+        now = now or time.time()
+        tat = self._tats.get(key)
+        if tat is None:
+            if len(self._tats) >= self.max_keys:
+                if now - self._evicted_at > 1:
+                    self.evict(now)
+                if len(self._tats) >= self.max_keys:
+                    # allow rather than forget the limited keys
+                    return 0
+            tat = now
+        elif tat < now:
+            tat = now
+        wait = tat - self._tolerance - now
+        if wait > 0:
+            return wait
+        self._tats[key] = tat + self._interval
+        return 0
+
+    def evict(self, now=None):
+        """Drops the keys whose bucket has refilled."""
+        now = self._evicted_at = now or time.time()
+        tats = self._tats
+        for key in [key for key, tat in tats.items() if tat <= now]:
+            del tats[key]
+
+
+class LagMonitor(object):
+    """Measures how late the IOLoop runs a callback scheduled every
+    ``interval`` seconds. `lag` follows an increase at once and decays
+    by ``decay`` per interval afterwards.
+    """
+
+    def __init__(self, interval=0.05, decay=0.8, io_loop=None):
+        self.interval = interval
+        self.decay = decay
+        self.io_loop = io_loop or IOLoop.current()
+        self.lag = 0
+        self._timeout = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        deadline = time.time() + self.interval
+        self._timeout = self.io_loop.add_timeout(
+            deadline, lambda: self._tick(deadline))
+
+    def _tick(self, deadline):
+        self.lag = max(time.time() - deadline, self.lag * self.decay)
+        _LAG.set(self.lag)
+        self._schedule()
+
+
+class Admission(object):
+    """Decides whether a worker accepts a request.
+
+    ``route_rates`` and ``route_concurrency`` are dicts by route name;
+    ``db`` is the `~durotar.tornpg.Connection` whose latency is compared
+    with ``max_db_latency``, and ``pool`` the
+    `~durotar.executor.BoundedExecutor` whose queue wait is compared with
+    ``max_pool_wait``. Zero or None disables a limit.
+    """
+
+    def __init__(self, route_rates=None, client_rate=None,
+                 max_concurrency=0, route_concurrency=None, max_lag=0,
+                 max_db_latency=0, db=None, max_pool_wait=0, pool=None,
+                 exempt=(), max_keys=100000, evict_interval=60,
+                 io_loop=None):
+        self.io_loop = io_loop or IOLoop.current()
+        self.route_rates = dict(
+            (route, RateLimiter(rate, burst))
+            for route, (rate, burst) in (route_rates or {}).items())
+        self.client_rate = None
+        if client_rate:
+            self.client_rate = RateLimiter(client_rate[0], client_rate[1],
+                                           max_keys)
+        self.max_concurrency = max_concurrency
+        self.route_concurrency = route_concurrency or {}
+        self.max_lag = max_lag
+        self.max_db_latency = max_db_latency if db is not None else 0
+        self.db = db
+        self.max_pool_wait = max_pool_wait if pool is not None else 0
+        self.pool = pool
+        self.exempt = frozenset(exempt)
+        self.evict_interval = evict_interval
+        self.in_flight = 0
+        self._route_in_flight = {}
+        self._monitor = None
+        if max_lag:
+            self._monitor = LagMonitor(io_loop=self.io_loop)
+        self._evictor = None
+
+    def start(self):
+        if self._monitor is not None:
+            self._monitor.start()
+        if self.client_rate is not None:
+            self._evictor = PeriodicCallback(
+                self.client_rate.evict, self.evict_interval * 1000,
+                io_loop=self.io_loop)
+            self._evictor.start()
+
+    def stop(self):
+        if self._monitor is not None:
+            self._monitor.stop()
+        if self._evictor is not None:
+            self._evictor.stop()
+            self._evictor = None
+
+    @property
+    def lag(self):
+        """The recent IOLoop lag in seconds (0 if not monitored)."""
+        return self._monitor.lag if self._monitor is not None else 0
+
+    def admit(self, route, client):
+        """Admits a request to ``route`` from ``client``. Returns None, to
+        be followed by a `release` when the request is done, or the
+        ``(status, retry_after)`` to reject it with.
+        """
+        if route in self.exempt:
+            return None
+        if self.overloaded():
+            return self._reject(route, 'overload', 503, 1)
+        now = time.time()
+        limiter = self.route_rates.get(route)
+        if limiter is not None:
+            wait = limiter.take(route, now)
+            if wait:
+                return self._reject(route, 'route_rate', 429, wait)
+        if self.client_rate is not None:
+            wait = self.client_rate.take(client, now)
+            if wait:
+                return self._reject(route, 'client_rate', 429, wait)
+        in_flight = self._route_in_flight.get(route, 0)
+        cap = self.route_concurrency.get(route)
+        if ((self.max_concurrency and
+                self.in_flight >= self.max_concurrency) or
+                (cap and in_flight >= cap)):
+            return self._reject(route, 'concurrency', 503, 1)
+        self.in_flight += 1
+        self._route_in_flight[route] = in_flight + 1
+        return None
+
+    def release(self, route):
+        """Ends a request admitted by `admit`."""
+        if route in self.exempt:
+            return
+        self.in_flight -= 1
+        in_flight = self._route_in_flight.pop(route) - 1
+        if in_flight:
+            self._route_in_flight[route] = in_flight
+
+    def overloaded(self):
+        """Returns True if the IOLoop lag, the database latency or the
+        pool queue wait exceeds its limit.
+        """
+        if self.max_lag and self._monitor.lag > self.max_lag:
+            return True
+        if self.max_db_latency and self.db.latency > self.max_db_latency:
+            return True
+        return bool(self.max_pool_wait and
+                    self.pool.queue_wait() > self.max_pool_wait)
+
+    def _reject(self, route, reason, status, retry_after):
+        _REJECTED.inc(labels=(route, reason))
+        return status, retry_after
+
+
+def create_admission(settings, executors=None, db=None, io_loop=None):
+    """Creates the `Admission` described by the application ``settings``,
+    or returns None if no limit is set.
+    """
+    route_rates = settings.get('admission_route_rates')
+    client_rate = settings.get('admission_client_rate')
+    max_concurrency = settings.get('admission_max_concurrency', 0)
+    route_concurrency = settings.get('admission_route_concurrency')
+    max_lag = settings.get('admission_max_lag', 0)
+    max_db_latency = settings.get('admission_max_db_latency', 0)
+    max_pool_wait = settings.get('admission_max_pool_wait', 0)
+    if not (route_rates or client_rate or max_concurrency or
+            route_concurrency or max_lag or max_db_latency or
+            max_pool_wait):
+        return None
+    return Admission(
+        route_rates=route_rates, client_rate=client_rate,
+        max_concurrency=max_concurrency,
+        route_concurrency=route_concurrency, max_lag=max_lag,
+        max_db_latency=max_db_latency, db=db, max_pool_wait=max_pool_wait,
+        pool=(executors or {}).get('thread'),
+        exempt=settings.get('admission_exempt', ()),
+        max_keys=settings.get('admission_max_keys', 100000),
+        evict_interval=settings.get('admission_evict_interval', 60),
+        io_loop=io_loop)
@@ -15,22 +15,36 @@ the `durotar.web.RequestHandler` class. They are used in two ways:
   database and/or cookies.
 * In non-login handlers, use methods such as ``wechat_request()``
   to use the authtication tokens to make requests to the respective services.
+
+Tokens obtained at login are kept in a `TokenStore` (by default a
+per-process `MemoryTokenStore`, see the ``wechat_token_store`` setting),
+so later requests can get a valid access token with ``get_access_token()``
+instead of a round trip to Wechat.
+
+The asynchronous methods return plain Futures to be yielded from
+coroutines and run without ``stack_context``; the ``callback`` argument
+is still accepted for older callers.
 """
 
 from __future__ import absolute_import, division, print_function, with_statement
 
+import collections
 import logging
 import functools
+import sys
+import time
 
-from tornado.concurrent import TracebackFuture, return_future
-from tornado import gen
-from tornado import httpclient
+from tornado.concurrent import TracebackFuture, chain_future
 from tornado import escape
 from tornado.httputil import url_concat
 from tornado.log import gen_log
-from tornado.stack_context import ExceptionStackContext
 from tornado.util import ArgReplacer
 
+from durotar import metrics
+from durotar import tracing
+from durotar.httpclient import shared_client
+from durotar.util import load_class
+
 try:
     import urlparse # py2
 except ImportError:
@@ -50,6 +64,64 @@ class AuthError(Exception):
     pass
 
 
+class TokenStore(object):
+    """Keeps Wechat OAuth tokens keyed by ``(appid, openid)``.
+
+    A token is the session dict returned by ``get_openid`` plus an
+    ``expires_at`` timestamp. Subclass to keep tokens somewhere shared by
+    all workers, and configure it with the ``wechat_token_store`` setting.
+    """
+
+    def get(self, appid, openid):
+        """Returns the stored token, or None."""
+        raise NotImplementedError()
+
+    def set(self, appid, openid, token):
+        raise NotImplementedError()
+
+    def delete(self, appid, openid):
+        raise NotImplementedError()
+
+
+class MemoryTokenStore(TokenStore):
+    """A per-process `TokenStore` holding at most ``max_size`` tokens.
+
+    Tokens are dropped once their refresh token has expired (Wechat
+    refresh tokens last 30 days), or oldest first when the store is full.
+    """
+
+    def __init__(self, max_size=100000, refresh_expires_in=30 * 24 * 3600):
+        self.max_size = max_size
+        self.refresh_expires_in = refresh_expires_in
+        self._tokens = collections.OrderedDict()
+
+    def get(self, appid, openid):
+        entry = self._tokens.get((appid, openid))
+        if entry is None:
+            return None
+        token, stored_at = entry
+        if time.time() - stored_at > self.refresh_expires_in:
+            del self._tokens[(appid, openid)]
+            return None
+        return token
+
+    def set(self, appid, openid, token):
+        key = (appid, openid)
+        self._tokens.pop(key, None)
+        self._tokens[key] = (token, time.time())
+        while len(self._tokens) > self.max_size:
+            self._tokens.popitem(last=False)
+
+    def delete(self, appid, openid):
+        self._tokens.pop((appid, openid), None)
+
+
+_default_token_store = None
+
+# refreshes in flight, by (appid, openid), so concurrent callers share one
+_token_refreshes = {}
+
+
 def _auth_future_to_callback(callback, future):
     try:
         result = future.result()
@@ -59,12 +131,28 @@ def _auth_future_to_callback(callback, future):
     callback(result)
 
 
+def _fail(future):
+    """Sets the exception being handled on ``future``, unless it is done."""
+    if future.done():
+        raise
+    future.set_exc_info(sys.exc_info())
+
+
+def _log_failure(future):
+    """Logs the exception of a future nobody waits for."""
+    if future.exception() is not None:
+        gen_log.error("Error in Wechat auth callback",
+                      exc_info=future.exc_info())
+
+
 def _auth_return_future(f):
-    """Similar to tornado.concurrent.return_future, but uses the auth
-    module's legacy callback interface.
+    """Makes ``f`` return a plain Future, keeping the auth module's legacy
+    ``callback`` interface as a thin shim.
 
     Note that when using this decorator the ``callback`` parameter
-    inside the function will actually be a future
+    inside the function will actually be a future. Exceptions raised by
+    ``f`` itself fail the future; the asynchronous steps report theirs
+    through `_auth_fetch`, so no ``stack_context`` is involved.
     """
     replacer = ArgReplacer(f, 'callback')
 
@@ -75,17 +163,64 @@ def _auth_return_future(f):
         if callback is not None:
             future.add_done_callback(
                 functools.partial(_auth_future_to_callback, callback))
-        def handle_exception(typ, value, tb):
-            if future.done():
-                return False
-            else:
-                future.set_exc_info((typ, value, tb))
-                return True
-        with ExceptionStackContext(handle_exception):
+        try:
             f(*args, **kwargs)
+        except Exception:
+            _fail(future)
         return future
     return wrapper
-        
+
+
+def _auth_fetch(http, url, future, step, **kwargs):
+    """Fetches ``url`` and passes the response to ``step``. Exceptions
+    raised by ``step`` fail ``future``. Records an ``auth`` span on the
+    current trace.
+    """
+    span = tracing.start_span('auth')
+
+    def on_response(response):
+        span.finish()
+        try:
+            step(response)
+        except Exception:
+            _fail(future)
+    http.fetch(url, callback=on_response, **kwargs)
+
+
+def _run_bounded(tasks, concurrency, on_complete):
+    """Runs ``task(done)`` for each of ``tasks``, at most ``concurrency``
+    at a time; each task calls ``done()`` once it has finished.
+    """
+    tasks = iter(tasks)
+    state = {'active': 0, 'exhausted': False, 'starting': False}
+
+    def start():
+        # tasks finishing synchronously re-enter here; let the outer
+        # loop start the next ones instead of recursing
+        if state['starting']:
+            return
+        state['starting'] = True
+        try:
+            while state['active'] < concurrency and not state['exhausted']:
+                try:
+                    task = next(tasks)
+                except StopIteration:
+                    state['exhausted'] = True
+                    break
+                state['active'] += 1
+                task(finish)
+        finally:
+            state['starting'] = False
+        if state['exhausted'] and not state['active']:
+            state['active'] = -1  # completed
+            on_complete()
+
+    def finish():
+        state['active'] -= 1
+        start()
+
+    start()
+
 
 class WechatMixin(object):
     """Abstract implementation of Wechat OAuth 2.0
@@ -97,7 +232,6 @@ class WechatMixin(object):
     * ``_OAUTH_AUTHORIZE_URL``: The service's authorization url.
     * ``_OAUTH_ACCESS_TOKEN_URL``: The service's access token url.
     """
-    @return_future
     def authorize_redirect(self, redirect_uri=None, appid=None,
                            secret=None, extra_params=None,
                            callback=None, scope=None, response_type="code"):
@@ -120,7 +254,11 @@ class WechatMixin(object):
             args['scope'] = ",".join(scope)
         self.redirect(
             url_concat(self._OAUTH_AUTHORIZE_URL, args)+'#wechat_redirect')
-        callback()
+        future = TracebackFuture()
+        future.set_result(None)
+        if callback is not None:
+            callback()
+        return future
 
     def _oauth_request_token_url(self, redirect_uri=None, appid=None,
                                  secret=None, code=None,
@@ -143,9 +281,13 @@ class WechatMpMixin(WechatMixin):
     """Wechat Media Platform authentication using OAuth2
     """
     _OAUTH_ACCESS_TOKEN_URL = "https://api.weixin.qq.com/sns/oauth2/access_token?"
+    _OAUTH_REFRESH_TOKEN_URL = "https://api.weixin.qq.com/sns/oauth2/refresh_token?"
     _OAUTH_AUTHORIZE_URL = "https://open.weixin.qq.com/connect/oauth2/authorize?"
     _OAUTH_NO_CALLBACKS = False
     _WECHAT_BASE_URL = "https://api.weixin.qq.com/sns"
+    _WECHAT_API_URL = "https://api.weixin.qq.com/cgi-bin"
+    # openids per user/info/batchget call, the API's maximum
+    _BATCHGET_SIZE = 100
 
     @_auth_return_future
     def get_openid(self, redirect_uri, appid, secret, code,
@@ -159,9 +301,9 @@ class WechatMpMixin(WechatMixin):
             'grant_type': grant_type,
         }
 
-        http.fetch(self._oauth_request_token_url(**args),
-                   functools.partial(self._on_openid, redirect_uri, appid,
-                                     secret, callback))
+        _auth_fetch(http, self._oauth_request_token_url(**args), callback,
+                    functools.partial(self._on_openid, redirect_uri, appid,
+                                      secret, callback))
 
     def _on_openid(self, redirect_uri, appid, secret, future, response):
         if response.error:
@@ -180,9 +322,99 @@ class WechatMpMixin(WechatMixin):
             'openid': args.get('openid'),
             'scope': args.get('scope'),
         }
+        self._store_token(appid, session)
 
         future.set_result(session)
 
+    # tokens this close to expiry are refreshed in the background
+    token_refresh_margin = 300
+
+    def get_token_store(self):
+        """Returns the `TokenStore` configured by the ``wechat_token_store``
+        setting (an instance or a dotted class path), by default a
+        `MemoryTokenStore` shared by the process.
+        """
+        global _default_token_store
+        store = self.settings.get('wechat_token_store')
+        if store is None:
+            if _default_token_store is None:
+                _default_token_store = MemoryTokenStore()
+            return _default_token_store
+        if isinstance(store, basestring):
+            store = self.settings['wechat_token_store'] = load_class(store)()
+        return store
+
+    def _store_token(self, appid, session):
+        if not session.get('openid') or not session.get('access_token'):
+            return
+        token = dict(session)
+        token['expires_at'] = time.time() + int(session.get('expires_in') or 0)
+        self.get_token_store().set(appid, session['openid'], token)
+        return token
+
+    @_auth_return_future
+    def get_access_token(self, appid, openid, callback):
+        """Returns the stored token of ``openid``, refreshing it first if
+        it has expired. Tokens close to expiry are returned as they are
+        and refreshed in the background.
+
+        Resolves to None when no token is known or it cannot be
+        refreshed; the user has to log in again.
+        """
+        token = self.get_token_store().get(appid, openid)
+        now = time.time()
+        if token is not None and now < token['expires_at']:
+            metrics.CACHE_REQUESTS.inc(labels=('wechat_token', 'hit'))
+            if now >= token['expires_at'] - self.token_refresh_margin:
+                self._refresh_token(appid, token)
+            callback.set_result(token)
+            return
+
+        metrics.CACHE_REQUESTS.inc(labels=('wechat_token', 'miss'))
+        if token is None or not token.get('refresh_token'):
+            callback.set_result(None)
+            return
+        chain_future(self._refresh_token(appid, token), callback)
+
+    def _refresh_token(self, appid, token):
+        """Refreshes ``token``, sharing the request with concurrent callers.
+        Returns a Future resolving to the new token or None.
+        """
+        key = (appid, token['openid'])
+        future = _token_refreshes.get(key)
+        if future is not None:
+            return future
+
+        future = _token_refreshes[key] = TracebackFuture()
+        future.add_done_callback(lambda f: _token_refreshes.pop(key, None))
+        url = url_concat(self._OAUTH_REFRESH_TOKEN_URL, dict(
+            appid=appid, grant_type='refresh_token',
+            refresh_token=token['refresh_token']))
+        _auth_fetch(self.get_auth_http_client(), url, future,
+                    functools.partial(self._on_refresh_token, appid,
+                                      token, future))
+        return future
+
+    def _on_refresh_token(self, appid, token, future, response):
+        store = self.get_token_store()
+        args = None
+        if not response.error:
+            args = escape.json_decode(response.body)
+        if not args or 'access_token' not in args:
+            gen_log.warning("Wechat token refresh failed for %s: %s",
+                            token['openid'], response.error or args)
+            if args and args.get('errcode'):
+                # the refresh token itself is no longer valid
+                store.delete(appid, token['openid'])
+            future.set_result(None)
+            return
+
+        session = dict(token)
+        for key in ('access_token', 'expires_in', 'refresh_token', 'scope'):
+            if args.get(key) is not None:
+                session[key] = args[key]
+        future.set_result(self._store_token(appid, session))
+
     @_auth_return_future
     def get_authenticated_user(self, redirect_uri, appid, secret, code,
                                callback, grant_type='authorization_code',
@@ -222,9 +454,9 @@ class WechatMpMixin(WechatMixin):
         if extra_fields:
             fields.update(extra_fields)
 
-        http.fetch(self._oauth_request_token_url(**args),
-                   functools.partial(self._on_access_token, redirect_uri, appid,
-                                       secret, callback, fields))
+        _auth_fetch(http, self._oauth_request_token_url(**args), callback,
+                    functools.partial(self._on_access_token, redirect_uri,
+                                      appid, secret, callback, fields))
 
     def _on_access_token(self, redirect_uri, appid, secret, future,
                          fields, response):
@@ -242,16 +474,24 @@ class WechatMpMixin(WechatMixin):
             'openid': args.get('openid'),
             'scope': args.get('scope'),
         }
+        self._store_token(appid, session)
 
         self.wechat_request(
             path="/userinfo",
-            callback=functools.partial(
-                self._on_get_user_info, future, session, fields),
             access_token=session['access_token'],
             fields=",".join(fields)
-        )
-
-    def _on_get_user_info(self, future, session, fields, user):
+        ).add_done_callback(functools.partial(
+            self._on_get_user_info, future, session, fields))
+
+    def _on_get_user_info(self, future, session, fields, user_future):
+        try:
+            user = user_future.result()
+        except AuthError as e:
+            gen_log.warning(str(e))
+            user = None
+        except Exception:
+            _fail(future)
+            return
         if user is None:
             future.set_result(None)
             return
@@ -267,7 +507,115 @@ class WechatMpMixin(WechatMixin):
         future.set_result(fieldmap)
 
     @_auth_return_future
-    def wechat_request(self, path, callback, access_token=None,
+    def get_users_info(self, openids, callback, appid=None, access_token=None,
+                       concurrency=10, on_result=None, lang='zh_CN'):
+        """Fetches the profiles of many users with at most ``concurrency``
+        requests in flight.
+
+        Given ``access_token``, a Media Platform (cgi-bin) API token, the
+        profiles are fetched with ``user/info/batchget``, 100 openids per
+        call. Otherwise each user's own OAuth token is taken from the token
+        store of ``appid`` and their ``/userinfo`` is fetched.
+
+        ``on_result(openid, user, error)`` is called as each profile
+        arrives. The returned Future resolves to a dict with ``errors``,
+        mapping failed openids to an error message, and ``users``, mapping
+        openids to profiles unless ``on_result`` was given (so large jobs
+        need not hold every profile in memory).
+
+        The endpoints come from ``_WECHAT_BASE_URL`` and
+        ``_WECHAT_API_URL``, which tests can point at a local stub server.
+        """
+        results = {'users': {}, 'errors': {}}
+
+        def report(openid, user, error):
+            if error is not None:
+                results['errors'][openid] = error
+            elif on_result is None:
+                results['users'][openid] = user
+            if on_result is not None:
+                on_result(openid, user, error)
+
+        openids = list(openids)
+        if access_token is not None:
+            size = self._BATCHGET_SIZE
+            tasks = [functools.partial(self._batchget_users, access_token,
+                                       openids[i:i + size], lang, report)
+                     for i in range(0, len(openids), size)]
+        else:
+            tasks = [functools.partial(self._get_user_info, appid, openid,
+                                       report)
+                     for openid in openids]
+        _run_bounded(tasks, concurrency,
+                     lambda: callback.set_result(results))
+
+    def _batchget_users(self, access_token, openids, lang, report, done):
+        url = url_concat(self._WECHAT_API_URL + "/user/info/batchget",
+                         dict(access_token=access_token))
+        body = escape.json_encode(dict(user_list=[
+            dict(openid=openid, lang=lang) for openid in openids]))
+
+        def on_response(response):
+            try:
+                users = {}
+                if response.error:
+                    error = "Error response %s" % response.error
+                else:
+                    try:
+                        args = escape.json_decode(response.body)
+                        error = (args.get('errmsg') if args.get('errcode')
+                                 else None)
+                        users = dict((user.get('openid'), user) for user
+                                     in args.get('user_info_list', ()))
+                    except Exception as e:
+                        # report the whole chunk as failed
+                        error = "Invalid response: %s" % e
+                for openid in openids:
+                    user = users.get(openid)
+                    if user is None:
+                        report(openid, None, error or "No user info returned")
+                    else:
+                        report(openid, user, None)
+            finally:
+                done()
+        # only an on_result callback can fail here
+        failure = TracebackFuture()
+        failure.add_done_callback(_log_failure)
+        _auth_fetch(self.get_auth_http_client(), url, failure,
+                    on_response, method="POST", body=body)
+
+    def _get_user_info(self, appid, openid, report, done):
+        def on_token(future):
+            try:
+                token = future.result()
+            except Exception as e:
+                report(openid, None, str(e) or "Token refresh failed")
+                done()
+                return
+            if token is None:
+                report(openid, None, "No access token")
+                done()
+                return
+            self.wechat_request("/userinfo",
+                                access_token=token['access_token'],
+                                openid=openid).add_done_callback(on_user)
+
+        def on_user(future):
+            try:
+                user = future.result()
+            except Exception as e:
+                report(openid, None, str(e))
+            else:
+                if user.get('errcode'):
+                    report(openid, None, user.get('errmsg'))
+                else:
+                    report(openid, user, None)
+            finally:
+                done()
+        self.get_access_token(appid, openid).add_done_callback(on_token)
+
+    @_auth_return_future
+    def wechat_request(self, path, callback=None, access_token=None,
                        post_args=None, **args):
         """Fetches the given relative API path, e.g., "/userinfo"
 
@@ -308,13 +656,13 @@ class WechatMpMixin(WechatMixin):
 
         if all_args:
             url += "?" + urllib_parse.urlencode(all_args)
-        callback = functools.partial(self._on_wechat_request, callback)
+        step = functools.partial(self._on_wechat_request, callback)
         http = self.get_auth_http_client()
         if post_args is not None:
-            http.fetch(url, method="POST", body=urllib_parse.urlencode(post_args),
-                       callback=callback)
+            _auth_fetch(http, url, callback, step, method="POST",
+                        body=urllib_parse.urlencode(post_args))
         else:
-            http.fetch(url, callback=callback)
+            _auth_fetch(http, url, callback, step)
 
     def _on_wechat_request(self, future, response):
         if response.error:
@@ -325,9 +673,10 @@ class WechatMpMixin(WechatMixin):
         future.set_result(escape.json_decode(response.body))
 
     def get_auth_http_client(self):
-        """Returns the `.AsyncHTTPClient` instance to be used for auth requests.
+        """Returns the HTTP client to be used for auth requests, by default
+        the process's pooled `durotar.httpclient.OutboundClient`.
 
         May be overridden by subclasses to use an HTTP client other than
         the default.
         """
-        return httpclient.AsyncHTTPClient()
\ No newline at end of file
+        return shared_client()
\ No newline at end of file
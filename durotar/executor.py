@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Bounded thread and process pools for blocking work.
+
+Blocking calls (htmlfill on a big form, image processing, reading large
+files, synchronous client libraries) freeze the IOLoop of the worker they
+run in. The application owns one thread pool and, optionally, one process
+pool; handlers hand blocking calls to them and yield the returned
+future::
+
+    class ThumbnailHandler(durotar.web.RequestHandler):
+        @tornado.gen.coroutine
+        def post(self):
+            data = yield self.run_in_process(make_thumbnail,
+                                             self.request.body)
+            self.finish(data)
+
+        @tornado.gen.coroutine
+        def get(self):
+            report = yield self.read_report()
+            ...
+
+        @blocking
+        def read_report(self):
+            with open(REPORT_PATH) as f:
+                return f.read()
+
+Code run in a pool must not use the application's ``db``: the
+`durotar.tornpg.Connection` is shared by the worker's requests and is not
+thread-safe. Pool threads also run outside of the request's tracing
+context.
+
+Each pool accepts at most ``executor_queue_size`` pending calls; beyond
+that `ExecutorFull` is raised (a 503 response when called through the
+handler helpers) instead of queueing work the pool cannot catch up with.
+
+The pools are configured with the ``executor_threads`` (default 10),
+``executor_processes`` (default 0, no process pool) and
+``executor_queue_size`` (default 100) application settings. Requires the
+``futures`` package on Python 2; without it, the application fails at
+start up unless both pool sizes are set to 0.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import collections
+import functools
+import time
+
+from tornado.ioloop import IOLoop
+
+from durotar import metrics
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+
+_PENDING = metrics.REGISTRY.gauge(
+    'durotar_executor_pending', 'Calls queued or running in an executor.',
+    ('executor',))
+_REJECTED = metrics.REGISTRY.counter(
+    'durotar_executor_rejected_total', 'Calls rejected by a full executor.',
+    ('executor',))
+_WAIT_TIME = metrics.REGISTRY.histogram(
+    'durotar_executor_wait_seconds',
+    'Time calls waited for a pool thread or process.', ('executor',))
+
+
+class ExecutorFull(Exception):
+    """Raised when an executor already has its maximum of pending calls."""
+    pass
+
+
+class BoundedExecutor(object):
+    """A `concurrent.futures` executor with a bound on pending calls.
+
+    Bookkeeping happens on the IOLoop thread: `submit` must be called from
+    the IOLoop, and completion is reported back with ``add_callback``.
+    """
+
+    def __init__(self, name, executor, max_pending=100, io_loop=None):
+        self.name = name
+        self.executor = executor
+        self.max_pending = max_pending
+        self.io_loop = io_loop or IOLoop.current()
+        self.pending = 0
+        self._labels = (name,)
+        self._process = isinstance(executor, futures.ProcessPoolExecutor)
+        # (submit time, future) of the calls, oldest first; calls that
+        # started are dropped from the left
+        self._queued = collections.deque()
+
+    def submit(self, fn, *args, **kwargs):
+        if self.pending >= self.max_pending:
+            _REJECTED.inc(labels=self._labels)
+            raise ExecutorFull("%s executor has %d pending calls"
+                               % (self.name, self.pending))
+        self.pending += 1
+        _PENDING.set(self.pending, labels=self._labels)
+        submitted = time.time()
+        if self._process:
+            inner = self.executor.submit(_timed_call, submitted, fn,
+                                         *args, **kwargs)
+            future = futures.Future()
+            inner.add_done_callback(
+                functools.partial(self._unwrap, future))
+        else:
+            inner = future = self.executor.submit(
+                self._timed, submitted, fn, *args, **kwargs)
+        self._queued.append((submitted, inner))
+        future.add_done_callback(
+            lambda future: self.io_loop.add_callback(self._done))
+        return future
+
+    def _timed(self, submitted, fn, *args, **kwargs):
+        wait = time.time() - submitted
+        self.io_loop.add_callback(_WAIT_TIME.observe, wait, self._labels)
+        return fn(*args, **kwargs)
+
+    def _unwrap(self, future, inner):
+        # the result of `_timed_call` in a pool process
+        error = inner.exception()
+        if error is not None:
+            future.set_exception(error)
+            return
+        wait, result = inner.result()
+        self.io_loop.add_callback(_WAIT_TIME.observe, wait, self._labels)
+        future.set_result(result)
+
+    def _done(self):
+        self.pending -= 1
+        _PENDING.set(self.pending, labels=self._labels)
+        self._drop_started()
+
+    def _drop_started(self):
+        queued = self._queued
+        while queued and (queued[0][1].running() or queued[0][1].done()):
+            queued.popleft()
+
+    def queue_wait(self, now=None):
+        """Returns how long the oldest call still waiting for a pool thread
+        or process has waited, in seconds. A process pool call counts as
+        started once it is handed to the pool's call queue.
+        """
+        self._drop_started()
+        if not self._queued:
+            return 0
+        return (now or time.time()) - self._queued[0][0]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def _timed_call(submitted, fn, *args, **kwargs):
+    """Runs ``fn`` in a pool process, returning how long the call waited
+    for the process with its result.
+    """
+    return time.time() - submitted, fn(*args, **kwargs)
+
+
+def create_executors(settings, io_loop=None):
+    """Creates the executors described by the application ``settings``.
+
+    Returns a dict with a ``thread`` and optionally a ``process`` entry.
+    """
+    threads = settings.get('executor_threads', 10)
+    processes = settings.get('executor_processes', 0)
+    if not threads and not processes:
+        return {}
+    if futures is None:
+        raise RuntimeError("Executors need the futures package on Python 2; "
+                           "install it or set executor_threads to 0")
+    max_pending = settings.get('executor_queue_size', 100)
+    executors = {}
+    if threads:
+        executors['thread'] = BoundedExecutor(
+            'thread', futures.ThreadPoolExecutor(threads), max_pending,
+            io_loop=io_loop)
+    if processes:
+        executors['process'] = BoundedExecutor(
+            'process', futures.ProcessPoolExecutor(processes), max_pending,
+            io_loop=io_loop)
+    return executors
+
+
+def blocking(method):
+    """Decorates a `~durotar.web.RequestHandler` method to run in the
+    application's thread pool, returning a future.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.run_in_executor(method, self, *args, **kwargs)
+    return wrapper
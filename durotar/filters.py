@@ -17,6 +17,30 @@ import re
 SC_ON = "<!-- SCRIPT_ON -->"
 SC_OFF = "<!-- SCRIPT_OFF -->"
 
+_between_tags1 = re.compile('> +')
+_between_tags2 = re.compile(' +<')
+_spaces = re.compile('[\s]+')
+_ignore = re.compile('(' + SC_OFF + '|' + SC_ON + ')', re.S | re.I)
+
+def py_space_compress(chunk):
+    """The pure python `space_compress`, used without the C extension."""
+    res = ''
+    sc = True
+    for p in _ignore.split(chunk):
+        if p == SC_OFF:
+            sc = True
+        elif p == SC_ON:
+            sc = False
+        elif sc:
+            p = _spaces.sub(' ', p)
+            p = _between_tags1.sub('>', p)
+            p = _between_tags2.sub('<', p)
+            res += p
+        else:
+            res += p
+
+    return res
+
 try:
     from durotar.cfilters import uspace_compress
     def space_compress(chunk):
@@ -26,24 +50,4 @@ try:
             chunk = unicode(chunk)
         return uspace_compress(chunk)
 except ImportError:
-    _between_tags1 = re.compile('> +')
-    _between_tags2 = re.compile(' +<')
-    _spaces = re.compile('[\s]+')
-    _ignore = re.compile('(' + SC_OFF + '|' + SC_ON + ')', re.S | re.I)
-    def space_compress(chunk):
-        res = ''
-        sc = True
-        for p in _ignore.split(chunk):
-            if p == SC_OFF:
-                sc = True
-            elif p == SC_ON:
-                sc = False
-            elif sc:
-                p = _spaces.sub(' ', p)
-                p = _between_tags1.sub('>', p)
-                p = _between_tags2.sub('<', p)
-                res += p
-            else:
-                res += p
-
-        return res
\ No newline at end of file
+    space_compress = py_space_compress
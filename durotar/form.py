@@ -6,10 +6,124 @@
 """A mixin for validating in tornado based on formencode
 """
 import re
-import urlparse
 
 import formencode
 from formencode import validators, htmlfill
+from formencode.api import FancyValidator, NoDefault
+from formencode.schema import format_compound_error
+from tornado import escape
+
+
+_translation_loaded = False
+
+
+def _load_translation():
+    """Installs formencode's zh translation, once per process."""
+    global _translation_loaded
+    if not _translation_loaded:
+        formencode.api.set_stdtranslation(languages=['zh'])
+        _translation_loaded = True
+
+
+def _same_method(cls, name, base):
+    return getattr(cls, name).im_func is getattr(base, name).im_func
+
+
+class _ValidationPlan(object):
+    """A Form class's fields flattened for validation.
+
+    Runs the same steps as ``formencode.Schema._convert_to_python`` for a
+    schema without pre validators, partial chained validators or state,
+    but walks a precomputed list instead of re-deriving it per request.
+    A form whose fields or chained validators differ from the ones the
+    plan was built from (see `matches`) is validated by formencode.
+    """
+
+    def __init__(self, form_class):
+        self.filter_extra_fields = form_class.filter_extra_fields
+        self.ignore_key_missing = form_class.ignore_key_missing
+        self.if_key_missing = form_class.if_key_missing
+        self.chained_validators = list(form_class.chained_validators)
+        self.field_map = dict(form_class.fields)
+        self.names = frozenset(form_class.fields)
+        self.fields = []
+        for name, validator in form_class.fields.items():
+            self.fields.append((name, validator, validator.to_python,
+                                getattr(validator, 'accept_iterator', False),
+                                getattr(validator, 'if_missing', NoDefault)))
+
+    @classmethod
+    def supports(cls, form_class):
+        """Whether ``form_class`` only uses behaviour the plan reproduces."""
+        return (form_class.allow_extra_fields and
+                not form_class.pre_validators and
+                form_class.if_invalid is NoDefault and
+                form_class.if_empty is NoDefault and
+                not form_class.not_empty and
+                not any(getattr(v, 'validate_partial_form', False)
+                        for v in form_class.chained_validators) and
+                _same_method(form_class, 'to_python', FancyValidator) and
+                _same_method(form_class, '_convert_to_python',
+                             formencode.Schema) and
+                _same_method(form_class, 'is_empty', formencode.Schema) and
+                _same_method(form_class, '_validate_python',
+                             FancyValidator) and
+                _same_method(form_class, '_validate_other', FancyValidator))
+
+    def matches(self, form):
+        """Whether ``form`` still has the fields and validators the plan
+        was built from, i.e. neither the form nor its class was changed
+        with ``add_field`` and friends since.
+        """
+        return (not form.pre_validators and
+                form.fields == self.field_map and
+                form.chained_validators == self.chained_validators)
+
+    def to_python(self, form, value_dict):
+        new = {}
+        errors = {}
+        names = self.names
+        if not self.filter_extra_fields:
+            for name, value in value_dict.iteritems():
+                if name not in names:
+                    new[name] = value
+
+        for name, validator, to_python, accept_iterator, if_missing \
+                in self.fields:
+            if name in value_dict:
+                value = value_dict[name]
+                if (not accept_iterator and
+                        not isinstance(value, basestring) and
+                        form._value_is_iterator(value)):
+                    errors[name] = formencode.Invalid(form.message(
+                        'singleValueExpected', None), value_dict, None)
+                try:
+                    new[name] = to_python(value)
+                except formencode.Invalid as e:
+                    errors[name] = e
+            elif if_missing is not NoDefault:
+                new[name] = if_missing
+            elif self.ignore_key_missing:
+                continue
+            elif self.if_key_missing is NoDefault:
+                try:
+                    message = validator.message('missing', None)
+                except KeyError:
+                    message = form.message('missingValue', None)
+                errors[name] = formencode.Invalid(message, None, None)
+            else:
+                try:
+                    new[name] = to_python(self.if_key_missing)
+                except formencode.Invalid as e:
+                    errors[name] = e
+
+        if errors:
+            raise formencode.Invalid(format_compound_error(errors),
+                                     value_dict, None, error_dict=errors)
+
+        for validator in self.chained_validators:
+            new = validator.to_python(new, None)
+        return new
 
 
 class Form(formencode.Schema):
@@ -28,42 +142,81 @@ class Form(formencode.Schema):
     # return by `_after_` method
     after_result = None
 
+    # how `render` shows submitted values and errors: 'htmlfill' or
+    # 'context', None to use the ``form_fill_mode`` application setting
+    fill_mode = None
+
     _xsrf = validators.String(not_empty=True, max=54)
 
     def __init__(self, RequestHandler):
-        super(Form, self).__init__()
-        self._args = {}
+        # the per-instance copies Schema.__init__ makes, so fields added
+        # to this form don't leak into the class and later requests
+        self.fields = self.fields.copy()
+        self.chained_validators = list(self.chained_validators)
+        self.pre_validators = list(self.pre_validators)
         self._fields = {}
         self._form_errors = {}
         self._errors = {}
-        arguments = {}
 
-        formencode.api.set_stdtranslation(languages=['zh'])
+        _load_translation()
+
+        self._handler = RequestHandler
+        self._files = {}
+        self._args = self._parse_arguments(RequestHandler.request)
+        self._result = True
+
+    def _parse_arguments(self, request):
+        """Returns the submitted fields, one value per key unless the
+        field was given several times.
+
+        Tornado has already parsed urlencoded and multipart bodies into
+        ``request.body_arguments`` (keeping blank values, so formencode's
+        ``not_empty`` works); JSON bodies are decoded here. Handlers
+        streaming their body with `~durotar.streaming.StreamingBodyMixin`
+        provide the fields they parsed instead.
+        """
+        if request.method not in ('POST', 'PUT', 'PATCH'):
+            return {}
+
+        streamed = getattr(self._handler, 'streamed_body', None)
+        if streamed is not None:
+            streamed.finish()
+            self._files = streamed.files
+            return self._collapse(streamed.arguments)
 
-        # re-parse qs, keep_blank_fields for formencode to validate
-        # so formencode not_empty setting work.
-        request = RequestHandler.request
         content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            try:
+                arguments = escape.json_decode(request.body)
+            except ValueError:
+                return {}
+            return arguments if isinstance(arguments, dict) else {}
 
-        if request.method == 'POST':
-            if content_type.startswith('application/x-www-form-urlencoded'):
-                arguments = \
-                    urlparse.parse_qs(request.body, keep_blank_values=1)
+        self._files = request.files
+        return self._collapse(request.body_arguments)
 
+    @staticmethod
+    def _collapse(arguments):
+        args = {}
         for k, v in arguments.iteritems():
             if len(v) == 1:
-                self._args[k] = v[0]
+                args[k] = v[0]
             else:
                 # keep a list of values as list (or set)
-                self._args[k] = v
-
-        self._handler = RequestHandler
-        self._result = True
+                args[k] = v
+        return args
 
     @property
     def args(self):
         return self._args
 
+    @property
+    def files(self):
+        """Uploaded files of a multipart body: ``request.files``, or lists
+        of `~durotar.streaming.UploadedFile` for streamed bodies.
+        """
+        return self._files
+
     @property
     def params(self):
         return self._fields
@@ -76,10 +229,30 @@ class Form(formencode.Schema):
     def normalized_errors(self):
         return dict((k,str(self._form_errors[k])) for k in self._form_errors)
 
+    @classmethod
+    def _validation_plan(cls):
+        """Returns the class's compiled `_ValidationPlan`, or None when the
+        class needs formencode's generic validation.
+        """
+        try:
+            return cls.__dict__['_plan']
+        except KeyError:
+            plan = None
+            if _ValidationPlan.supports(cls):
+                plan = _ValidationPlan(cls)
+            cls._plan = plan
+            return plan
+
+    def _convert_args(self, value_dict):
+        plan = self._validation_plan()
+        if plan is None or not plan.matches(self):
+            return self.to_python(value_dict)
+        return plan.to_python(self, value_dict)
+
     def validate(self):
         self._result = True
         try:
-            self._fields = self.to_python(self._args)
+            self._fields = self._convert_args(self._args)
         except formencode.Invalid, e:
             self._fields = e.value
             self._form_errors = e.error_dict or {}
@@ -97,7 +270,67 @@ class Form(formencode.Schema):
         self._result = False
         self._form_errors[attr] = msg
 
+    def value(self, name, default=''):
+        """The submitted value of field ``name`` (the first one if it was
+        given several times), decoded and HTML-escaped for re-rendering.
+        """
+        value = self._args.get(name, default)
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else default
+        return self._escaped(value)
+
+    def values(self, name):
+        """All the submitted values of field ``name``, e.g. the checked
+        boxes of a group, decoded and HTML-escaped.
+        """
+        value = self._args.get(name, [])
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return [self._escaped(v) for v in value]
+
+    def error(self, name, default=''):
+        """The HTML-escaped error message of field ``name``, or
+        ``default``.
+        """
+        error = self._form_errors.get(name)
+        if error is None:
+            return self._escaped(default)
+        return self._escaped(error)
+
+    @staticmethod
+    def _escaped(value):
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        return escape.xhtml_escape(value)
+
     def render(self, template_name, **kwargs):
+        """Renders the form page and finishes the request.
+
+        With ``fill_mode = 'htmlfill'`` (the default, also settable with
+        the ``form_fill_mode`` application setting) a failed form is
+        re-filled by running htmlfill over the rendered page. With
+        ``fill_mode = 'context'`` the form is passed to the template as
+        ``form`` and the template renders values and errors itself with
+        `value` and `error`, saving a second parse of the page. Both
+        return decoded text that is already HTML-escaped, so submitted
+        input never reaches the page raw; don't add the ``h`` filter,
+        which would escape it twice::
+
+            <input name="email" value="${form.value('email')}">
+            % if form.error('email'):
+              <span class="error">${form.error('email')}</span>
+            % endif
+        """
+        fill_mode = self.fill_mode or \
+            self._handler.settings.get('form_fill_mode', 'htmlfill')
+        if fill_mode == 'context':
+            kwargs.setdefault('form', self)
+            self._handler.finish(
+                self._handler.render_string(template_name, **kwargs))
+            return
+
         html = self._handler.render_string(template_name, **kwargs)
         if not self._result:
             html = htmlfill.render(html,
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""A shared, pooled client for outbound HTTP calls.
+
+`shared_client` returns the process's `OutboundClient`, which wraps its
+own `tornado.httpclient.AsyncHTTPClient` with:
+
+* a cap on concurrent requests per host (further requests wait their
+  turn instead of filling every client slot with one slow host);
+* default connect and request timeouts;
+* retries with jittered exponential backoff for idempotent ``GET``
+  requests that fail with a connection error or a 5xx response;
+* DNS results cached for ``http_dns_ttl`` seconds;
+* request, retry and queue-wait metrics per host.
+
+Connections are only kept alive with the curl based client, which is used
+when ``pycurl`` is installed; Tornado's simple client, used otherwise,
+opens a connection per request.
+
+The client is configured from the application settings ``http_max_clients``
+(default 50), ``http_max_per_host`` (10), ``http_connect_timeout`` (5),
+``http_request_timeout`` (20), ``http_retries`` (2) and ``http_dns_ttl``
+(300); the defaults apply when the settings are not given.
+`durotar.web.Application` calls `configure` at start up. The outbound
+client uses its own `AsyncHTTPClient` instance, so the process-wide
+implementation and its configuration are left alone.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import collections
+import functools
+import random
+import socket
+import time
+
+from tornado import gen
+from tornado import stack_context
+from tornado.concurrent import TracebackFuture
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.netutil import BlockingResolver, Resolver
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+from durotar import metrics
+
+try:
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    pycurl = None
+
+try:
+    import urlparse  # py2
+except ImportError:
+    import urllib.parse as urlparse  # py3
+
+
+_REQUESTS = metrics.REGISTRY.counter(
+    'durotar_http_requests_total', 'Outbound HTTP requests by host and code.',
+    ('host', 'code'))
+_RETRIES = metrics.REGISTRY.counter(
+    'durotar_http_retries_total', 'Outbound HTTP retries by host.', ('host',))
+_QUEUE_WAIT = metrics.REGISTRY.histogram(
+    'durotar_http_queue_seconds',
+    'Time outbound requests waited for a per-host slot.', ('host',))
+_REQUEST_TIME = metrics.REGISTRY.histogram(
+    'durotar_http_request_seconds', 'Outbound HTTP request time by host.',
+    ('host',))
+
+
+class CachingResolver(Resolver):
+    """Caches the results of another resolver for ``ttl`` seconds."""
+
+    def initialize(self, resolver=None, ttl=300, io_loop=None):
+        self.resolver = resolver or BlockingResolver(io_loop=io_loop)
+        self.ttl = ttl
+        self._cache = {}
+
+    def close(self):
+        self.resolver.close()
+
+    @gen.coroutine
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        key = (host, port, family)
+        entry = self._cache.get(key)
+        if entry is not None and entry[1] > time.time():
+            metrics.CACHE_REQUESTS.inc(labels=('dns', 'hit'))
+            raise gen.Return(entry[0])
+        metrics.CACHE_REQUESTS.inc(labels=('dns', 'miss'))
+        addrinfo = yield self.resolver.resolve(host, port, family)
+        self._cache[key] = (addrinfo, time.time() + self.ttl)
+        raise gen.Return(addrinfo)
+
+
+class OutboundClient(object):
+    """Per-host limits, timeouts and retries around an `AsyncHTTPClient`."""
+
+    def __init__(self, client, max_per_host=10, connect_timeout=5,
+                 request_timeout=20, retries=2, backoff=0.1, io_loop=None):
+        self.client = client
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.io_loop = io_loop or IOLoop.current()
+        self._active = collections.defaultdict(int)
+        self._waiting = collections.defaultdict(collections.deque)
+
+    def fetch(self, request, callback=None, **kwargs):
+        """Like `AsyncHTTPClient.fetch`: returns a Future of the response
+        and, if given, calls ``callback`` with it.
+        """
+        if not isinstance(request, HTTPRequest):
+            kwargs.setdefault('connect_timeout', self.connect_timeout)
+            kwargs.setdefault('request_timeout', self.request_timeout)
+            request = HTTPRequest(url=request, **kwargs)
+        host = urlparse.urlsplit(request.url).netloc
+        future = TracebackFuture()
+        if callback is not None:
+            future.add_done_callback(
+                lambda future: callback(future.result()))
+
+        def on_slot():
+            self._attempt(host, request, future, 0)
+        if self._active[host] < self.max_per_host:
+            self._active[host] += 1
+            on_slot()
+        else:
+            # run it in this request's stack context, not in the one of
+            # the request releasing the slot
+            self._waiting[host].append(
+                (time.time(), stack_context.wrap(on_slot)))
+        return future if callback is not None else self._raising(future)
+
+    def _raising(self, future):
+        # without a callback, error responses raise like AsyncHTTPClient
+        result = TracebackFuture()
+
+        def copy(future):
+            response = future.result()
+            if response.error:
+                result.set_exception(response.error)
+            else:
+                result.set_result(response)
+        future.add_done_callback(copy)
+        return result
+
+    def _attempt(self, host, request, future, attempt):
+        start = time.time()
+
+        def on_response(response):
+            _REQUEST_TIME.observe(time.time() - start, labels=(host,))
+            _REQUESTS.inc(labels=(host, response.code))
+            if (attempt < self.retries and request.method == 'GET' and
+                    (response.code == 599 or response.code >= 500)):
+                _RETRIES.inc(labels=(host,))
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                self.io_loop.add_timeout(
+                    time.time() + delay, functools.partial(
+                        self._attempt, host, request, future, attempt + 1))
+                return
+            self._release(host)
+            future.set_result(response)
+        self.client.fetch(request, callback=on_response)
+
+    def _release(self, host):
+        waiting = self._waiting[host]
+        if waiting:
+            queued, on_slot = waiting.popleft()
+            _QUEUE_WAIT.observe(time.time() - queued, labels=(host,))
+            on_slot()
+        else:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+                del self._waiting[host]
+
+
+_settings = {}
+_shared_clients = {}
+
+
+def configure(settings):
+    """Configures the process's outbound client from application settings.
+
+    Must be called before the first `shared_client` call to take effect.
+    """
+    _settings.clear()
+    _settings.update(settings)
+
+
+def _create_client(io_loop):
+    max_clients = _settings.get('http_max_clients', 50)
+    dns_ttl = _settings.get('http_dns_ttl', 300)
+    if pycurl is not None:
+        def prepare_curl(curl):
+            curl.setopt(pycurl.DNS_CACHE_TIMEOUT, dns_ttl)
+        return CurlAsyncHTTPClient(
+            io_loop=io_loop, force_instance=True, max_clients=max_clients,
+            defaults=dict(prepare_curl_callback=prepare_curl))
+    return SimpleAsyncHTTPClient(
+        io_loop=io_loop, force_instance=True, max_clients=max_clients,
+        resolver=CachingResolver(io_loop=io_loop, ttl=dns_ttl))
+
+
+def shared_client(io_loop=None):
+    """Returns the `OutboundClient` of the current IOLoop."""
+    io_loop = io_loop or IOLoop.current()
+    client = _shared_clients.get(io_loop)
+    if client is None:
+        client = _shared_clients[io_loop] = OutboundClient(
+            _create_client(io_loop),
+            max_per_host=_settings.get('http_max_per_host', 10),
+            connect_timeout=_settings.get('http_connect_timeout', 5),
+            request_timeout=_settings.get('http_request_timeout', 20),
+            retries=_settings.get('http_retries', 2),
+            io_loop=io_loop)
+    return client
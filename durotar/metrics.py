@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Application-wide counters, gauges and histograms.
+
+Metrics live in a `Registry` and are updated in-process without locks;
+Durotar runs one IOLoop thread per process, so plain dictionary updates
+are enough. Each metric keeps one value per label tuple::
+
+    requests = metrics.REGISTRY.counter(
+        'myapp_signups_total', 'Completed signups.', ('source',))
+    requests.inc(labels=('wechat',))
+
+When the application runs in several forked workers, the master calls
+`Registry.share` before forking and each worker calls `Registry.bind`
+with its own slot number. Workers then periodically publish a snapshot
+of their metrics into their slot of an anonymous shared memory map, and
+`Registry.collect` sums the slots of every worker so any worker can
+answer a scrape for the whole server.
+
+`MetricsHandler` exposes the registry in the Prometheus text format. Set
+the ``metrics_url`` application setting to mount it.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import bisect
+import marshal
+import mmap
+import struct
+
+import tornado.web
+from tornado.ioloop import PeriodicCallback
+from tornado.log import gen_log
+
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# seqlock sequence number and payload length, written ahead of each slot
+_SLOT_HEADER = struct.Struct('<QI')
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def snapshot(self):
+        return self._values.copy()
+
+
+class Counter(_Metric):
+    """A monotonically increasing value."""
+    kind = COUNTER
+
+    def inc(self, amount=1, labels=()):
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, e.g. a queue depth."""
+    kind = GAUGE
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(_Metric):
+    """Observations counted into fixed buckets, plus their sum.
+
+    The value kept for each label tuple is a list holding one count per
+    bucket, the count of observations above the last bucket and the sum.
+    """
+    kind = HISTOGRAM
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def snapshot(self):
+        return dict((k, list(v)) for k, v in self._values.items())
+
+
+class Registry(object):
+    """A named collection of metrics, optionally aggregated across forked
+    worker processes.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._shm = None
+        self._slots = 0
+        self._slot_size = 0
+        self._slot = None
+        self._publisher = None
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError("Metric %s already registered as a %s"
+                             % (name, metric.kind))
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames,
+                              buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def share(self, slots, slot_size=256 * 1024):
+        """Allocates shared memory for ``slots`` worker processes. Must be
+        called before forking.
+        """
+        self._shm = mmap.mmap(-1, slots * slot_size)
+        self._slots = slots
+        self._slot_size = slot_size
+
+    def bind(self, slot, io_loop=None, interval=1000):
+        """Makes this process publish its metrics into ``slot`` every
+        ``interval`` milliseconds. Called in the worker after fork.
+        """
+        if self._shm is None:
+            raise RuntimeError("Registry.share() must be called before fork")
+        if not 0 <= slot < self._slots:
+            raise ValueError("Invalid metrics slot %d" % slot)
+        self._slot = slot
+        # a restarted worker starts over from zero
+        for metric in self._metrics.values():
+            metric._values.clear()
+        self.publish()
+        if self._publisher is not None:
+            self._publisher.stop()
+        self._publisher = PeriodicCallback(self.publish, interval,
+                                           io_loop=io_loop)
+        self._publisher.start()
+
+    def snapshot(self):
+        return dict((name, metric.snapshot())
+                    for name, metric in self._metrics.items())
+
+    def publish(self):
+        """Writes this process's snapshot into its shared memory slot."""
+        if self._slot is None:
+            return
+        data = marshal.dumps(self.snapshot())
+        capacity = self._slot_size - _SLOT_HEADER.size
+        if len(data) > capacity:
+            gen_log.warning(
+                "Metrics snapshot of %d bytes exceeds slot size", len(data))
+            return
+        offset = self._slot * self._slot_size
+        seq = _SLOT_HEADER.unpack_from(self._shm, offset)[0]
+        # odd sequence numbers mark a write in progress
+        _SLOT_HEADER.pack_into(self._shm, offset, seq + 1, 0)
+        start = offset + _SLOT_HEADER.size
+        self._shm[start:start + len(data)] = data
+        _SLOT_HEADER.pack_into(self._shm, offset, seq + 2, len(data))
+
+    def _read_slot(self, slot):
+        offset = slot * self._slot_size
+        start = offset + _SLOT_HEADER.size
+        for _ in range(100):
+            seq, length = _SLOT_HEADER.unpack_from(self._shm, offset)
+            if seq == 0:
+                return None
+            if seq % 2:
+                continue
+            data = self._shm[start:start + length]
+            if _SLOT_HEADER.unpack_from(self._shm, offset)[0] == seq:
+                return marshal.loads(data)
+        return None
+
+    def collect(self):
+        """Returns a snapshot summed over every worker process."""
+        if self._shm is None or self._slot is None:
+            return self.snapshot()
+        self.publish()
+        total = {}
+        for slot in range(self._slots):
+            snapshot = self._read_slot(slot)
+            if not snapshot:
+                continue
+            for name, values in snapshot.items():
+                merged = total.setdefault(name, {})
+                for labels, value in values.items():
+                    if labels not in merged:
+                        merged[labels] = value
+                    elif isinstance(value, list):
+                        merged[labels] = [a + b for a, b in
+                                          zip(merged[labels], value)]
+                    else:
+                        merged[labels] += value
+        return total
+
+    def expose(self):
+        """Formats the collected metrics in the Prometheus text format."""
+        collected = self.collect()
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            lines.append("# HELP %s %s" % (name, metric.documentation))
+            lines.append("# TYPE %s %s" % (name, metric.kind))
+            for labels, value in sorted(collected.get(name, {}).items()):
+                pairs = list(zip(metric.labelnames, labels))
+                if metric.kind != HISTOGRAM:
+                    lines.append("%s%s %s" % (name, _format_labels(pairs),
+                                              _format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (
+                        name, _format_labels(pairs + [('le', bound)]),
+                        cumulative))
+                lines.append("%s_sum%s %s" % (name, _format_labels(pairs),
+                                              _format_value(value[-1])))
+                lines.append("%s_count%s %d" % (name, _format_labels(pairs),
+                                                cumulative))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in pairs)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves the registry in the Prometheus text format.
+
+    Only answers requests from the addresses listed in the ``metrics_allow``
+    application setting (by default the loopback addresses).
+    """
+
+    def initialize(self, registry=None):
+        self.registry = registry or REGISTRY
+
+    def get(self):
+        allowed = self.settings.get('metrics_allow', ('127.0.0.1', '::1'))
+        if self.request.remote_ip not in allowed:
+            raise tornado.web.HTTPError(403)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(self.registry.expose())
+
+
+# The default registry used by Durotar itself.
+REGISTRY = Registry()
+
+# Shared by every Durotar cache, labelled with the cache name and
+# ``hit`` or ``miss``.
+CACHE_REQUESTS = REGISTRY.counter(
+    'durotar_cache_requests_total', 'Cache lookups by cache and result.',
+    ('cache', 'result'))
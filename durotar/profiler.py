@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""A sampling profiler that can be switched on in a running worker.
+
+A `Sampler` thread looks at the IOLoop thread's stack every ``interval``
+seconds with ``sys._current_frames`` and counts the stacks it sees; the
+IOLoop thread itself does no extra work, so profiling a production worker
+costs little. Each stack is tagged with the `~durotar.route.Route` name
+of the handler found on it, and the counts are output as collapsed
+stacks, the input of flame graph tools such as ``flamegraph.pl``::
+
+    $ curl 'http://127.0.0.1:8000/_profile?seconds=30' > worker.collapsed
+    $ flamegraph.pl worker.collapsed > worker.svg
+
+`ProfilerHandler` is mounted at the ``profiler_url`` application setting
+and answers the addresses of ``profiler_allow`` (by default the loopback
+addresses). ``GET`` profiles for ``seconds`` (at most
+``profiler_max_seconds``, default 300) and returns the stacks, or returns
+what was collected so far; ``POST`` with ``action`` ``start``, ``stop`` or
+``reset`` controls sampling. ``POST`` requests must pass the XSRF check
+even when the application doesn't set ``xsrf_cookies``; from a script,
+send any value as both the ``_xsrf`` cookie and the ``X-XSRFToken``
+header::
+
+    $ curl -b _xsrf=1 -H 'X-XSRFToken: 1' -d action=start \\
+        http://127.0.0.1:8000/_profile
+
+With the ``profiler_signal`` setting (e.g. ``signal.SIGUSR2``) the signal
+starts sampling and, sent again, stops it and writes the stacks to
+``profiler_output`` (by default ``/tmp/durotar-<pid>.collapsed``). The
+sampling interval is ``profiler_interval`` seconds (default 0.005).
+
+Samples taken while the IOLoop waits for events are counted apart and
+left out of the stacks.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import os
+import signal
+import sys
+import threading
+import time
+
+import tornado.web
+from tornado import gen
+from tornado.ioloop import IOLoop, PollIOLoop
+from tornado.log import gen_log
+
+try:
+    _IDLE_CODE = PollIOLoop.start.__func__.__code__  # py2
+except AttributeError:
+    _IDLE_CODE = PollIOLoop.start.__code__  # py3
+
+
+class Sampler(object):
+    """Samples the stack of thread ``thread_id`` (by default the thread
+    creating the sampler) from a background thread.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None, max_depth=100):
+        self.interval = interval
+        self.thread_id = thread_id or threading.current_thread().ident
+        self.max_depth = max_depth
+        self.samples = 0
+        self.idle_samples = 0
+        self._counts = {}
+        self._labels = {}
+        self._thread = None
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='durotar-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        self.samples = 0
+        self.idle_samples = 0
+        self._counts = {}
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.interval)
+            self.sample()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '%s (%s:%d)' % (
+                code.co_name, code.co_filename, code.co_firstlineno)
+        return label
+
+    def sample(self):
+        """Records the current stack of the sampled thread."""
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        self.samples += 1
+        if frame.f_code is _IDLE_CODE:
+            self.idle_samples += 1
+            return
+        stack = []
+        route = None
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(code)
+            if (route is None and code.co_argcount and
+                    code.co_varnames[0] == 'self'):
+                handler = frame.f_locals.get('self')
+                if isinstance(handler, tornado.web.RequestHandler):
+                    route = getattr(handler, 'route_name',
+                                    handler.__class__.__name__)
+            frame = frame.f_back
+        key = (route,) + tuple(reversed(stack))
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    def collapsed(self):
+        """Returns the stacks sampled so far in the collapsed format, one
+        ``route:<name>;frame;...;frame <count>`` line per stack.
+        """
+        lines = []
+        for key, count in sorted(self._counts.items(),
+                                 key=lambda item: -item[1]):
+            frames = ['route:%s' % (key[0] or '-')]
+            frames.extend(self._label(code) for code in key[1:])
+            lines.append('%s %d' % (';'.join(frames), count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+
+
+def install_signal(sampler, signum, path=None):
+    """Makes ``signum`` toggle ``sampler``, writing the stacks to ``path``
+    when sampling stops.
+    """
+    path = path or '/tmp/durotar-%(pid)d.collapsed'
+    io_loop = IOLoop.current()
+
+    def toggle():
+        if not sampler.running:
+            sampler.reset()
+            sampler.start()
+            gen_log.info("Profiler started")
+            return
+        sampler.stop()
+        output = path % dict(pid=os.getpid())
+        sampler.write(output)
+        gen_log.info("Profiler stopped, %d samples written to %s",
+                     sampler.samples, output)
+
+    signal.signal(signum, lambda signum, frame:
+                  io_loop.add_callback_from_signal(toggle))
+
+
+class ProfilerHandler(tornado.web.RequestHandler):
+    """Controls the application's `Sampler` and serves its stacks."""
+
+    def prepare(self):
+        allowed = self.settings.get('profiler_allow', ('127.0.0.1', '::1'))
+        if self.request.remote_ip not in allowed:
+            raise tornado.web.HTTPError(403)
+        if (self.request.method == 'POST' and
+                not self.settings.get('xsrf_cookies')):
+            # a page open in a browser on an allowed host could post here
+            self.check_xsrf_cookie()
+
+    @gen.coroutine
+    def get(self):
+        sampler = self.application.profiler
+        try:
+            seconds = float(self.get_argument('seconds', 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "seconds must be a number")
+        seconds = min(seconds, self.settings.get('profiler_max_seconds', 300))
+        if seconds > 0:
+            if sampler.running:
+                raise tornado.web.HTTPError(409, "Profiler already running")
+            sampler.reset()
+            sampler.start()
+            try:
+                yield gen.Task(IOLoop.current().add_timeout,
+                               time.time() + seconds)
+            finally:
+                sampler.stop()
+        self.set_header('Content-Type', 'text/plain')
+        self.set_header('X-Profiler-Samples', sampler.samples)
+        self.set_header('X-Profiler-Idle-Samples', sampler.idle_samples)
+        self.finish(sampler.collapsed())
+
+    def post(self):
+        sampler = self.application.profiler
+        action = self.get_argument('action')
+        if action == 'start':
+            sampler.start()
+        elif action == 'stop':
+            sampler.stop()
+        elif action == 'reset':
+            sampler.reset()
+        else:
+            raise tornado.web.HTTPError(400, "Unknown action %s" % action)
+        self.finish(dict(running=sampler.running, samples=sampler.samples))
@@ -41,6 +41,10 @@ class Route(object):
         spec = tornado.web.url(self.pattern, handler_class,
                                    self.kwargs, name=name)
         self._routes.setdefault(self.host, []).append(spec)
+        # remember the first name a handler was routed under, so that
+        # per-route tracing and metrics can label requests with it
+        if '_route_name' not in handler_class.__dict__:
+            handler_class._route_name = name
 
         return handler_class
 
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""The ``durotar`` command: a supervised, multi-process HTTP server.
+
+The master process binds the listening sockets once, then forks worker
+processes which load the settings module and build the `Application`.
+Everything that holds connections (the database, executors, ...) is
+therefore created after fork, in the worker that uses it. Typical usage::
+
+    $ durotar --settings=myproject.settings --port=8000 --workers=4
+
+The settings module is an ordinary python module; every public module
+attribute is passed to the application as a setting.
+
+Workers that die are restarted. Sending ``SIGHUP`` to the master starts
+a fresh generation of workers (which re-import the application code) and
+then asks the old generation to finish their in-flight requests and exit,
+so no connection is dropped. ``SIGTERM`` or ``SIGINT`` shut the server
+down the same way.
+
+With ``--task_workers=N`` the master also forks N task worker processes
+running the `durotar.tasks` queue of the application (restricted to the
+queues given with ``--task_queues``); they are restarted and reloaded
+like HTTP workers and finish the running batch when stopped.
+
+With ``--reuse_port`` each worker binds its own ``SO_REUSEPORT`` socket
+and the kernel balances connections between them instead of sharing one
+accept queue.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import errno
+import os
+import signal
+import socket
+import sys
+import time
+import types
+
+import tornado.options
+from tornado import netutil
+from tornado import process
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.log import gen_log
+from tornado.options import define, options
+
+from durotar import metrics
+from durotar.util import import_module, load_class
+
+
+define("settings", type=str, help="dotted path of the settings module")
+define("application", type=str, default="durotar.web.Application",
+       help="dotted path of the application class")
+define("port", type=int, default=8000, help="port to listen on")
+define("address", type=str, default="", help="address to listen on")
+define("workers", type=int, default=0,
+       help="number of worker processes, 0 for one per CPU")
+define("reuse_port", type=bool, default=False,
+       help="bind one SO_REUSEPORT socket per worker")
+define("backlog", type=int, default=128, help="listen backlog")
+define("xheaders", type=bool, default=False,
+       help="trust X-Real-Ip and X-Scheme headers from a proxy")
+define("graceful_timeout", type=float, default=30,
+       help="seconds a stopping worker waits for open connections")
+define("task_workers", type=int, default=0,
+       help="number of task worker processes")
+define("task_queues", type=str, multiple=True,
+       help="queues run by task workers, default the task_queues setting")
+
+
+# callbacks run in every worker process after fork, before the
+# application is built, as ``callback(server, slot)``
+_worker_init_callbacks = []
+
+
+def on_worker_init(callback):
+    """Registers ``callback`` to run in each worker right after fork."""
+    _worker_init_callbacks.append(callback)
+    return callback
+
+
+def load_settings(path):
+    """Returns the public attributes of the settings module at ``path``."""
+    if not path:
+        return {}
+    module = import_module(path)
+    return dict((name, value) for name, value in vars(module).items()
+                if not name.startswith('_') and
+                not isinstance(value, types.ModuleType))
+
+
+def bind_reuseport_sockets(port, address=None, backlog=128):
+    """Like `tornado.netutil.bind_sockets` but sets ``SO_REUSEPORT`` so
+    that every worker can bind the same port.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+    sockets = []
+    for res in set(socket.getaddrinfo(address or None, port, socket.AF_UNSPEC,
+                                      socket.SOCK_STREAM, 0,
+                                      socket.AI_PASSIVE)):
+        af, socktype, proto, canonname, sockaddr = res
+        sock = socket.socket(af, socktype, proto)
+        netutil.set_close_exec(sock.fileno())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
+class Server(object):
+    """Forks and supervises the worker processes."""
+
+    # a worker exiting this soon after start is considered crashing
+    min_worker_lifetime = 1.0
+
+    def __init__(self, settings_path=None, application=None, port=8000,
+                 address="", workers=0, reuse_port=False, backlog=128,
+                 xheaders=False, graceful_timeout=30, task_workers=0,
+                 task_queues=None):
+        self.settings_path = settings_path
+        self.application = application or "durotar.web.Application"
+        self.port = port
+        self.address = address
+        self.workers = workers or process.cpu_count()
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.xheaders = xheaders
+        self.graceful_timeout = graceful_timeout
+        self.task_workers = task_workers
+        self.task_queues = task_queues
+        self.sockets = None
+        self.slot = None
+        self.http_server = None
+        self.task_worker = None
+        self._children = {}  # pid -> (slot, start time)
+        self._retiring = set()
+        self._generation = 0
+        self._reload = False
+        self._stopping = False
+
+    # master
+
+    def run(self):
+        """Binds, forks the workers and supervises them until stopped."""
+        if not self.reuse_port:
+            self.sockets = netutil.bind_sockets(self.port, self.address,
+                                                backlog=self.backlog)
+        if self.workers == 1 and not self.task_workers:
+            return self._run_worker(None)
+
+        # two generations may overlap during a reload
+        metrics.REGISTRY.share((self.workers + self.task_workers) * 2)
+
+        signal.signal(signal.SIGHUP, self._on_master_signal)
+        signal.signal(signal.SIGTERM, self._on_master_signal)
+        signal.signal(signal.SIGINT, self._on_master_signal)
+
+        gen_log.info("Starting %d workers on %s:%d and %d task workers",
+                     self.workers, self.address or "*", self.port,
+                     self.task_workers)
+        self._spawn_generation()
+        self._supervise()
+
+    def _on_master_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stopping = True
+
+    def _slots(self):
+        base = (self._generation % 2) * self.workers
+        slots = list(range(base, base + self.workers))
+        # task workers take the slots after both HTTP generations
+        base = 2 * self.workers + (self._generation % 2) * self.task_workers
+        return slots + list(range(base, base + self.task_workers))
+
+    def _is_task_slot(self, slot):
+        return slot is not None and slot >= 2 * self.workers
+
+    def _spawn_generation(self):
+        for slot in self._slots():
+            self._spawn(slot)
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            process._reseed_random()
+            try:
+                if self._is_task_slot(slot):
+                    self._run_task_worker(slot)
+                else:
+                    self._run_worker(slot)
+            except Exception:
+                gen_log.error("Worker %d failed", slot, exc_info=True)
+                os._exit(1)
+            os._exit(0)
+        self._children[pid] = (slot, time.time())
+        return pid
+
+    def _retire(self, pids):
+        for pid in pids:
+            self._retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _supervise(self):
+        while self._children:
+            if self._reload:
+                self._reload = False
+                if not self._stopping:
+                    gen_log.info("Reloading workers")
+                    old = list(pid for pid in self._children
+                               if pid not in self._retiring)
+                    self._generation += 1
+                    self._spawn_generation()
+                    self._retire(old)
+            if self._stopping:
+                self._retire(pid for pid in self._children
+                             if pid not in self._retiring)
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in self._children:
+                continue
+            slot, started = self._children.pop(pid)
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                continue
+            if os.WIFSIGNALED(status):
+                gen_log.warning("Worker %d (pid %d) killed by signal %d",
+                                slot, pid, os.WTERMSIG(status))
+            else:
+                gen_log.warning("Worker %d (pid %d) exited with status %d",
+                                slot, pid, os.WEXITSTATUS(status))
+            if self._stopping:
+                continue
+            if time.time() - started < self.min_worker_lifetime:
+                # don't spin when the application fails at start up
+                time.sleep(self.min_worker_lifetime)
+            self._spawn(slot)
+        gen_log.info("All workers stopped")
+
+    # worker
+
+    def _build_application(self, slot):
+        self.slot = slot
+        for callback in _worker_init_callbacks:
+            callback(self, slot)
+
+        settings = load_settings(self.settings_path)
+        application_class = load_class(settings.pop('application',
+                                                    self.application))
+        return application_class(**settings)
+
+    def _run_worker(self, slot):
+        io_loop = IOLoop.instance()
+        app = self._build_application(slot)
+
+        sockets = self.sockets
+        if sockets is None:
+            sockets = bind_reuseport_sockets(self.port, self.address,
+                                             self.backlog)
+        self.http_server = HTTPServer(app, xheaders=self.xheaders)
+        self.http_server.add_sockets(sockets)
+
+        if slot is not None:
+            metrics.REGISTRY.bind(slot, io_loop=io_loop)
+        signal.signal(signal.SIGTERM, self._on_worker_signal)
+        signal.signal(signal.SIGINT, self._on_worker_signal)
+        io_loop.start()
+
+    def _run_task_worker(self, slot):
+        io_loop = IOLoop.instance()
+        app = self._build_application(slot)
+        from durotar import tasks
+        self.task_worker = tasks.create_worker(app, queues=self.task_queues,
+                                               io_loop=io_loop)
+        self.task_worker.start()
+
+        metrics.REGISTRY.bind(slot, io_loop=io_loop)
+        signal.signal(signal.SIGTERM, self._on_worker_signal)
+        signal.signal(signal.SIGINT, self._on_worker_signal)
+        io_loop.start()
+
+    def _on_worker_signal(self, signum, frame):
+        IOLoop.instance().add_callback_from_signal(self._stop_worker)
+
+    def _stop_worker(self):
+        """Stops accepting and exits once open connections are done."""
+        deadline = time.time() + self.graceful_timeout
+        io_loop = IOLoop.instance()
+        if self.task_worker is not None:
+            self.task_worker.stop().add_done_callback(
+                lambda future: io_loop.stop())
+            io_loop.add_timeout(deadline, io_loop.stop)
+            return
+        self.http_server.stop()
+
+        def wait_for_connections():
+            if (getattr(self.http_server, '_connections', None) and
+                    time.time() < deadline):
+                io_loop.add_timeout(time.time() + 0.1, wait_for_connections)
+                return
+            if hasattr(self.http_server, 'close_all_connections'):
+                self.http_server.close_all_connections()
+            io_loop.stop()
+        wait_for_connections()
+
+
+def main():
+    """Entry point of the ``durotar`` command."""
+    tornado.options.parse_command_line()
+    if options.settings:
+        sys.path.insert(0, os.getcwd())
+    Server(settings_path=options.settings,
+           application=options.application,
+           port=options.port,
+           address=options.address,
+           workers=options.workers,
+           reuse_port=options.reuse_port,
+           backlog=options.backlog,
+           xheaders=options.xheaders,
+           graceful_timeout=options.graceful_timeout,
+           task_workers=options.task_workers,
+           task_queues=options.task_queues or None).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Server-side sessions behind a compact signed session ID cookie.
+
+Instead of keeping tokens and profile data in secure cookies, handlers
+keep them in ``self.session``, a dict stored server side under a random
+ID; only the signed ID travels in the cookie::
+
+    class LoginHandler(durotar.auth.WechatMpMixin, durotar.web.RequestHandler):
+        @tornado.gen.coroutine
+        def get(self):
+            user = yield self.get_authenticated_user(...)
+            self.session.regenerate()
+            self.session['user'] = user
+            self.redirect('/')
+
+The session is loaded the first time ``self.session`` (or
+``current_user``, which reads ``session['user']`` by default) is used,
+and written back when the request finishes only if it was modified.
+Changes inside nested values are not noticed; set ``session.modified``
+after making them.
+
+Sessions are enabled with the ``session_store`` application setting:
+``'memory'``, ``'sqlite'`` (a file named by ``session_sqlite_path``),
+``'postgres'`` (the application's ``db``), the dotted path of a
+`SessionStore` subclass or an instance. Stores shared by several workers
+are fronted by a per-worker `CachedSessionStore` of
+``session_cache_size`` entries (default 10000) kept for
+``session_cache_ttl`` seconds (default 60); with the PostgreSQL store,
+workers also drop sessions from their cache as soon as another worker
+changes them, through `durotar.tornpg.Connection.listen`. The cookie is
+named by ``session_cookie`` (default ``'sid'``) and sessions expire
+after ``session_expires_days`` days (default 30) without being modified.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import binascii
+import collections
+import json
+import os
+import sqlite3
+import time
+
+from tornado.escape import native_str
+
+from durotar import metrics
+from durotar.util import load_class
+
+try:
+    basestring  # py2
+except NameError:
+    basestring = str  # py3
+
+
+def generate_id():
+    """Returns a new random session ID."""
+    return native_str(binascii.hexlify(os.urandom(16)))
+
+
+class Session(dict):
+    """The data of one session, tracking whether it was modified."""
+
+    def __init__(self, sid=None, data=None):
+        dict.__init__(self, data or ())
+        self.sid = sid
+        self.modified = False
+        self.discarded_sid = None
+
+    def regenerate(self):
+        """Moves the session to a new ID, e.g. after a login, so an ID
+        known before cannot be used to ride the new session.
+        """
+        if self.sid is not None:
+            self.discarded_sid = self.sid
+            self.sid = None
+        self.modified = True
+
+    def _modifies(name):
+        method = getattr(dict, name)
+
+        def wrapper(self, *args, **kwargs):
+            self.modified = True
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = name
+        return wrapper
+
+    __setitem__ = _modifies('__setitem__')
+    __delitem__ = _modifies('__delitem__')
+    clear = _modifies('clear')
+    pop = _modifies('pop')
+    popitem = _modifies('popitem')
+    setdefault = _modifies('setdefault')
+    update = _modifies('update')
+    del _modifies
+
+
+class SessionStore(object):
+    """Keeps session data, a JSON serializable dict, by session ID."""
+
+    # the tornpg notification channel changed session IDs are sent on,
+    # if the store sends them
+    channel = None
+
+    def load(self, sid):
+        """Returns the data of session ``sid``, or None."""
+        raise NotImplementedError()
+
+    def save(self, sid, data, expires_in):
+        raise NotImplementedError()
+
+    def delete(self, sid):
+        raise NotImplementedError()
+
+    def purge(self):
+        """Removes expired sessions."""
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """A per-process `SessionStore` holding at most ``max_size``
+    sessions, dropping the least recently used first.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._sessions = collections.OrderedDict()
+
+    def load(self, sid):
+        entry = self._sessions.pop(sid, None)
+        if entry is None or entry[1] < time.time():
+            return None
+        self._sessions[sid] = entry
+        return entry[0]
+
+    def save(self, sid, data, expires_in):
+        self._sessions.pop(sid, None)
+        self._sessions[sid] = (data, time.time() + expires_in)
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+
+    def delete(self, sid):
+        self._sessions.pop(sid, None)
+
+    def purge(self):
+        now = time.time()
+        for sid in [sid for sid, (data, expires_at)
+                    in self._sessions.items() if expires_at < now]:
+            del self._sessions[sid]
+
+
+class CachedSessionStore(SessionStore):
+    """A per-worker read-through cache in front of a shared ``store``.
+
+    Sessions read are kept for ``ttl`` seconds, so a session changed by
+    another worker may be seen stale for that long; writes go through to
+    ``store`` immediately.
+    """
+
+    def __init__(self, store, max_size=10000, ttl=60):
+        self.store = store
+        self.ttl = ttl
+        self._cache = MemorySessionStore(max_size)
+
+    def load(self, sid):
+        data = self._cache.load(sid)
+        if data is not None:
+            metrics.CACHE_REQUESTS.inc(labels=('session', 'hit'))
+            return data
+        metrics.CACHE_REQUESTS.inc(labels=('session', 'miss'))
+        data = self.store.load(sid)
+        if data is not None:
+            self._cache.save(sid, data, self.ttl)
+        return data
+
+    def save(self, sid, data, expires_in):
+        self.store.save(sid, data, expires_in)
+        self._cache.save(sid, data, min(self.ttl, expires_in))
+
+    def delete(self, sid):
+        self._cache.delete(sid)
+        self.store.delete(sid)
+
+    def invalidate(self, sid):
+        """Drops ``sid`` from the cache only, or every session if ``sid``
+        is None.
+        """
+        if sid is None:
+            self._cache = MemorySessionStore(self._cache.max_size)
+        else:
+            self._cache.delete(sid)
+
+    def purge(self):
+        self._cache.purge()
+        self.store.purge()
+
+
+class SQLiteSessionStore(SessionStore):
+    """Keeps sessions in an SQLite database file, which all workers on
+    one machine can share.
+    """
+
+    def __init__(self, path, table='durotar_sessions'):
+        self.path = path
+        self.table = table
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, "
+            "data TEXT NOT NULL, expires_at REAL NOT NULL)" % table)
+
+    def load(self, sid):
+        row = self._db.execute(
+            "SELECT data FROM %s WHERE id = ? AND expires_at > ?"
+            % self.table, (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(self, sid, data, expires_in):
+        self._db.execute(
+            "INSERT OR REPLACE INTO %s (id, data, expires_at) "
+            "VALUES (?, ?, ?)" % self.table,
+            (sid, json.dumps(data), time.time() + expires_in))
+
+    def delete(self, sid):
+        self._db.execute("DELETE FROM %s WHERE id = ?" % self.table, (sid,))
+
+    def purge(self):
+        self._db.execute("DELETE FROM %s WHERE expires_at <= ?" % self.table,
+                         (time.time(),))
+
+
+class PostgresSessionStore(SessionStore):
+    """Keeps sessions in PostgreSQL through a `durotar.tornpg.Connection`,
+    in a table created by `create_table`. Changed session IDs are sent
+    on the ``durotar_sessions`` channel.
+    """
+
+    channel = 'durotar_sessions'
+
+    def __init__(self, db, table='durotar_sessions'):
+        if db is None:
+            raise RuntimeError("PostgresSessionStore needs the db_config "
+                               "setting")
+        self.db = db
+        self.table = table
+
+    def create_table(self):
+        with self.db.transaction():
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS %s (id text PRIMARY KEY, "
+                "data text NOT NULL, expires_at timestamp NOT NULL)"
+                % self.table)
+
+    def load(self, sid):
+        row = self.db.get(
+            "SELECT data FROM %s WHERE id = %%s AND expires_at > now()"
+            % self.table, sid)
+        if row is None:
+            return None
+        return json.loads(row.data)
+
+    def save(self, sid, data, expires_in):
+        data = json.dumps(data)
+        expires = "now() + interval '%d seconds'" % expires_in
+        with self.db.transaction():
+            if not self.db.execute_rowcount(
+                    "UPDATE %s SET data = %%s, expires_at = %s WHERE id = %%s"
+                    % (self.table, expires), data, sid):
+                self.db.execute(
+                    "INSERT INTO %s (id, data, expires_at) "
+                    "VALUES (%%s, %%s, %s)" % (self.table, expires),
+                    sid, data)
+            self.db.notify(self.channel, sid)
+
+    def delete(self, sid):
+        with self.db.transaction():
+            self.db.execute("DELETE FROM %s WHERE id = %%s" % self.table,
+                            sid)
+            self.db.notify(self.channel, sid)
+
+    def purge(self):
+        with self.db.transaction():
+            self.db.execute("DELETE FROM %s WHERE expires_at <= now()"
+                            % self.table)
+
+
+def create_store(settings, db=None):
+    """Creates the `SessionStore` described by the application
+    ``settings``, or returns None if sessions are disabled.
+    """
+    store = settings.get('session_store')
+    if store is None:
+        return None
+    if isinstance(store, basestring):
+        if store == 'memory':
+            store = MemorySessionStore()
+        elif store == 'sqlite':
+            store = SQLiteSessionStore(
+                settings.get('session_sqlite_path', 'sessions.db'))
+        elif store == 'postgres':
+            store = PostgresSessionStore(db)
+        else:
+            store = load_class(store)()
+    cache_size = settings.get('session_cache_size', 10000)
+    if cache_size and not isinstance(store, MemorySessionStore):
+        cache = CachedSessionStore(store, cache_size,
+                                   settings.get('session_cache_ttl', 60))
+        if store.channel is not None:
+            store.db.listen(store.channel, cache.invalidate)
+        store = cache
+    return store
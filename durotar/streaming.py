@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Incremental parsing of large form posts and uploads.
+
+Tornado normally buffers the whole request body before a handler runs.
+Handlers decorated with `tornado.web.stream_request_body` and using
+`StreamingBodyMixin` instead parse urlencoded and multipart bodies as
+chunks arrive: plain fields are collected (up to
+``stream_max_fields_size`` bytes in total) and file parts are written to
+temporary files which move from memory to disk past
+``stream_spool_size`` bytes. `durotar.form.Form` reads the parsed fields
+like it reads a buffered body::
+
+    @tornado.web.stream_request_body
+    class UploadHandler(StreamingBodyMixin, durotar.web.RequestHandler):
+        def post(self):
+            form = UploadForm(self)
+            if form.validate():
+                upload = form.files['photo'][0]
+                save(upload.file)
+            ...
+
+Other content types are spooled to ``streamed_body.body_file``. The
+``stream_max_body_size`` setting overrides the server's body size limit
+for these handlers. Handlers overriding ``prepare`` must call the
+mixin's ``prepare``.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import tempfile
+
+import tornado.web
+from tornado import httputil
+from tornado.escape import native_str, utf8
+
+try:
+    import urlparse  # py2
+except ImportError:
+    import urllib.parse as urlparse  # py3
+
+
+class UploadedFile(object):
+    """A file part of a streamed multipart body."""
+
+    def __init__(self, filename, content_type, file):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+class _UrlencodedParser(object):
+    def __init__(self, body):
+        self.body = body
+        self._buffer = b''
+
+    def feed(self, chunk):
+        data = self._buffer + chunk
+        end = data.rfind(b'&')
+        if end == -1:
+            self._buffer = data
+        else:
+            self._buffer = data[end + 1:]
+            self._parse(data[:end])
+        self.body.check_fields_size(len(self._buffer))
+
+    def finish(self):
+        self._parse(self._buffer)
+        self._buffer = b''
+
+    def _parse(self, data):
+        for name, value in urlparse.parse_qsl(native_str(data),
+                                              keep_blank_values=True):
+            self.body.add_argument(name, value)
+
+
+class _MultipartParser(object):
+    _PREAMBLE, _HEADERS, _BODY, _BOUNDARY, _END = range(5)
+
+    max_headers_size = 16 * 1024
+    # the rest of a delimiter line: "--" or transport padding and CRLF
+    max_boundary_line_size = 1024
+
+    def __init__(self, body, boundary):
+        self.body = body
+        self._delimiter = b'\r\n--' + boundary
+        # treat the first boundary like the following ones
+        self._buffer = b'\r\n'
+        self._state = self._PREAMBLE
+        self._part = None
+        self._name = None
+        self._value = None
+        self._value_size = 0
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        while self._step():
+            pass
+
+    def finish(self):
+        if self._state != self._END:
+            raise tornado.web.HTTPError(400, "Truncated multipart body")
+
+    def _step(self):
+        if self._state in (self._PREAMBLE, self._BODY):
+            index = self._buffer.find(self._delimiter)
+            if index == -1:
+                # keep what could be the start of a delimiter
+                keep = len(self._delimiter) - 1
+                if len(self._buffer) > keep:
+                    self._write(self._buffer[:-keep])
+                    self._buffer = self._buffer[-keep:]
+                return False
+            self._write(self._buffer[:index])
+            self._end_part()
+            self._buffer = self._buffer[index + len(self._delimiter):]
+            self._state = self._BOUNDARY
+            return True
+
+        if self._state == self._BOUNDARY:
+            if len(self._buffer) < 2:
+                return False
+            if self._buffer.startswith(b'--'):
+                self._state = self._END
+                self._buffer = b''
+                return False
+            eol = self._buffer.find(b'\r\n')
+            if eol == -1:
+                if len(self._buffer) > self.max_boundary_line_size:
+                    raise tornado.web.HTTPError(
+                        400, "Invalid multipart boundary line")
+                return False
+            self._buffer = self._buffer[eol + 2:]
+            self._state = self._HEADERS
+            return True
+
+        if self._state == self._HEADERS:
+            eoh = self._buffer.find(b'\r\n\r\n')
+            if eoh == -1:
+                if len(self._buffer) > self.max_headers_size:
+                    raise tornado.web.HTTPError(
+                        400, "Multipart headers too large")
+                return False
+            self._start_part(self._buffer[:eoh])
+            self._buffer = self._buffer[eoh + 4:]
+            self._state = self._BODY
+            return True
+
+        # _END: ignore the epilogue
+        self._buffer = b''
+        return False
+
+    def _start_part(self, header_data):
+        headers = httputil.HTTPHeaders.parse(header_data.decode('utf-8'))
+        disposition, params = httputil._parse_header(
+            headers.get('Content-Disposition', ''))
+        if disposition != 'form-data' or not params.get('name'):
+            raise tornado.web.HTTPError(400, "Invalid multipart/form-data")
+        self._name = params['name']
+        if params.get('filename'):
+            self._part = self.body.open_file(
+                self._name, params['filename'],
+                headers.get('Content-Type', 'application/unknown'))
+        else:
+            self._value = []
+            self._value_size = 0
+
+    def _write(self, data):
+        if not data or self._state == self._PREAMBLE:
+            return
+        if self._part is not None:
+            self._part.write(data)
+        else:
+            self._value_size += len(data)
+            self.body.check_fields_size(self._value_size)
+            self._value.append(data)
+
+    def _end_part(self):
+        if self._state != self._BODY:
+            return
+        if self._part is not None:
+            self._part.file.seek(0)
+            self._part = None
+        else:
+            self.body.add_argument(self._name, b''.join(self._value))
+            self._value = None
+
+
+class _SpoolParser(object):
+    def __init__(self, body):
+        self.body = body
+
+    def feed(self, chunk):
+        self.body.body_file.write(chunk)
+
+    def finish(self):
+        self.body.body_file.seek(0)
+
+
+class StreamedBody(object):
+    """The incrementally parsed body of one request.
+
+    ``arguments`` maps field names to lists of byte string values like
+    ``request.body_arguments``; ``files`` maps field names to lists of
+    `UploadedFile`.
+    """
+
+    def __init__(self, content_type, max_fields_size=1024 * 1024,
+                 spool_size=1024 * 1024, temp_dir=None):
+        self.arguments = {}
+        self.files = {}
+        self.body_file = None
+        self.max_fields_size = max_fields_size
+        self.spool_size = spool_size
+        self.temp_dir = temp_dir
+        self.error = None
+        self._fields_size = 0
+        self._finished = False
+
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            self._parser = _UrlencodedParser(self)
+        elif content_type.startswith('multipart/form-data'):
+            boundary = None
+            for field in content_type.split(';'):
+                k, sep, v = field.strip().partition('=')
+                if k == 'boundary' and v:
+                    boundary = utf8(v.strip('"'))
+            if boundary is None:
+                raise tornado.web.HTTPError(400, "Missing multipart boundary")
+            self._parser = _MultipartParser(self, boundary)
+        else:
+            self.body_file = self._spool()
+            self._parser = _SpoolParser(self)
+
+    def _spool(self):
+        return tempfile.SpooledTemporaryFile(max_size=self.spool_size,
+                                             dir=self.temp_dir)
+
+    def feed(self, chunk):
+        """Parses the next chunk of the body. Errors are kept until
+        `finish` so the handler can still send a response.
+        """
+        if self.error is not None:
+            return
+        try:
+            self._parser.feed(chunk)
+        except tornado.web.HTTPError as e:
+            self.error = e
+
+    def finish(self):
+        """Completes parsing once the whole body was fed. Raises
+        `tornado.web.HTTPError` if the body was invalid or too large.
+        """
+        if not self._finished:
+            self._finished = True
+            if self.error is None:
+                try:
+                    self._parser.finish()
+                except tornado.web.HTTPError as e:
+                    self.error = e
+        if self.error is not None:
+            raise self.error
+
+    def check_fields_size(self, size):
+        if self._fields_size + size > self.max_fields_size:
+            raise tornado.web.HTTPError(413, "Form fields too large")
+
+    def add_argument(self, name, value):
+        self.check_fields_size(len(value))
+        self._fields_size += len(value)
+        self.arguments.setdefault(name, []).append(value)
+
+    def open_file(self, name, filename, content_type):
+        upload = UploadedFile(filename, content_type, self._spool())
+        self.files.setdefault(name, []).append(upload)
+        return upload
+
+    def close(self):
+        """Releases the temporary files."""
+        for uploads in self.files.values():
+            for upload in uploads:
+                upload.close()
+        if self.body_file is not None:
+            self.body_file.close()
+
+
+class StreamingBodyMixin(object):
+    """Parses the request body of a `tornado.web.stream_request_body`
+    handler into ``self.streamed_body`` as it arrives.
+    """
+
+    streamed_body = None
+
+    def prepare(self):
+        super(StreamingBodyMixin, self).prepare()
+        settings = self.settings
+        if 'stream_max_body_size' in settings:
+            self.request.connection.set_max_body_size(
+                settings['stream_max_body_size'])
+        self.streamed_body = StreamedBody(
+            self.request.headers.get('Content-Type', ''),
+            max_fields_size=settings.get('stream_max_fields_size',
+                                         1024 * 1024),
+            spool_size=settings.get('stream_spool_size', 1024 * 1024),
+            temp_dir=settings.get('stream_temp_dir'))
+
+    def data_received(self, chunk):
+        self.streamed_body.feed(chunk)
+
+    def on_finish(self):
+        super(StreamingBodyMixin, self).on_finish()
+        if self.streamed_body is not None:
+            self.streamed_body.close()
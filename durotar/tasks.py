@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""A background task queue kept in PostgreSQL.
+
+Follow-up work that the client doesn't wait for (sending Wechat
+messages, updating statistics) is declared as a task and enqueued from
+the handler; task worker processes run it afterwards::
+
+    @durotar.tasks.task(max_attempts=3)
+    def send_welcome(openid):
+        ...
+
+    class SignupHandler(durotar.web.RequestHandler):
+        def post(self):
+            ...
+            self.enqueue(send_welcome, args=(openid,))
+
+Tasks are rows of the ``durotar_tasks`` table (see `create_table`).
+Enqueueing inserts a row and sends a ``NOTIFY``; each worker listens for
+it with `durotar.tornpg.Connection.listen` and claims due tasks in
+batches with ``SELECT ... FOR UPDATE SKIP LOCKED`` (PostgreSQL 9.5 or
+later), so workers never wait on each other. A claimed task is hidden
+for ``lock_timeout`` seconds; if its worker dies it becomes due again.
+The lock is renewed when the worker starts running the task, and a task
+that another worker claimed again in the meantime (its batch outlived
+the lock) is skipped rather than run twice. A task that succeeded is
+deleted right away, before the next task of its batch runs.
+Failed tasks are retried with exponential backoff until
+``max_attempts``, then kept with ``failed_at`` set for inspection.
+
+Task workers are started by the ``durotar`` command with
+``--task_workers=N``. They build the application like HTTP workers, so
+tasks defined in the handler modules of installed ``apps`` (or in the
+``task_modules`` setting) are registered, and use its ``db``. A task
+may return a Future, which the worker waits for.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import functools
+import json
+import time
+
+from tornado import gen
+from tornado.concurrent import TracebackFuture
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.log import app_log
+
+from durotar import metrics
+from durotar.util import import_module
+
+
+CHANNEL = 'durotar_tasks'
+
+_ENQUEUED = metrics.REGISTRY.counter(
+    'durotar_tasks_enqueued_total', 'Tasks enqueued by task name.',
+    ('task',))
+_PROCESSED = metrics.REGISTRY.counter(
+    'durotar_tasks_processed_total',
+    'Tasks run by task name and result (ok, retry, failed).',
+    ('task', 'result'))
+_TASK_TIME = metrics.REGISTRY.histogram(
+    'durotar_task_seconds', 'Task run time by task name.', ('task',))
+_BATCH_SIZE = metrics.REGISTRY.histogram(
+    'durotar_task_batch_size', 'Tasks claimed per batch.',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+
+class Task(object):
+    """A function registered to run in task workers."""
+
+    def __init__(self, fn, name, queue='default', max_attempts=5,
+                 backoff=10, max_backoff=3600):
+        self.fn = fn
+        self.name = name
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        functools.update_wrapper(self, fn)
+
+    def __call__(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+    def retry_delay(self, attempts):
+        """Seconds to wait before running again after ``attempts``."""
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+
+
+# registered tasks, by name
+_tasks = {}
+
+
+def task(name=None, queue='default', max_attempts=5, backoff=10,
+         max_backoff=3600):
+    """Decorates a function as a `Task` named ``name`` (by default its
+    module and function name).
+    """
+    def decorator(fn):
+        t = Task(fn, name or '%s.%s' % (fn.__module__, fn.__name__),
+                 queue=queue, max_attempts=max_attempts, backoff=backoff,
+                 max_backoff=max_backoff)
+        _tasks[t.name] = t
+        return t
+    return decorator
+
+
+def create_table(db, table='durotar_tasks'):
+    """Creates the task table through the `durotar.tornpg.Connection`
+    ``db``.
+    """
+    with db.transaction():
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS %(table)s (
+                id bigserial PRIMARY KEY,
+                queue text NOT NULL,
+                name text NOT NULL,
+                args text NOT NULL,
+                attempts integer NOT NULL DEFAULT 0,
+                run_at timestamp NOT NULL DEFAULT now(),
+                failed_at timestamp,
+                last_error text,
+                created_at timestamp NOT NULL DEFAULT now()
+            )""" % dict(table=table))
+        db.execute("CREATE INDEX IF NOT EXISTS %(table)s_due ON %(table)s "
+                   "(queue, run_at) WHERE failed_at IS NULL"
+                   % dict(table=table))
+
+
+def enqueue_many(db, task, arg_list, delay=0, queue=None,
+                 table='durotar_tasks'):
+    """Enqueues one run of ``task`` per ``(args, kwargs)`` pair of
+    ``arg_list`` with a single statement and notification.
+
+    Inside a `~durotar.tornpg.Connection.transaction`, the tasks are
+    enqueued only if that transaction commits.
+    """
+    queue = queue or task.queue
+    rows = [(queue, task.name, json.dumps([list(args), kwargs or {}]))
+            for args, kwargs in arg_list]
+    if not rows:
+        return
+    with db.transaction():
+        db.executemany(
+            "INSERT INTO %s (queue, name, args, run_at) VALUES "
+            "(%%s, %%s, %%s, now() + interval '%d seconds')"
+            % (table, delay), rows)
+        db.notify(CHANNEL, queue)
+    _ENQUEUED.inc(len(rows), labels=(task.name,))
+
+
+def enqueue(db, task, args=(), kwargs=None, delay=0, queue=None,
+            table='durotar_tasks'):
+    """Enqueues a run of ``task`` with ``args`` and ``kwargs`` (which
+    must be JSON serializable), due in ``delay`` seconds.
+    """
+    enqueue_many(db, task, [(args, kwargs)], delay=delay, queue=queue,
+                 table=table)
+
+
+class TaskWorker(object):
+    """Runs the tasks of ``queues`` from the table of ``db``.
+
+    Tasks are claimed ``batch_size`` at a time whenever a notification
+    arrives, and every ``poll_interval`` seconds to pick up delayed
+    tasks and retries.
+    """
+
+    def __init__(self, db, queues=('default',), batch_size=50,
+                 poll_interval=5, lock_timeout=300, table='durotar_tasks',
+                 io_loop=None):
+        self.db = db
+        self.queues = list(queues)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        self.table = table
+        self.io_loop = io_loop or IOLoop.current()
+        self._poller = None
+        self._wakeup = False
+        self._running = False
+        self._stopping = False
+        self._stopped = TracebackFuture()
+
+    def start(self):
+        self.db.listen(CHANNEL, self._on_notify, io_loop=self.io_loop)
+        self._poller = PeriodicCallback(self.wakeup,
+                                        self.poll_interval * 1000,
+                                        io_loop=self.io_loop)
+        self._poller.start()
+        self.wakeup()
+
+    def stop(self):
+        """Stops claiming tasks. Returns a Future resolved once the batch
+        being run is done.
+        """
+        self._stopping = True
+        if self._poller is not None:
+            self._poller.stop()
+        self.db.unlisten(CHANNEL, self._on_notify, io_loop=self.io_loop)
+        if not self._running and not self._stopped.done():
+            self._stopped.set_result(None)
+        return self._stopped
+
+    def _on_notify(self, queue):
+        # None after the listener reconnected
+        if queue is None or queue in self.queues:
+            self.wakeup()
+
+    def wakeup(self):
+        """Claims and runs due tasks until none are left."""
+        if self._running:
+            # the running drain claims again after its batch
+            self._wakeup = True
+        elif not self._stopping:
+            self._drain()
+
+    @gen.coroutine
+    def _drain(self):
+        self._running = True
+        try:
+            while not self._stopping:
+                self._wakeup = False
+                try:
+                    batch = self._claim()
+                except Exception:
+                    app_log.error("Cannot claim tasks", exc_info=True)
+                    break
+                if batch:
+                    yield self._run_batch(batch)
+                if len(batch) < self.batch_size and not self._wakeup:
+                    break
+        finally:
+            self._running = False
+            if self._stopping and not self._stopped.done():
+                self._stopped.set_result(None)
+
+    def _claim(self):
+        with self.db.transaction():
+            rows = self.db.query(
+                "UPDATE %(table)s SET attempts = attempts + 1, "
+                "run_at = now() + interval '%(lock)d seconds' "
+                "WHERE id IN (SELECT id FROM %(table)s "
+                "WHERE queue = ANY(%%s) AND run_at <= now() "
+                "AND failed_at IS NULL ORDER BY run_at LIMIT %%s "
+                "FOR UPDATE SKIP LOCKED) "
+                "RETURNING id, name, args, attempts"
+                % dict(table=self.table, lock=self.lock_timeout),
+                self.queues, self.batch_size)
+        _BATCH_SIZE.observe(len(rows))
+        return rows
+
+    @gen.coroutine
+    def _run_batch(self, batch):
+        for row in batch:
+            try:
+                locked = self._lock(row)
+            except Exception:
+                app_log.error("Cannot lock task %d", row.id, exc_info=True)
+                continue
+            if not locked:
+                app_log.warning("Task %s (%d) was claimed again by another "
+                                "worker; skipped", row.name, row.id)
+                continue
+            t = _tasks.get(row.name)
+            start = time.time()
+            try:
+                if t is None:
+                    raise LookupError("Unknown task %s" % row.name)
+                args, kwargs = json.loads(row.args)
+                result = t(*args, **dict((str(k), v)
+                                         for k, v in kwargs.items()))
+                if gen.is_future(result):
+                    yield result
+            except Exception as e:
+                app_log.error("Task %s (%d) failed", row.name, row.id,
+                              exc_info=True)
+                self._failed(row, t, e)
+            else:
+                _PROCESSED.inc(labels=(row.name, 'ok'))
+                self._finished(row)
+            _TASK_TIME.observe(time.time() - start, labels=(row.name,))
+
+    def _lock(self, row):
+        # renews the lock of a claimed task; returns False if it expired
+        # and another worker claimed the task (and counted an attempt)
+        with self.db.transaction():
+            return self.db.execute_rowcount(
+                "UPDATE %s SET run_at = now() + interval '%d seconds' "
+                "WHERE id = %%s AND attempts = %%s AND failed_at IS NULL"
+                % (self.table, self.lock_timeout), row.id, row.attempts) > 0
+
+    def _finished(self, row):
+        # deleted before the rest of the batch runs, so that a long batch
+        # can't outlive the lock and have the task run again elsewhere
+        try:
+            with self.db.transaction():
+                self.db.execute("DELETE FROM %s WHERE id = %%s" % self.table,
+                                row.id)
+        except Exception:
+            app_log.error("Cannot delete finished task %d", row.id,
+                          exc_info=True)
+
+    def _failed(self, row, t, error):
+        if t is not None and row.attempts < t.max_attempts:
+            query = ("UPDATE %s SET last_error = %%s, run_at = now() + "
+                     "interval '%d seconds' WHERE id = %%s"
+                     % (self.table, t.retry_delay(row.attempts)))
+            result = 'retry'
+        else:
+            query = ("UPDATE %s SET last_error = %%s, failed_at = now() "
+                     "WHERE id = %%s" % self.table)
+            result = 'failed'
+        _PROCESSED.inc(labels=(row.name, result))
+        try:
+            with self.db.transaction():
+                self.db.execute(query, repr(error), row.id)
+        except Exception:
+            app_log.error("Cannot record failure of task %d", row.id,
+                          exc_info=True)
+
+
+def create_worker(application, queues=None, io_loop=None):
+    """Creates a `TaskWorker` for ``application``, importing the modules
+    of its ``task_modules`` setting and reading the ``task_queues``
+    (default ``['default']``), ``task_batch_size`` (50),
+    ``task_poll_interval`` (5) and ``task_lock_timeout`` (300) settings.
+    """
+    settings = application.settings
+    if application.db is None:
+        raise RuntimeError("Task workers need the db_config setting")
+    for module in settings.get('task_modules', []):
+        import_module(module)
+    return TaskWorker(
+        application.db,
+        queues=queues or settings.get('task_queues', ['default']),
+        batch_size=settings.get('task_batch_size', 50),
+        poll_interval=settings.get('task_poll_interval', 5),
+        lock_timeout=settings.get('task_lock_timeout', 300),
+        io_loop=io_loop)
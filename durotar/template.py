@@ -12,6 +12,9 @@ import os.path
 from tornado.template import Loader
 from mako.lookup import TemplateLookup
 
+from durotar import metrics
+from durotar import tracing
+
 
 class MakoLoader(Loader):
     """A Mako template loader that loads from a single root directory.
@@ -20,11 +23,19 @@ class MakoLoader(Loader):
         super(MakoLoader, self).__init__(root_directory, **kwargs)
         self.root = os.path.abspath(root_directory)
 
+    def load(self, name, parent_path=None):
+        """Loads a template, counting template cache hits and misses."""
+        resolved = self.resolve_path(name, parent_path=parent_path)
+        result = 'hit' if resolved in self.templates else 'miss'
+        metrics.CACHE_REQUESTS.inc(labels=('template', result))
+        return super(MakoLoader, self).load(name, parent_path)
+
     def _create_template(self, name):
         _lookup = TemplateLookup(directories=[self.root],
             module_directory='/tmp/mako_module', input_encoding='utf-8',
             output_encoding='utf-8', encoding_errors='replace')
-        template = _lookup.get_template(name)
+        with tracing.span('template'):
+            template = _lookup.get_template(name)
         template.generate = template.render
 
         return template
\ No newline at end of file
@@ -5,11 +5,64 @@
 # <http://stoneopus.com>
 
 """A lightweight wrapper around psycopg2.
+
+`Connection.listen` subscribes callbacks to PostgreSQL notifications,
+which lets every worker process drop cached data another process
+changed::
+
+    db.listen('users_changed', lambda payload: user_cache.pop(payload, None))
+    ...
+    db.execute("UPDATE users SET ... WHERE id = %s", user_id)
+    db.notify('users_changed', str(user_id))
+    db.commit()
+
+All subscriptions of a process share one `Listener` connection, watched
+by the IOLoop.
+
+Statements that must succeed or fail together run in
+`Connection.transaction`, and nested blocks in `Connection.savepoint`::
+
+    with db.transaction():
+        db.execute("UPDATE accounts SET ...")
+        try:
+            with db.savepoint():
+                db.execute("INSERT INTO audit ...")
+        except IntegrityError:
+            pass
+
+The connection is shared by every request of the process, so a
+transaction must not stay open across a ``yield``: statements of other
+requests would run inside it.
+
+By default (``autocommit=True``) each statement outside of a
+`Connection.transaction` commits at once, so reads never leave a
+transaction idle behind them. With ``autocommit=False`` the connection
+behaves like psycopg2's: the first statement opens a transaction that
+lasts until `Connection.commit`, and `Connection.transaction` refuses
+to start while statements that may have written are uncommitted in it.
+Either way `durotar.web.RequestHandler` logs the transactions left open
+with uncommitted work outside of a ``transaction()`` block when a
+request finishes.
+
+A lost connection is re-established in the background, retrying with
+exponential backoff; meanwhile statements fail at once with
+`NotConnected` instead of each waiting for a connect timeout. When a
+background attempt is overdue, because the IOLoop isn't running or is
+blocked, the next statement makes the attempt itself. A ``SELECT``
+outside of a transaction, or in an implicit one that only read, that
+fails because the connection was lost (not because it was canceled or
+timed out) is retried once on a new connection.
+`Connection.start_keepalive` probes an idle connection periodically, so
+a failover is noticed before a request needs the database, and TCP
+keepalives detect peers that vanished without closing the connection.
 """
 
 from __future__ import absolute_import, division, with_statement
 
+import collections
+import contextlib
 import copy
+import functools
 import itertools
 import logging
 import os
@@ -29,11 +82,27 @@ except ImportError:
     else:
         raise
 
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from durotar import metrics
+from durotar import tracing
+
 version = "0.1"
 version_info = (0, 1, 0, 0)
 
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 
+_QUERY_TIME = metrics.REGISTRY.histogram(
+    'durotar_db_seconds', 'Database statement execution time.')
+_RECONNECTS = metrics.REGISTRY.counter(
+    'durotar_db_reconnects_total',
+    'Background reconnection attempts by result.', ('result',))
+_RETRIES = metrics.REGISTRY.counter(
+    'durotar_db_retries_total', 'Reads retried after a lost connection.')
+_NOTIFICATIONS = metrics.REGISTRY.counter(
+    'durotar_db_notifications_total', 'Notifications received by channel.',
+    ('channel',))
+
 class Connection(object):
     """A lightweight wrapper around psycopg2 DB-API connections.
 
@@ -52,13 +121,36 @@ class Connection(object):
     """
     def __init__(self, host, database, port=None, user=None, password=None,
                  max_idle_time=2 * 3600, connect_timeout=0,
-                 connection_factory=None):
+                 connection_factory=None, autocommit=True,
+                 keepalives_idle=30, keepalives_interval=10,
+                 keepalives_count=3, reconnect_backoff=0.1,
+                 max_reconnect_backoff=10):
         self.host = host
         self.database = database
         self.max_idle_time = float(max_idle_time)
+        self.autocommit = autocommit
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self._transaction_depth = 0
+        # statements other than a SELECT ran in the implicit transaction
+        # of a connection without autocommit
+        self._implicit_writes = False
+        self._reconnect_delay = 0
+        self._reconnect_timeout = None
+        self._reconnect_deadline = 0
+        self._keepalive = None
+        self._io_loop = None
+        # moving average of statement times, as of _latency_time
+        self._latency = 0
+        self._latency_time = 0
 
         args = dict(client_encoding="utf8", database=database,
                     connect_timeout=connect_timeout)
+        if keepalives_idle:
+            # TCP keepalives, in seconds
+            args.update(keepalives=1, keepalives_idle=keepalives_idle,
+                        keepalives_interval=keepalives_interval,
+                        keepalives_count=keepalives_count)
         if user is not None:
             args['user'] = user
         if password is not None:
@@ -82,8 +174,9 @@ class Connection(object):
         try:
             self.reconnect()
         except Exception:
-            logging.error("Cannot connect to Postgresql on %s:%s", self.host,
+            logging.error("Cannot connect to Postgresql on %s", self.host,
                           exc_info=True)
+            self._schedule_reconnect()
 
     def __del__(self):
         self.close()
@@ -97,9 +190,88 @@ class Connection(object):
     def reconnect(self):
         """Closes the existing database connection and re-opens it."""
         self.close()
+        self._implicit_writes = False
         self._db = psycopg2.connect(**self._db_args)
-        # It's not a good idea to autocommit
-        #self._db.autocommit = True
+        self._db.autocommit = self.autocommit
+
+    def start_keepalive(self, interval=30, io_loop=None):
+        """Probes the connection when it was idle for ``interval`` seconds,
+        replacing it in the background if it was lost.
+        """
+        self._io_loop = io_loop or IOLoop.current()
+        self.stop_keepalive()
+        self._keepalive = PeriodicCallback(
+            functools.partial(self._probe, interval), interval * 1000,
+            io_loop=self._io_loop)
+        self._keepalive.start()
+
+    def stop_keepalive(self):
+        if self._keepalive is not None:
+            self._keepalive.stop()
+            self._keepalive = None
+
+    def _probe(self, interval):
+        # an implicit transaction that only read is rolled back below
+        if (self._db is None or self._transaction_depth or
+                self.pending_transaction or
+                time.time() - self._last_use_time < interval):
+            return
+        try:
+            cursor = self._db.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            if not self._db.autocommit:
+                self._db.rollback()
+        except psycopg2.Error:
+            logging.warning("Lost connection to Postgresql on %s", self.host,
+                            exc_info=True)
+            self._connection_lost()
+
+    def _connection_lost(self):
+        self.close()
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_timeout is not None:
+            return
+        self._reconnect_delay = min(
+            max(self._reconnect_delay * 2, self.reconnect_backoff),
+            self.max_reconnect_backoff)
+        io_loop = self._io_loop or IOLoop.current()
+        self._reconnect_deadline = time.time() + self._reconnect_delay
+        self._reconnect_timeout = io_loop.add_timeout(
+            self._reconnect_deadline, self._background_reconnect)
+
+    def _reconnect_now(self):
+        # replaces the scheduled background attempt
+        if self._reconnect_timeout is not None:
+            (self._io_loop or IOLoop.current()).remove_timeout(
+                self._reconnect_timeout)
+            self._reconnect_timeout = None
+        try:
+            self.reconnect()
+        except Exception:
+            self._schedule_reconnect()
+            raise
+        self._reconnect_delay = 0
+
+    def _background_reconnect(self):
+        self._reconnect_timeout = None
+        if self._db is not None:
+            return
+        try:
+            self.reconnect()
+        except Exception:
+            _RECONNECTS.inc(labels=('failed',))
+            logging.warning("Cannot reconnect to Postgresql on %s, retrying "
+                            "in %.1fs", self.host,
+                            min(self._reconnect_delay * 2,
+                                self.max_reconnect_backoff))
+            self._schedule_reconnect()
+            return
+        _RECONNECTS.inc(labels=('ok',))
+        self._reconnect_delay = 0
+        logging.info("Reconnected to Postgresql on %s", self.host)
 
     def commit(self):
         """Commit any pending transaction to the database.
@@ -110,6 +282,7 @@ class Connection(object):
         The connection can be also set in "autocommit" mode: no transaction
         is automatically open, commands have immediate effect.
         """
+        self._implicit_writes = False
         return self._db.commit()
 
     def rollback(self):
@@ -120,11 +293,137 @@ class Connection(object):
         statement, the method is automatically called if an exception is raised
         in the with block.
         """
+        self._implicit_writes = False
         return self._db.rollback()
 
+    @property
+    def in_transaction(self):
+        """Whether a transaction is open on the connection."""
+        return (self._db is not None and not self._db.closed and
+                self._db.get_transaction_status() in _OPEN_TRANSACTION)
+
+    @property
+    def latency(self):
+        """The recent statement execution time in seconds: a moving
+        average over the statements run, halving every second without
+        one so that it recovers while requests are shed.
+        """
+        return self._latency * 0.5 ** (time.time() - self._latency_time)
+
+    def _observe(self, seconds):
+        _QUERY_TIME.observe(seconds)
+        self._latency = 0.8 * self.latency + 0.2 * seconds
+        self._latency_time = time.time()
+
+    @property
+    def pending_transaction(self):
+        """Whether a transaction that may hold uncommitted writes is open
+        outside of any `transaction` block: one begun by hand in autocommit
+        mode, or an implicit one with statements other than ``SELECT``
+        otherwise.
+        """
+        if self._transaction_depth or not self.in_transaction:
+            return False
+        return self._db.autocommit or self._implicit_writes
+
+    @property
+    def transaction_depth(self):
+        """The number of `transaction` and `savepoint` blocks being run."""
+        return self._transaction_depth
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the ``with`` block in a transaction, committed when the
+        block completes and rolled back when it raises. Nested in another
+        transaction, it is a `savepoint`.
+
+        Without autocommit, an implicit transaction that only ran
+        ``SELECT`` statements is rolled back first; one that may have
+        written raises `TransactionOpen`, since committing or discarding
+        that work is the caller's decision.
+        """
+        if self._transaction_depth:
+            with self.savepoint():
+                yield self
+            return
+        self._ensure_connected()
+        if self.pending_transaction:
+            raise TransactionOpen("Uncommitted statements outside of a "
+                                  "transaction() block; commit() or "
+                                  "rollback() first")
+        if self.in_transaction:
+            # the snapshot of earlier reads
+            self.rollback()
+        db = self._db
+        if db.autocommit:
+            # psycopg2 opens the transaction with the first statement
+            db.autocommit = False
+        self._transaction_depth = 1
+        try:
+            yield self
+        except BaseException:
+            if not db.closed:
+                db.rollback()
+            raise
+        else:
+            db.commit()
+        finally:
+            self._transaction_depth = 0
+            if not db.closed:
+                db.autocommit = self.autocommit
+
+    @contextlib.contextmanager
+    def savepoint(self):
+        """Runs the ``with`` block in a savepoint of the current
+        transaction, rolled back to when the block raises without
+        aborting the transaction. Outside of a transaction, it is a
+        `transaction`.
+        """
+        if not self._transaction_depth:
+            with self.transaction():
+                yield self
+            return
+        name = 'durotar_savepoint_%d' % self._transaction_depth
+        self._transaction_depth += 1
+        self.execute('SAVEPOINT ' + name)
+        try:
+            yield self
+        except BaseException:
+            # unless the connection was lost with the transaction
+            if self._db is not None:
+                self.execute('ROLLBACK TO SAVEPOINT ' + name)
+            raise
+        else:
+            self.execute('RELEASE SAVEPOINT ' + name)
+        finally:
+            self._transaction_depth -= 1
+
     def query(self, query, *parameters, **kwparameters):
-        """Returns a row list for the given query and parameters."""
+        """Returns a row list for the given query and parameters.
+
+        A ``SELECT`` run outside of a transaction is retried once on a new
+        connection if the connection was lost.
+        """
+        # the work of a transaction is lost with its connection
+        in_transaction = self._transaction_depth or self.pending_transaction
+        try:
+            return self._query(query, parameters, kwparameters)
+        except NotConnected:
+            raise
+        except OperationalError as e:
+            # a canceled or timed out query left the connection usable
+            if (in_transaction or self._db is not None or
+                    isinstance(e, QueryCanceledError) or
+                    not _is_select(query)):
+                raise
+            _RETRIES.inc()
+            self._reconnect_now()
+            return self._query(query, parameters, kwparameters)
+
+    def _query(self, query, parameters, kwparameters):
         cursor = self._cursor()
+        if not _is_select(query):
+            self._wrote()
         try:
             self._execute(cursor, query, parameters, kwparameters)
             column_names = [d[0] for d in cursor.description]
@@ -155,6 +454,7 @@ class Connection(object):
     def execute_lastrowid(self, query, *parameters, **kwparameters):
         """Executes the given query, returning the lastrowid from the query."""
         cursor = self._cursor()
+        self._wrote()
         try:
             self._execute(cursor, query, parameters, kwparameters)
             return cursor.lastrowid
@@ -164,6 +464,7 @@ class Connection(object):
     def execute_rowcount(self, query, *parameters, **kwparameters):
         """Executes the given query, returning the rowcount from the query."""
         cursor = self._cursor()
+        self._wrote()
         try:
             self._execute(cursor, query, parameters, kwparameters)
             return cursor.rowcount
@@ -183,8 +484,12 @@ class Connection(object):
         We return the lastrowid from the query.
         """
         cursor = self._cursor()
+        self._wrote()
         try:
-            cursor.executemany(query, parameters)
+            start = time.time()
+            with tracing.span('db'):
+                cursor.executemany(query, parameters)
+            self._observe(time.time() - start)
             return cursor.lastrowid
         finally:
             cursor.close()
@@ -195,12 +500,31 @@ class Connection(object):
         We return the rowcount from the query.
         """
         cursor = self._cursor()
+        self._wrote()
         try:
-            cursor.executemany(query, parameters)
+            start = time.time()
+            with tracing.span('db'):
+                cursor.executemany(query, parameters)
+            self._observe(time.time() - start)
             return cursor.rowcount
         finally:
             cursor.close()
 
+    def notify(self, channel, payload=''):
+        """Sends ``payload`` to the listeners of ``channel`` when the
+        current transaction commits.
+        """
+        self.execute("SELECT pg_notify(%s, %s)", channel, payload)
+
+    def listen(self, channel, callback, io_loop=None):
+        """Calls ``callback(payload)`` on the IOLoop for every notification
+        on ``channel``. See `Listener.subscribe`.
+        """
+        get_listener(self._db_args, io_loop).subscribe(channel, callback)
+
+    def unlisten(self, channel, callback, io_loop=None):
+        get_listener(self._db_args, io_loop).unsubscribe(channel, callback)
+
     update = execute_rowcount
     updatemany = executemany_rowcount
 
@@ -213,6 +537,14 @@ class Connection(object):
         # until you try to perform a query and it fails.  Protect against
         # this case by preemptively closing and reopening the connection
         # if it has been idle for too long (7 hours by default).
+        if self._db is None and self._reconnect_timeout is not None:
+            if time.time() < self._reconnect_deadline:
+                # reconnecting in the background: fail fast rather than
+                # wait for a connect timeout on every statement
+                raise NotConnected("Not connected to Postgresql on %s"
+                                   % self.host)
+            # the IOLoop didn't make the attempt in time
+            self._reconnect_now()
         if (self._db is None or
             (time.time() - self._last_use_time > self.max_idle_time)):
             self.reconnect()
@@ -222,13 +554,166 @@ class Connection(object):
         self._ensure_connected()
         return self._db.cursor()
 
+    def _wrote(self):
+        # only the implicit transaction of a connection without
+        # autocommit keeps the statement uncommitted
+        if not self._transaction_depth and not self._db.autocommit:
+            self._implicit_writes = True
+
     def _execute(self, cursor, query, parameters, kwparameters):
+        start = time.time()
         try:
-            return cursor.execute(query, kwparameters or parameters)
+            with tracing.span('db'):
+                return cursor.execute(query, kwparameters or parameters)
         except OperationalError:
-            logging.error("Error connecting to Postgresql on %s", self.host)
-            self.close()
+            # OperationalError also covers canceled queries, deadlocks and
+            # serialization failures, which leave the connection open
+            if self._db.closed:
+                logging.error("Lost connection to Postgresql on %s",
+                              self.host)
+                self._connection_lost()
             raise
+        finally:
+            self._observe(time.time() - start)
+
+
+class Listener(object):
+    """Dispatches the notifications of one dedicated autocommit connection
+    to callbacks on the IOLoop.
+
+    The connection is re-established every ``reconnect_interval`` seconds
+    after a failure. Notifications sent meanwhile are lost, so once
+    reconnected every callback is called with ``None`` as payload,
+    meaning anything may have changed.
+    """
+
+    def __init__(self, db_args, io_loop=None, reconnect_interval=5):
+        self.db_args = db_args
+        self.io_loop = io_loop or IOLoop.current()
+        self.reconnect_interval = reconnect_interval
+        self._callbacks = collections.defaultdict(list)
+        self._conn = None
+        # the fd of the IOLoop handler; a closed connection has no fileno()
+        self._fd = None
+        self._reconnect_timeout = None
+
+    def subscribe(self, channel, callback):
+        callbacks = self._callbacks[channel]
+        callbacks.append(callback)
+        if len(callbacks) == 1 and self._conn is not None:
+            self._listen(channel)
+        elif self._conn is None and self._reconnect_timeout is None:
+            self._connect()
+
+    def unsubscribe(self, channel, callback):
+        callbacks = self._callbacks.get(channel)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._callbacks[channel]
+                if self._conn is not None:
+                    self._execute('UNLISTEN %s' % _quote_ident(channel))
+
+    def close(self):
+        if self._reconnect_timeout is not None:
+            self.io_loop.remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        self._disconnect()
+
+    def _connect(self):
+        self._reconnect_timeout = None
+        try:
+            conn = psycopg2.connect(**self.db_args)
+            conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        except psycopg2.Error:
+            logging.error("Cannot connect listener to Postgresql on %s",
+                          self.db_args.get('host'), exc_info=True)
+            self._schedule_reconnect()
+            return False
+        self._conn = conn
+        self._fd = conn.fileno()
+        self.io_loop.add_handler(self._fd, self._on_events, IOLoop.READ)
+        for channel in self._callbacks:
+            self._listen(channel)
+        return self._conn is not None
+
+    def _disconnect(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self.io_loop.remove_handler(self._fd)
+            self._fd = None
+            conn.close()
+
+    def _schedule_reconnect(self):
+        self._disconnect()
+        if self._reconnect_timeout is None:
+            self._reconnect_timeout = self.io_loop.add_timeout(
+                time.time() + self.reconnect_interval, self._reconnected)
+
+    def _reconnected(self):
+        if self._connect():
+            for channel in list(self._callbacks):
+                self._dispatch(channel, None)
+
+    def _listen(self, channel):
+        self._execute('LISTEN %s' % _quote_ident(channel))
+
+    def _execute(self, statement):
+        try:
+            self._conn.cursor().execute(statement)
+        except psycopg2.Error:
+            logging.error("Listener connection to Postgresql lost",
+                          exc_info=True)
+            self._schedule_reconnect()
+
+    def _on_events(self, fd, events):
+        conn = self._conn
+        try:
+            conn.poll()
+        except psycopg2.Error:
+            logging.error("Listener connection to Postgresql lost",
+                          exc_info=True)
+            self._schedule_reconnect()
+            return
+        notifies = conn.notifies[:]
+        del conn.notifies[:]
+        for notify in notifies:
+            _NOTIFICATIONS.inc(labels=(notify.channel,))
+            self._dispatch(notify.channel, notify.payload)
+
+    def _dispatch(self, channel, payload):
+        for callback in list(self._callbacks.get(channel, ())):
+            try:
+                callback(payload)
+            except Exception:
+                logging.error("Error in notification callback for %s",
+                              channel, exc_info=True)
+
+
+# one listener per IOLoop and database
+_listeners = {}
+
+
+def get_listener(db_args, io_loop=None):
+    """Returns the process's `Listener` for the database of ``db_args``."""
+    io_loop = io_loop or IOLoop.current()
+    key = (io_loop, db_args.get('host'), db_args.get('port'),
+           db_args.get('database'), db_args.get('user'))
+    listener = _listeners.get(key)
+    if listener is None:
+        args = dict(db_args)
+        args.pop('connection_factory', None)
+        listener = _listeners[key] = Listener(args, io_loop)
+    return listener
+
+
+def _is_select(query):
+    return query.lstrip()[:6].upper() == 'SELECT'
+
+
+def _quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
 
 
 class Row(dict):
@@ -239,5 +724,23 @@ class Row(dict):
         except KeyError:
             raise AttributeError(name)
 
+_OPEN_TRANSACTION = frozenset([
+    psycopg2.extensions.TRANSACTION_STATUS_INTRANS,
+    psycopg2.extensions.TRANSACTION_STATUS_INERROR])
+
 IntegrityError = psycopg2.IntegrityError
 OperationalError = psycopg2.OperationalError
+ProgrammingError = psycopg2.ProgrammingError
+QueryCanceledError = psycopg2.extensions.QueryCanceledError
+
+
+class NotConnected(OperationalError):
+    """Raised while the connection is being re-established."""
+    pass
+
+
+class TransactionOpen(ProgrammingError):
+    """Raised by `Connection.transaction` when a transaction with
+    uncommitted work is already open outside of one.
+    """
+    pass
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Per-request performance tracing.
+
+A `RequestTrace` collects timed spans (routing, context processors,
+template lookup and render, ``space_compress``, database queries and auth
+fetches) for a single request. The trace of the running request is carried
+across IOLoop callbacks with a `tornado.stack_context.StackContext`, so
+library code only needs to call `span` or `start_span`::
+
+    with tracing.span('db'):
+        cursor.execute(query)
+
+When no request is being traced both helpers return a shared no-op span,
+which keeps the cost of unsampled requests to a thread-local lookup.
+
+Tracing is configured with application settings:
+
+* ``trace_sample_rate``: fraction of requests to trace (default ``0``,
+  tracing disabled).
+* ``trace_server_timing``: add a ``Server-Timing`` header to traced
+  responses (default ``False``).
+* ``trace_exporter``: dotted path to a callable invoked as
+  ``exporter(handler, trace)`` once a traced request has finished.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import contextlib
+import random
+import threading
+import time
+
+
+class _State(threading.local):
+    def __init__(self):
+        self.trace = None
+_state = _State()
+
+
+class Span(object):
+    """A single timed operation inside a `RequestTrace`."""
+
+    __slots__ = ('name', 'start', 'duration')
+
+    def __init__(self, name, start=None):
+        self.name = name
+        self.start = start if start is not None else time.time()
+        self.duration = None
+
+    def finish(self, end=None):
+        """Records the end of the span. Finishing twice is a no-op."""
+        if self.duration is None:
+            self.duration = (end if end is not None else time.time()) \
+                - self.start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.finish()
+
+
+class _NullSpan(object):
+    """Span returned when the current request is not traced."""
+
+    __slots__ = ()
+
+    def finish(self, end=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_null_span = _NullSpan()
+
+
+class RequestTrace(object):
+    """The spans recorded for one request."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.spans = []
+
+    def start_span(self, name, start=None):
+        span = Span(name, start)
+        self.spans.append(span)
+        return span
+
+    def add_span(self, name, start, end):
+        span = self.start_span(name, start)
+        span.finish(end)
+        return span
+
+    def summary(self):
+        """Returns a list of ``(name, count, total_seconds)`` tuples
+        aggregating finished spans by name, in first-seen order.
+        """
+        totals = {}
+        order = []
+        for span in self.spans:
+            if span.duration is None:
+                continue
+            if span.name not in totals:
+                totals[span.name] = [0, 0.0]
+                order.append(span.name)
+            entry = totals[span.name]
+            entry[0] += 1
+            entry[1] += span.duration
+        return [(name, totals[name][0], totals[name][1]) for name in order]
+
+    def server_timing(self):
+        """Formats the trace as a ``Server-Timing`` header value."""
+        parts = []
+        for name, count, total in self.summary():
+            part = "%s;dur=%.2f" % (name, total * 1000.0)
+            if count > 1:
+                part += ';desc="%dx"' % count
+            parts.append(part)
+        return ", ".join(parts)
+
+    def log_fields(self):
+        """Formats the trace for a structured access log line."""
+        return " ".join("%s=%.2fms/%d" % (name, total * 1000.0, count)
+                        for name, count, total in self.summary())
+
+
+class Tracer(object):
+    """Decides which requests are traced and where finished traces go."""
+
+    def __init__(self, sample_rate=0.0, server_timing=False, exporter=None):
+        self.sample_rate = float(sample_rate)
+        self.server_timing = server_timing
+        self.exporter = exporter
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def begin(self, name):
+        """Returns a new `RequestTrace`, or None if the request is not
+        sampled.
+        """
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and
+                                     random.random() >= self.sample_rate):
+            return None
+        return RequestTrace(name)
+
+    def export(self, handler, trace):
+        if self.exporter is not None:
+            self.exporter(handler, trace)
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """Makes ``trace`` the current trace. Used as a ``StackContext``
+    factory so the trace follows the request across callbacks.
+    """
+    old = _state.trace
+    _state.trace = trace
+    try:
+        yield
+    finally:
+        _state.trace = old
+
+
+def current():
+    """Returns the `RequestTrace` of the running request, if any."""
+    return _state.trace
+
+
+def start_span(name):
+    """Starts a span on the current trace. Call ``finish()`` on the result
+    when the operation completes, e.g. from an asynchronous callback.
+    """
+    trace = _state.trace
+    if trace is None:
+        return _null_span
+    return trace.start_span(name)
+
+
+def span(name):
+    """Returns a context manager timing the enclosed block."""
+    trace = _state.trace
+    if trace is None:
+        return _null_span
+    return trace.start_span(name)
@@ -4,22 +4,44 @@
 # Copyright (c) 2014 Stoneopus Technologies Co., Ltd.
 # <http://stoneopus.com>
 
+import functools
 import logging
+import math
 import time
 
 import tornado.web
 import tornado.options
 
+from tornado import escape
 from tornado import httputil
+from tornado import stack_context
 from tornado.log import access_log, app_log, gen_log
 import durotar
 
-from durotar import template
-from durotar import tornpg
+from durotar import admission
+from durotar import metrics
+from durotar import tracing
 from durotar.util import import_module, load_class
-from durotar.filters import space_compress
 from durotar.route import Route
 
+# durotar.tornpg (psycopg2), durotar.template (Mako), durotar.filters,
+# durotar.session (sqlite3), durotar.executor, durotar.httpclient,
+# durotar.profiler and durotar.tasks are imported where first used, so
+# processes that don't need them start fast.
+
+
+_REQUESTS = metrics.REGISTRY.counter(
+    'durotar_requests_total', 'Finished requests by route and status.',
+    ('route', 'status'))
+_REQUEST_TIME = metrics.REGISTRY.histogram(
+    'durotar_request_seconds', 'Request latency by route.', ('route',))
+_RENDER_TIME = metrics.REGISTRY.histogram(
+    'durotar_render_seconds', 'Template render time by route.', ('route',))
+_OPEN_TRANSACTIONS = metrics.REGISTRY.counter(
+    'durotar_db_open_transactions_total',
+    'Requests that finished with a database transaction open, by route.',
+    ('route',))
+
 
 class Application(tornado.web.Application):
     """Subclass of tornado.web.Application
@@ -43,9 +65,42 @@ class Application(tornado.web.Application):
 
         tornado.web.Application.__init__(self, self.handlers, **settings)
 
+        # per-request tracing
+        self._setup_tracer()
+
         # database connection
         self._connect_db(self.settings.get('db_config'))
 
+        # server-side sessions
+        self.session_store = None
+        if self.settings.get('session_store') is not None:
+            from durotar import session
+            self.session_store = session.create_store(self.settings, self.db)
+
+        # pools for blocking calls
+        self.executors = {}
+        if (self.settings.get('executor_threads', 10) or
+                self.settings.get('executor_processes', 0)):
+            from durotar import executor
+            self.executors = executor.create_executors(self.settings)
+
+        # rate limits, concurrency caps and load shedding
+        self.admission = admission.create_admission(
+            self.settings, self.executors, self.db)
+        if self.admission is not None:
+            self.admission.start()
+
+        # outbound HTTP requests
+        from durotar import httpclient
+        httpclient.configure(self.settings)
+
+        if self.settings.get('metrics_url'):
+            self.add_handlers('.*$', [(self.settings['metrics_url'],
+                                       metrics.MetricsHandler)])
+
+        # on-demand sampling profiler
+        self._setup_profiler()
+
 
     def _install_app(self, apps):
         """Discovery handlers automaticlly from app directory"""
@@ -67,7 +122,52 @@ class Application(tornado.web.Application):
     def _connect_db(self, config):
         self.db = None
         if config:
+            from durotar import tornpg
             self.db = tornpg.Connection(**config)
+            # notice a lost connection before a request needs it
+            interval = self.settings.get('db_keepalive_interval', 30)
+            if interval:
+                self.db.start_keepalive(interval)
+
+    def _setup_tracer(self):
+        exporter = self.settings.get('trace_exporter')
+        if isinstance(exporter, basestring):
+            exporter = load_class(exporter)
+        self.tracer = tracing.Tracer(
+            sample_rate=self.settings.get('trace_sample_rate', 0),
+            server_timing=self.settings.get('trace_server_timing', False),
+            exporter=exporter)
+
+    def _setup_profiler(self):
+        from durotar import profiler
+        self.profiler = profiler.Sampler(
+            interval=self.settings.get('profiler_interval', 0.005))
+        if self.settings.get('profiler_url'):
+            self.add_handlers('.*$', [(self.settings['profiler_url'],
+                                       profiler.ProfilerHandler)])
+        if self.settings.get('profiler_signal'):
+            profiler.install_signal(self.profiler,
+                                    self.settings['profiler_signal'],
+                                    self.settings.get('profiler_output'))
+
+    def log_request(self, handler):
+        """Writes a completed HTTP request to the logs, appending the
+        span summary of traced requests.
+        """
+        trace = getattr(handler, '_trace', None)
+        if trace is None or 'log_function' in self.settings:
+            return super(Application, self).log_request(handler)
+
+        if handler.get_status() < 400:
+            log_method = access_log.info
+        elif handler.get_status() < 500:
+            log_method = access_log.warning
+        else:
+            log_method = access_log.error
+        request_time = 1000.0 * handler.request.request_time()
+        log_method("%d %s %.2fms handler=%s %s", handler.get_status(),
+                   handler._request_summary(), request_time,
+                   handler.route_name, trace.log_fields())
 
 
 class RequestHandler(tornado.web.RequestHandler):
@@ -75,12 +175,193 @@ class RequestHandler(tornado.web.RequestHandler):
     tornado.web.RequestHandler.
     """
 
+    _trace = None
+
+    _session = None
+
+    _admitted = False
+
+    @property
+    def route_name(self):
+        """The `~durotar.route.Route` name this handler was registered
+        under, falling back to the class name.
+        """
+        return getattr(self, '_route_name', None) or self.__class__.__name__
+
+    def _execute(self, transforms, *args, **kwargs):
+        control = self.application.admission
+        if control is not None:
+            rejection = control.admit(self.route_name, self.admission_key())
+            if rejection is not None:
+                self._transforms = transforms
+                return self._reject(*rejection)
+            self._admitted = True
+        trace = self.application.tracer.begin(self.route_name)
+        if trace is None:
+            return super(RequestHandler, self)._execute(transforms,
+                                                        *args, **kwargs)
+        # time spent before the handler runs: parsing and routing
+        trace.add_span('route', self.request._start_time, trace.start)
+        self._trace = trace
+        with stack_context.StackContext(
+                functools.partial(tracing.activate, trace)):
+            return super(RequestHandler, self)._execute(transforms,
+                                                        *args, **kwargs)
+
+    def finish(self, chunk=None):
+        trace = self._trace
+        if (trace is not None and self.application.tracer.server_timing
+                and not self._headers_written):
+            self.set_header('Server-Timing', trace.server_timing())
+        if self._session is not None and self._session.modified:
+            self._save_session()
+        super(RequestHandler, self).finish(chunk)
+        self._release()
+        route = self.route_name
+        _REQUESTS.inc(labels=(route, self.get_status()))
+        _REQUEST_TIME.observe(self.request.request_time(), labels=(route,))
+        db = self.application.db
+        if db is not None and db.pending_transaction:
+            self._report_open_transaction()
+        if trace is not None:
+            self.application.tracer.export(self, trace)
+
+    def on_connection_close(self):
+        self._release()
+        super(RequestHandler, self).on_connection_close()
+
+    def admission_key(self):
+        """Returns the client key of per-client rate limits, by default the
+        remote IP. Override to limit by user or API key instead.
+        """
+        return self.request.remote_ip
+
+    def _reject(self, status, retry_after):
+        # an admission control rejection: answer before any handler code
+        if self._prepared_future is not None:
+            self._prepared_future.set_result(None)
+        # 429 is missing from httplib's reasons on python 2
+        self.set_status(status, 'Too Many Requests' if status == 429 else None)
+        self.set_header('Retry-After', int(math.ceil(retry_after)))
+        self.finish()
+
+    def _release(self):
+        if self._admitted:
+            self._admitted = False
+            self.application.admission.release(self.route_name)
+
+    def _report_open_transaction(self):
+        # uncommitted work outside of any transaction() block; it may be
+        # another request's, so it is reported rather than rolled back
+        _OPEN_TRANSACTIONS.inc(labels=(self.route_name,))
+        gen_log.warning("%s finished with a database transaction open "
+                        "outside of a transaction() block", self.route_name)
+
+    @property
+    def session(self):
+        """The `durotar.session.Session` of this request, loaded on first
+        use. Requires the ``session_store`` application setting.
+        """
+        if self._session is None:
+            self._session = self._load_session()
+        return self._session
+
+    def get_current_user(self):
+        """Returns the ``user`` entry of the session when sessions are
+        enabled. Override to determine the user differently.
+        """
+        if self.application.session_store is None:
+            return None
+        return self.session.get('user')
+
+    def _load_session(self):
+        store = self.application.session_store
+        if store is None:
+            raise RuntimeError("No session_store configured")
+        from durotar import session
+        sid = self.get_secure_cookie(
+            self.settings.get('session_cookie', 'sid'),
+            max_age_days=self.settings.get('session_expires_days', 30))
+        if sid:
+            sid = escape.native_str(sid)
+            with tracing.span('session'):
+                data = store.load(sid)
+            if data is not None:
+                return session.Session(sid, data)
+        return session.Session()
+
+    def _save_session(self):
+        # the session is always stored; once headers were flushed only the
+        # cookie can no longer be updated
+        store = self.application.session_store
+        sess = self._session
+        name = self.settings.get('session_cookie', 'sid')
+        expires_days = self.settings.get('session_expires_days', 30)
+        new_sid = sess.sid is None
+        with tracing.span('session'):
+            if sess.discarded_sid is not None:
+                store.delete(sess.discarded_sid)
+            if not sess:
+                if sess.sid is not None:
+                    store.delete(sess.sid)
+                    if not self._headers_written:
+                        self.clear_cookie(name)
+                sess.modified = False
+                return
+            if new_sid:
+                from durotar import session
+                sess.sid = session.generate_id()
+            store.save(sess.sid, dict(sess), expires_days * 24 * 3600)
+        sess.modified = False
+        if not self._headers_written:
+            self.set_secure_cookie(name, sess.sid, expires_days=expires_days,
+                                   httponly=True)
+        elif new_sid:
+            gen_log.warning("%s created session %s after flushing headers; "
+                            "its cookie cannot be sent", self.route_name,
+                            sess.sid)
+
+    def run_in_executor(self, fn, *args, **kwargs):
+        """Runs the blocking ``fn`` in the application's thread pool and
+        returns a future. Responds 503 when the pool is saturated.
+        """
+        return self._submit('thread', fn, args, kwargs)
+
+    def run_in_process(self, fn, *args, **kwargs):
+        """Runs ``fn`` in the application's process pool. ``fn`` and its
+        arguments must be picklable.
+        """
+        return self._submit('process', fn, args, kwargs)
+
+    def _submit(self, kind, fn, args, kwargs):
+        pool = self.application.executors.get(kind)
+        if pool is None:
+            raise RuntimeError("No %s executor configured" % kind)
+        from durotar import executor
+        try:
+            return pool.submit(fn, *args, **kwargs)
+        except executor.ExecutorFull as e:
+            gen_log.warning(str(e))
+            raise tornado.web.HTTPError(503)
+
+    def enqueue(self, task, args=(), kwargs=None, delay=0, queue=None):
+        """Enqueues ``task`` to run in a task worker with ``args`` and
+        ``kwargs``. See `durotar.tasks.enqueue`.
+        """
+        if self.application.db is None:
+            raise RuntimeError("No db_config configured")
+        from durotar import tasks
+        with tracing.span('enqueue'):
+            tasks.enqueue(self.application.db, task, args, kwargs,
+                          delay=delay, queue=queue)
+
     def _apply_context_processors(self, kwargs):
         context = {}
         context.update(kwargs)
 
-        for processor in self.application.context_processors:
-            context.update(processor(self))
+        with tracing.span('context'):
+            for processor in self.application.context_processors:
+                context.update(processor(self))
 
         return context
 
@@ -92,9 +373,14 @@ class RequestHandler(tornado.web.RequestHandler):
         """
         context = self._apply_context_processors(kwargs)
 
-        content = super(RequestHandler, self).render_string(template_name,
-                                                            **context)
-        return space_compress(content)
+        start = time.time()
+        with tracing.span('render'):
+            content = super(RequestHandler, self).render_string(
+                template_name, **context)
+        _RENDER_TIME.observe(time.time() - start, labels=(self.route_name,))
+        from durotar.filters import space_compress
+        with tracing.span('compress'):
+            return space_compress(content)
 
     def create_template_loader(self, template_path):
         """Returns a new mako template loader for the given path.
@@ -111,6 +397,7 @@ class RequestHandler(tornado.web.RequestHandler):
             # autoescape=None means "no escaping", so we have to be sure
             # to only pass this kwargs if the user asked for i.
             kwargs['autoescape'] = settings['autoescape']
+        from durotar import template
         return template.MakoLoader(template_path, **kwargs)
 
     def clear(self):
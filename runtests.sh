@@ -0,0 +1,4 @@
+#!/bin/sh
+# Runs the unit tests against the working tree.
+cd "$(dirname "$0")"
+PYTHONPATH=.${PYTHONPATH:+:$PYTHONPATH} exec ${PYTHON:-python} -m unittest discover -s tests "$@"
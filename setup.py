@@ -97,6 +97,11 @@ http://api.mongodb.org/python/current/installation.html#osx
 
 kwargs = {}
 
+if setuptools is not None:
+    kwargs['entry_points'] = {
+        'console_scripts': ['durotar = durotar.server:main'],
+    }
+
 version = "0.1.0"
 
 with open('README.rst') as f:
@@ -117,16 +122,22 @@ if (platform.python_implementation() == "CPython" and
         # fall back to the pure-python implementation on any build failure.
         kwargs['cmdclass'] = {'build_ext': custom_build_ext}
 
+install_requires = [
+    'tornado>=4.0.2',
+    'mako>=1.0.0',
+    'FormEncode>=1.3.0a1',
+    'psycopg2>=2.5.4',
+]
+
+if sys.version_info < (3, 2):
+    # the concurrent.futures backport, for durotar.executor
+    install_requires.append('futures>=2.1.6')
+
 setup(
     name="durotar",
     version=version,
     packages=["durotar"],
-    install_requires = [
-        'tornado>=4.0.2',
-        'mako>=1.0.0',
-        'FormEncode>=1.3.0a1',
-        'psycopg2>=2.5.4',
-    ],
+    install_requires=install_requires,
     platforms=["Linux", "Unix", "Mac OS X", "Windows"],
     include_package_data=True,
     author="Mark Gao",
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the GCRA rate limiter and the admission decisions of
+`durotar.admission`.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import unittest
+
+from tornado.ioloop import IOLoop
+
+from durotar.admission import Admission, RateLimiter, create_admission
+
+
+class FakePool(object):
+    wait = 0
+
+    def queue_wait(self):
+        return self.wait
+
+
+class FakeDB(object):
+    latency = 0
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        limiter = RateLimiter(rate=10, burst=3)
+        now = 1000.0
+        self.assertEqual([limiter.take('a', now) for i in range(3)],
+                         [0, 0, 0])
+        self.assertAlmostEqual(limiter.take('a', now), 0.1)
+        # one event is allowed every 1 / rate seconds afterwards
+        self.assertEqual(limiter.take('a', now + 0.1), 0)
+        self.assertAlmostEqual(limiter.take('a', now + 0.15), 0.05)
+        self.assertEqual(limiter.take('a', now + 0.2), 0)
+
+    def test_keys_are_independent(self):
+        limiter = RateLimiter(rate=1)
+        self.assertEqual(limiter.take('a', 1000.0), 0)
+        self.assertGreater(limiter.take('a', 1000.0), 0)
+        self.assertEqual(limiter.take('b', 1000.0), 0)
+
+    def test_rejected_events_are_not_counted(self):
+        limiter = RateLimiter(rate=1)
+        limiter.take('a', 1000.0)
+        for i in range(10):
+            limiter.take('a', 1000.5)
+        self.assertEqual(limiter.take('a', 1001.0), 0)
+
+    def test_evict(self):
+        limiter = RateLimiter(rate=1, burst=2)
+        limiter.take('a', 1000.0)
+        limiter.take('b', 1000.0)
+        limiter.take('b', 1000.0)
+        limiter.evict(1001.0)
+        self.assertEqual(len(limiter), 1)
+        limiter.evict(1002.0)
+        self.assertEqual(len(limiter), 0)
+
+    def test_max_keys(self):
+        limiter = RateLimiter(rate=1, max_keys=2)
+        limiter.take('a', 1000.0)
+        limiter.take('b', 1000.0)
+        # full of limited keys: new keys are allowed but not tracked
+        self.assertEqual(limiter.take('c', 1000.5), 0)
+        self.assertEqual(limiter.take('c', 1000.5), 0)
+        self.assertEqual(len(limiter), 2)
+        # once the others refilled, they make room
+        self.assertEqual(limiter.take('c', 1002.0), 0)
+        self.assertGreater(limiter.take('c', 1002.0), 0)
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def test_route_rate(self):
+        admission = Admission(route_rates={'home': (1, 2)},
+                              io_loop=self.io_loop)
+        self.assertIsNone(admission.admit('home', '1.2.3.4'))
+        self.assertIsNone(admission.admit('home', '5.6.7.8'))
+        status, retry_after = admission.admit('home', '1.2.3.4')
+        self.assertEqual(status, 429)
+        self.assertGreater(retry_after, 0)
+        self.assertIsNone(admission.admit('other', '1.2.3.4'))
+
+    def test_client_rate(self):
+        admission = Admission(client_rate=(1, 1), io_loop=self.io_loop)
+        self.assertIsNone(admission.admit('home', '1.2.3.4'))
+        self.assertEqual(admission.admit('other', '1.2.3.4')[0], 429)
+        self.assertIsNone(admission.admit('home', '5.6.7.8'))
+
+    def test_concurrency(self):
+        admission = Admission(max_concurrency=3,
+                              route_concurrency={'upload': 1},
+                              io_loop=self.io_loop)
+        self.assertIsNone(admission.admit('upload', 'a'))
+        self.assertEqual(admission.admit('upload', 'a'), (503, 1))
+        self.assertIsNone(admission.admit('home', 'a'))
+        self.assertIsNone(admission.admit('home', 'a'))
+        self.assertEqual(admission.admit('home', 'a'), (503, 1))
+        admission.release('upload')
+        self.assertEqual(admission.in_flight, 2)
+        self.assertIsNone(admission.admit('upload', 'a'))
+
+    def test_exempt(self):
+        admission = Admission(max_concurrency=1, exempt=['health'],
+                              io_loop=self.io_loop)
+        self.assertIsNone(admission.admit('home', 'a'))
+        self.assertIsNone(admission.admit('health', 'a'))
+        admission.release('health')
+        self.assertEqual(admission.in_flight, 1)
+
+    def test_pool_overload(self):
+        pool = FakePool()
+        admission = Admission(max_pool_wait=0.5, pool=pool,
+                              io_loop=self.io_loop)
+        self.assertIsNone(admission.admit('home', 'a'))
+        pool.wait = 1
+        self.assertEqual(admission.admit('home', 'a'), (503, 1))
+
+    def test_db_overload(self):
+        db = FakeDB()
+        admission = Admission(max_db_latency=0.2, db=db,
+                              io_loop=self.io_loop)
+        self.assertIsNone(admission.admit('home', 'a'))
+        db.latency = 0.5
+        self.assertEqual(admission.admit('home', 'a'), (503, 1))
+        # without a database the limit is ignored
+        self.assertFalse(Admission(max_db_latency=0.2,
+                                   io_loop=self.io_loop).overloaded())
+
+    def test_create_admission(self):
+        self.assertIsNone(create_admission({}, io_loop=self.io_loop))
+        pool = FakePool()
+        admission = create_admission(
+            dict(admission_max_pool_wait=1, admission_exempt=['health']),
+            executors=dict(thread=pool), io_loop=self.io_loop)
+        self.assertIs(admission.pool, pool)
+        self.assertEqual(admission.exempt, frozenset(['health']))
+        db = FakeDB()
+        admission = create_admission(dict(admission_max_db_latency=0.5),
+                                     db=db, io_loop=self.io_loop)
+        self.assertIs(admission.db, db)
+        self.assertEqual(admission.max_db_latency, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests `durotar.auth.WechatMpMixin.get_users_info` against a local stub
+of the Wechat API.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import time
+import unittest
+
+import tornado.web
+from tornado import escape
+from tornado.httpclient import AsyncHTTPClient
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from durotar.auth import MemoryTokenStore, WechatMpMixin
+
+
+class BatchGetHandler(tornado.web.RequestHandler):
+    def post(self):
+        token = self.get_argument('access_token')
+        if token == 'malformed':
+            self.finish('{"user_info_list": [')
+            return
+        if token == 'expired':
+            self.finish(dict(errcode=40001, errmsg='invalid credential'))
+            return
+        openids = [user['openid'] for user in
+                   escape.json_decode(self.request.body)['user_list']]
+        self.finish(dict(user_info_list=[
+            dict(openid=openid, nickname='user %s' % openid)
+            for openid in openids if not openid.startswith('unknown')]))
+
+
+class UserInfoHandler(tornado.web.RequestHandler):
+    def get(self):
+        openid = self.get_argument('openid')
+        if openid == 'blocked':
+            self.finish(dict(errcode=46004, errmsg='user not exist'))
+            return
+        self.finish(dict(openid=openid, nickname='user %s' % openid))
+
+
+class RefreshHandler(tornado.web.RequestHandler):
+    def get(self):
+        # a malformed answer makes the refresh fail with an exception
+        self.finish('<html>')
+
+
+class StubClient(WechatMpMixin):
+    def __init__(self, test, store):
+        self.test = test
+        self.settings = dict(wechat_token_store=store)
+        self._WECHAT_BASE_URL = test.get_url('/sns')
+        self._WECHAT_API_URL = test.get_url('/cgi-bin')
+        self._OAUTH_REFRESH_TOKEN_URL = test.get_url(
+            '/sns/oauth2/refresh_token?')
+
+    def get_auth_http_client(self):
+        return self.test.http_client
+
+
+class GetUsersInfoTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([
+            ('/cgi-bin/user/info/batchget', BatchGetHandler),
+            ('/sns/userinfo', UserInfoHandler),
+            ('/sns/oauth2/refresh_token', RefreshHandler),
+        ])
+
+    def get_http_client(self):
+        return AsyncHTTPClient(io_loop=self.io_loop, force_instance=True)
+
+    def setUp(self):
+        super(GetUsersInfoTest, self).setUp()
+        self.store = MemoryTokenStore()
+        self.client = StubClient(self, self.store)
+
+    def store_token(self, openid, expires_at):
+        self.store.set('app', openid, dict(
+            openid=openid, access_token='token-%s' % openid,
+            refresh_token='refresh-%s' % openid, expires_at=expires_at))
+
+    @gen_test
+    def test_batchget(self):
+        self.client._BATCHGET_SIZE = 2
+        result = yield self.client.get_users_info(
+            ['a', 'b', 'unknown', 'c'], access_token='good', concurrency=1)
+        self.assertEqual(sorted(result['users']), ['a', 'b', 'c'])
+        self.assertEqual(result['users']['b']['nickname'], 'user b')
+        self.assertEqual(list(result['errors']), ['unknown'])
+
+    @gen_test
+    def test_batchget_api_error(self):
+        result = yield self.client.get_users_info(
+            ['a', 'b'], access_token='expired')
+        self.assertEqual(result['users'], {})
+        self.assertEqual(result['errors'], dict(a='invalid credential',
+                                                b='invalid credential'))
+
+    @gen_test
+    def test_batchget_malformed_json(self):
+        reported = []
+        result = yield self.client.get_users_info(
+            ['a', 'b'], access_token='malformed',
+            on_result=lambda *args: reported.append(args))
+        self.assertEqual(sorted(result['errors']), ['a', 'b'])
+        self.assertEqual(sorted(openid for openid, user, error in reported),
+                         ['a', 'b'])
+
+    @gen_test
+    def test_user_tokens(self):
+        for openid in ('a', 'blocked'):
+            self.store_token(openid, time.time() + 3600)
+        result = yield self.client.get_users_info(
+            ['a', 'blocked', 'nobody'], appid='app')
+        self.assertEqual(list(result['users']), ['a'])
+        self.assertEqual(result['errors'], dict(blocked='user not exist',
+                                                nobody='No access token'))
+
+    @gen_test
+    def test_token_refresh_failure(self):
+        self.store_token('a', time.time() + 3600)
+        self.store_token('stale', time.time() - 1)
+        result = yield self.client.get_users_info(['a', 'stale'],
+                                                  appid='app')
+        self.assertEqual(list(result['users']), ['a'])
+        self.assertEqual(list(result['errors']), ['stale'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the bounded executors of `durotar.executor` and the handler
+helpers using them.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import os
+import threading
+import time
+import unittest
+
+from concurrent import futures
+from tornado import gen
+from tornado.httpclient import HTTPError
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+
+from durotar import executor
+from durotar.executor import BoundedExecutor, ExecutorFull, blocking
+from durotar.web import Application, RequestHandler
+
+
+def getpid():
+    return os.getpid()
+
+
+class BoundedExecutorTest(AsyncTestCase):
+    def setUp(self):
+        super(BoundedExecutorTest, self).setUp()
+        self.release = threading.Event()
+
+    def thread_pool(self, max_pending):
+        pool = BoundedExecutor('test', futures.ThreadPoolExecutor(1),
+                               max_pending, io_loop=self.io_loop)
+        self.addCleanup(pool.shutdown)
+        # cleanups run last in, first out
+        self.addCleanup(self.release.set)
+        return pool
+
+    @gen_test
+    def test_bound(self):
+        pool = self.thread_pool(2)
+        first = pool.submit(self.release.wait)
+        second = pool.submit(lambda: 'second')
+        self.assertRaises(ExecutorFull, pool.submit, lambda: 'third')
+        self.release.set()
+        yield [first, second]
+        self.assertEqual(second.result(), 'second')
+        # completion is counted on the IOLoop
+        yield gen.moment
+        self.assertEqual(pool.pending, 0)
+        self.assertEqual((yield pool.submit(lambda: 'again')), 'again')
+
+    @gen_test
+    def test_queue_wait(self):
+        pool = self.thread_pool(10)
+        self.assertEqual(pool.queue_wait(), 0)
+        running = pool.submit(self.release.wait)
+        waiting = pool.submit(lambda: None)
+        submitted = pool._queued[-1][0]
+        # only the call that has not started counts
+        self.assertAlmostEqual(pool.queue_wait(submitted + 2), 2, places=2)
+        self.release.set()
+        yield [running, waiting]
+        self.assertEqual(pool.queue_wait(), 0)
+
+    @gen_test
+    def test_process_pool(self):
+        pool = BoundedExecutor('process', futures.ProcessPoolExecutor(1),
+                               io_loop=self.io_loop)
+        self.addCleanup(pool.shutdown)
+        pid = yield pool.submit(getpid)
+        self.assertNotEqual(pid, os.getpid())
+        with self.assertRaises(ZeroDivisionError):
+            yield pool.submit(divmod, 1, 0)
+        yield gen.moment
+        self.assertEqual(pool.pending, 0)
+        self.assertEqual(pool.queue_wait(), 0)
+
+
+class CreateExecutorsTest(unittest.TestCase):
+    def test_settings(self):
+        executors = executor.create_executors(
+            dict(executor_threads=2, executor_processes=1,
+                 executor_queue_size=5))
+        for pool in executors.values():
+            pool.shutdown()
+        self.assertEqual(sorted(executors), ['process', 'thread'])
+        self.assertEqual(executors['thread'].max_pending, 5)
+        self.assertEqual(executor.create_executors(
+            dict(executor_threads=0)), {})
+
+    def test_missing_futures(self):
+        executor.futures = None
+        self.addCleanup(setattr, executor, 'futures', futures)
+        self.assertRaises(RuntimeError, executor.create_executors, {})
+        self.assertEqual(executor.create_executors(
+            dict(executor_threads=0)), {})
+
+
+class BlockingHandler(RequestHandler):
+    started = threading.Event()
+    release = threading.Event()
+
+    @gen.coroutine
+    def get(self):
+        result = yield self.wait()
+        self.finish(result)
+
+    @blocking
+    def wait(self):
+        self.started.set()
+        self.release.wait(5)
+        return 'done'
+
+
+class BlockingApplication(Application):
+    handlers = [('/', BlockingHandler)]
+
+
+class BlockingHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        BlockingHandler.started.clear()
+        BlockingHandler.release.clear()
+        self.addCleanup(BlockingHandler.release.set)
+        return BlockingApplication(executor_threads=1,
+                                   executor_queue_size=1)
+
+    def tearDown(self):
+        for pool in self._app.executors.values():
+            pool.shutdown(wait=False)
+        super(BlockingHandlerTest, self).tearDown()
+
+    @gen_test
+    def test_full_pool_answers_503(self):
+        first = self.http_client.fetch(self.get_url('/'))
+        # the first request holds the only pending slot
+        while not BlockingHandler.started.is_set():
+            yield gen.Task(self.io_loop.add_timeout, time.time() + 0.01)
+        with self.assertRaises(HTTPError) as context:
+            yield self.http_client.fetch(self.get_url('/'))
+        self.assertEqual(context.exception.code, 503)
+        BlockingHandler.release.set()
+        response = yield first
+        self.assertEqual(response.body, b'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests that `durotar.form.Form` validates through its compiled plan
+exactly like formencode's ``Schema.to_python``.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import unittest
+
+import formencode
+from formencode import validators
+from tornado import httputil
+
+from durotar.form import Form, URL, _ValidationPlan
+
+
+class FakeRequest(object):
+    def __init__(self, body, method='POST'):
+        content_type = 'application/x-www-form-urlencoded'
+        self.method = method
+        self.body = body
+        self.headers = httputil.HTTPHeaders({'Content-Type': content_type})
+        self.body_arguments = {}
+        self.files = {}
+        httputil.parse_body_arguments(content_type, body,
+                                      self.body_arguments, self.files)
+
+
+class FakeHandler(object):
+    settings = {}
+
+    def __init__(self, body):
+        self.request = FakeRequest(body)
+
+
+class SignupForm(Form):
+    name = validators.String(not_empty=True, max=5)
+    age = validators.Int()
+    site = URL()
+    note = validators.String(if_missing=u'none')
+    tags = validators.Set()
+
+
+class KeepExtraForm(SignupForm):
+    filter_extra_fields = False
+
+
+class ContactForm(Form):
+    phone = validators.String(if_missing=None)
+    email = validators.Email(if_missing=None)
+    chained_validators = [validators.RequireIfMissing('email',
+                                                      missing='phone')]
+
+
+BODIES = [
+    b'',
+    b'name=ab&age=3&site=http://a.com/&_xsrf=1',
+    b'name=abcdefg&age=x&site=ftp://a&tags=1&tags=2&extra=3',
+    b'name=ab&age=3&age=4&_xsrf=1&extra=x',
+    b'name=&age=&_xsrf=1&note=given',
+]
+
+
+def validate(form_class, body, plan):
+    form = form_class(FakeHandler(body))
+    if not plan:
+        form._convert_args = form.to_python
+    valid = form.validate()
+    return (valid, form.params,
+            dict((k, unicode(v)) for k, v in form.errors.items()))
+
+
+class ValidationPlanTest(unittest.TestCase):
+    def assertSameResults(self, form_class, bodies):
+        self.assertIsNotNone(form_class._validation_plan())
+        for body in bodies:
+            self.assertEqual(validate(form_class, body, True),
+                             validate(form_class, body, False), body)
+
+    def test_fields(self):
+        self.assertSameResults(SignupForm, BODIES)
+
+    def test_extra_fields(self):
+        self.assertSameResults(KeepExtraForm, BODIES)
+
+    def test_chained_validators(self):
+        self.assertSameResults(ContactForm, [
+            b'phone=123&_xsrf=1',
+            b'email=a@example.com&_xsrf=1',
+            b'email=invalid&_xsrf=1',
+            b'_xsrf=1'])
+
+    def test_unsupported(self):
+        class NotEmptyForm(SignupForm):
+            not_empty = True
+
+        class PreValidatedForm(SignupForm):
+            pre_validators = [validators.String()]
+
+        class MatchForm(Form):
+            password = validators.String()
+            confirm = validators.String()
+            chained_validators = [validators.FieldsMatch('password',
+                                                         'confirm')]
+        self.assertFalse(_ValidationPlan.supports(NotEmptyForm))
+        self.assertIsNone(PreValidatedForm._validation_plan())
+        self.assertIsNone(MatchForm._validation_plan())
+
+    def test_added_field(self):
+        body = b'name=ab&age=3&site=http://a.com/&_xsrf=1&city=x'
+        form = SignupForm(FakeHandler(body))
+        form.add_field('city', validators.Int())
+        self.assertFalse(SignupForm._validation_plan().matches(form))
+        self.assertFalse(form.validate())
+        self.assertIn('city', form.errors)
+        # the class and later forms are unchanged
+        self.assertNotIn('city', SignupForm.fields)
+        form = SignupForm(FakeHandler(body))
+        self.assertTrue(SignupForm._validation_plan().matches(form))
+        self.assertTrue(form.validate())
+
+    def test_plan_errors_are_compound(self):
+        form = SignupForm(FakeHandler(b'age=x'))
+        plan = SignupForm._validation_plan()
+        with self.assertRaises(formencode.Invalid) as cm:
+            plan.to_python(form, form.args)
+        self.assertEqual(sorted(cm.exception.error_dict),
+                         ['_xsrf', 'age', 'name', 'site'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the pooled outbound HTTP client of `durotar.httpclient`."""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import socket
+import unittest
+
+from tornado import gen
+from tornado.httpclient import HTTPError, HTTPResponse
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncTestCase, gen_test
+
+from durotar import httpclient
+from durotar.httpclient import CachingResolver, OutboundClient
+
+
+class FakeClient(object):
+    """Records requests; the test answers them with `respond`."""
+
+    def __init__(self):
+        self.pending = []
+        self.urls = []
+
+    def fetch(self, request, callback):
+        self.urls.append(request.url)
+        self.pending.append((request, callback))
+
+    def respond(self, code=200):
+        request, callback = self.pending.pop(0)
+        callback(HTTPResponse(request, code))
+
+
+class OutboundClientTest(AsyncTestCase):
+    def setUp(self):
+        super(OutboundClientTest, self).setUp()
+        self.client = FakeClient()
+        self.outbound = OutboundClient(self.client, max_per_host=2,
+                                       retries=2, backoff=0.001,
+                                       io_loop=self.io_loop)
+
+    @gen_test
+    def test_per_host_cap(self):
+        futures = [self.outbound.fetch('http://a/%d' % i) for i in range(3)]
+        other = self.outbound.fetch('http://b/')
+        # the third request to a waits for a slot; b has its own
+        self.assertEqual(self.client.urls, ['http://a/0', 'http://a/1',
+                                            'http://b/'])
+        self.client.respond()
+        self.assertEqual(self.client.urls[-1], 'http://a/2')
+        while self.client.pending:
+            self.client.respond()
+        responses = yield futures + [other]
+        self.assertEqual([response.code for response in responses],
+                         [200] * 4)
+        self.assertEqual(self.outbound._active, {})
+
+    @gen_test
+    def test_request_defaults(self):
+        self.outbound.fetch('http://a/', connect_timeout=1)
+        request = self.client.pending[0][0]
+        self.assertEqual(request.connect_timeout, 1)
+        self.assertEqual(request.request_timeout, 20)
+        self.client.respond()
+
+    @gen_test
+    def test_retries_get(self):
+        future = self.outbound.fetch('http://a/')
+        for code in (599, 503):
+            self.client.respond(code)
+            while not self.client.pending:
+                yield gen.moment
+        self.client.respond()
+        response = yield future
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(self.client.urls), 3)
+
+    @gen_test
+    def test_gives_up(self):
+        future = self.outbound.fetch('http://a/')
+        for attempt in range(3):
+            while not self.client.pending:
+                yield gen.moment
+            self.client.respond(500)
+        with self.assertRaises(HTTPError) as context:
+            yield future
+        self.assertEqual(context.exception.code, 500)
+        self.assertEqual(len(self.client.urls), 3)
+
+    @gen_test
+    def test_no_post_retry(self):
+        future = self.outbound.fetch('http://a/', method='POST', body='x')
+        self.client.respond(503)
+        with self.assertRaises(HTTPError):
+            yield future
+        self.assertEqual(len(self.client.urls), 1)
+
+    def test_callback(self):
+        self.outbound.fetch('http://a/', callback=self.stop)
+        self.client.respond(404)
+        # error responses go to the callback instead of raising
+        self.assertEqual(self.wait().code, 404)
+
+
+class FakeResolver(object):
+    def __init__(self):
+        self.calls = 0
+
+    @gen.coroutine
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        self.calls += 1
+        raise gen.Return([(socket.AF_INET, ('127.0.0.1', port))])
+
+
+class CachingResolverTest(AsyncTestCase):
+    @gen_test
+    def test_cache(self):
+        inner = FakeResolver()
+        resolver = CachingResolver(resolver=inner, ttl=60)
+        first = yield resolver.resolve('example.com', 80)
+        second = yield resolver.resolve('example.com', 80)
+        self.assertEqual(first, second)
+        self.assertEqual(inner.calls, 1)
+        yield resolver.resolve('example.com', 443)
+        self.assertEqual(inner.calls, 2)
+
+    @gen_test
+    def test_expiry(self):
+        inner = FakeResolver()
+        resolver = CachingResolver(resolver=inner, ttl=0)
+        yield resolver.resolve('example.com', 80)
+        yield resolver.resolve('example.com', 80)
+        self.assertEqual(inner.calls, 2)
+
+
+class SharedClientTest(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.addCleanup(self.io_loop.close, all_fds=True)
+        self.addCleanup(httpclient.configure, {})
+        self.addCleanup(httpclient._shared_clients.pop, self.io_loop, None)
+
+    def test_defaults(self):
+        httpclient.configure({})
+        client = httpclient.shared_client(self.io_loop)
+        self.addCleanup(client.client.close)
+        self.assertIs(httpclient.shared_client(self.io_loop), client)
+        self.assertEqual(client.max_per_host, 10)
+        self.assertEqual(client.client.max_clients, 50)
+        if httpclient.pycurl is None:
+            self.assertIsInstance(client.client.resolver, CachingResolver)
+
+    def test_settings(self):
+        httpclient.configure(dict(http_max_clients=5, http_max_per_host=2,
+                                  http_dns_ttl=10))
+        client = httpclient.shared_client(self.io_loop)
+        self.addCleanup(client.client.close)
+        self.assertEqual(client.max_per_host, 2)
+        self.assertEqual(client.client.max_clients, 5)
+        if httpclient.pycurl is None:
+            self.assertEqual(client.client.resolver.ttl, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
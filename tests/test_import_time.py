@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Runs ``benchmarks/import_time.py``, which fails when importing a
+Durotar module loads a module Durotar defers to first use.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import os
+import subprocess
+import sys
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_deferred_imports(self):
+        # the budget is generous: a loaded test machine must not fail it,
+        # while an eager import of a deferred module always does
+        script = os.path.join(ROOT, 'benchmarks', 'import_time.py')
+        child = subprocess.Popen(
+            [sys.executable, script, '--repeat=1', '--budget=2000'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = child.communicate()[0].decode('utf-8')
+        self.assertEqual(child.returncode, 0, output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the metrics registry and its Prometheus exposition."""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import unittest
+
+from tornado.ioloop import IOLoop
+
+from durotar.metrics import Registry
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_register_once(self):
+        counter = self.registry.counter('hits_total', 'Hits.')
+        self.assertIs(self.registry.counter('hits_total', 'Hits.'), counter)
+        self.assertRaises(ValueError, self.registry.gauge, 'hits_total',
+                          'Hits.')
+
+    def test_expose(self):
+        requests = self.registry.counter('requests_total', 'Requests.',
+                                         ('route', 'code'))
+        depth = self.registry.gauge('queue_depth', 'Queue depth.')
+        latency = self.registry.histogram('latency_seconds', 'Latency.',
+                                          buckets=(0.1, 1))
+        requests.inc(labels=('home', 200))
+        requests.inc(2, labels=('home', 200))
+        requests.inc(labels=('say "hi"', 500))
+        depth.set(4)
+        depth.dec()
+        for value in (0.05, 0.5, 0.5, 3):
+            latency.observe(value)
+        self.assertEqual(self.registry.expose().splitlines(), [
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 4.05',
+            'latency_seconds_count 4',
+            '# HELP queue_depth Queue depth.',
+            '# TYPE queue_depth gauge',
+            'queue_depth 3',
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{route="home",code="200"} 3',
+            'requests_total{route="say \\"hi\\"",code="500"} 1',
+        ])
+
+    def test_collect_sums_slots(self):
+        io_loop = IOLoop()
+        self.addCleanup(io_loop.close)
+        counter = self.registry.counter('jobs_total', 'Jobs.', ('queue',))
+        latency = self.registry.histogram('job_seconds', 'Job time.',
+                                          buckets=(1,))
+        self.registry.share(2, slot_size=4096)
+        # what two workers would publish into their slots
+        for slot, jobs in ((1, 5), (0, 2)):
+            self.registry.bind(slot, io_loop=io_loop)
+            self.registry._publisher.stop()
+            counter.inc(jobs, labels=('default',))
+            latency.observe(slot)
+            self.registry.publish()
+        collected = self.registry.collect()
+        self.assertEqual(collected['jobs_total'], {('default',): 7})
+        self.assertEqual(collected['job_seconds'], {(): [2, 0, 1.0]})
+        # the process's own values are unchanged
+        self.assertEqual(counter.snapshot(), {('default',): 2})
+
+    def test_bind_needs_share(self):
+        self.assertRaises(RuntimeError, self.registry.bind, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
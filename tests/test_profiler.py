@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the sampling profiler and its handler."""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import json
+import threading
+import time
+import unittest
+
+from tornado.testing import AsyncHTTPTestCase
+
+from durotar.profiler import Sampler
+from durotar.web import Application, RequestHandler
+
+
+def busy(event):
+    while not event.is_set():
+        sum(range(100))
+
+
+class SamplerTest(unittest.TestCase):
+    def test_sample_thread(self):
+        done = threading.Event()
+        thread = threading.Thread(target=busy, args=(done,))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(done.set)
+        sampler = Sampler(interval=0.001, thread_id=thread.ident)
+        sampler.start()
+        while sampler.samples < 5:
+            time.sleep(0.005)
+        sampler.stop()
+        self.assertFalse(sampler.running)
+        lines = sampler.collapsed().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('route:-;'))
+            self.assertIn('busy (', stack)
+            self.assertGreater(int(count), 0)
+        sampler.reset()
+        self.assertEqual((sampler.samples, sampler.collapsed()), (0, '\n'))
+
+    def test_unknown_thread(self):
+        sampler = Sampler(thread_id=-1)
+        sampler.sample()
+        self.assertEqual(sampler.samples, 0)
+
+
+class SampledHandler(RequestHandler):
+    def get(self):
+        # samples the IOLoop thread running this handler
+        self.application.profiler.sample()
+        self.finish('ok')
+
+
+class ProfiledApplication(Application):
+    handlers = [('/sampled', SampledHandler)]
+
+
+class ProfilerHandlerTest(AsyncHTTPTestCase):
+    settings = dict(profiler_url='/_profile', profiler_max_seconds=0.05)
+
+    def get_app(self):
+        return ProfiledApplication(**self.settings)
+
+    def post(self, body, headers=None):
+        return self.fetch('/_profile', method='POST', body=body,
+                          headers=headers)
+
+    def test_route_tagging(self):
+        self.assertEqual(self.fetch('/sampled').body, b'ok')
+        response = self.fetch('/_profile')
+        self.assertEqual(response.headers['X-Profiler-Samples'], '1')
+        self.assertTrue(response.body.startswith(b'route:SampledHandler;'))
+
+    def test_bad_seconds(self):
+        self.assertEqual(self.fetch('/_profile?seconds=soon').code, 400)
+
+    def test_seconds_clamped(self):
+        start = time.time()
+        response = self.fetch('/_profile?seconds=3600')
+        self.assertEqual(response.code, 200)
+        self.assertLess(time.time() - start, 2)
+        self.assertFalse(self._app.profiler.running)
+
+    def test_post_needs_xsrf(self):
+        self.assertEqual(self.post('action=start').code, 403)
+        self.assertFalse(self._app.profiler.running)
+        response = self.post('action=start', headers={
+            'Cookie': '_xsrf=1', 'X-XSRFToken': '1'})
+        self.addCleanup(self._app.profiler.stop)
+        self.assertEqual(json.loads(response.body.decode())['running'], True)
+        self.assertEqual(self.post('action=pause', headers={
+            'Cookie': '_xsrf=1', 'X-XSRFToken': '1'}).code, 400)
+
+
+class ProfilerAllowTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return ProfiledApplication(profiler_url='/_profile',
+                                   profiler_allow=('10.0.0.1',))
+
+    def test_forbidden(self):
+        self.assertEqual(self.fetch('/_profile').code, 403)
+
+
+if __name__ == '__main__':
+    unittest.main()
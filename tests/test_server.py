@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the ``durotar`` prefork server."""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    import urllib2 as urllib_request  # py2
+except ImportError:
+    import urllib.request as urllib_request  # py3
+
+from tornado import netutil
+
+from durotar.server import Server, bind_reuseport_sockets, load_settings
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SITE = """
+import os
+import durotar.web
+
+
+class PidHandler(durotar.web.RequestHandler):
+    def get(self):
+        self.finish(str(os.getpid()))
+
+
+class Application(durotar.web.Application):
+    handlers = [('/', PidHandler)]
+"""
+
+SETTINGS = """
+import os
+
+application = 'serversite.Application'
+greeting = 'hello'
+_private = 1
+"""
+
+
+def unused_port():
+    sock = netutil.bind_sockets(0, '127.0.0.1')[0]
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class SettingsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'serversettings.py'), 'w') as f:
+            f.write(SETTINGS)
+        sys.path.insert(0, self.tmpdir)
+        self.addCleanup(sys.path.remove, self.tmpdir)
+
+    def test_load_settings(self):
+        self.assertEqual(load_settings('serversettings'), dict(
+            application='serversite.Application', greeting='hello'))
+        self.assertEqual(load_settings(None), {})
+
+
+class SlotTest(unittest.TestCase):
+    def test_generations_use_distinct_slots(self):
+        server = Server(workers=2, task_workers=1)
+        first = server._slots()
+        server._generation += 1
+        second = server._slots()
+        self.assertEqual(first, [0, 1, 4])
+        self.assertEqual(second, [2, 3, 5])
+        self.assertEqual([server._is_task_slot(slot) for slot in first],
+                         [False, False, True])
+        self.assertFalse(server._is_task_slot(None))
+
+
+@unittest.skipIf(not hasattr(socket, 'SO_REUSEPORT'), "no SO_REUSEPORT")
+class ReusePortTest(unittest.TestCase):
+    def test_bind_twice(self):
+        port = unused_port()
+        first = bind_reuseport_sockets(port, '127.0.0.1')
+        second = bind_reuseport_sockets(port, '127.0.0.1')
+        for sock in first + second:
+            self.assertEqual(sock.getsockname()[1], port)
+            sock.close()
+
+
+@unittest.skipIf(not hasattr(os, 'fork'), "needs fork")
+class ServeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for name, source in (('serversite.py', SITE),
+                             ('serversettings.py', SETTINGS)):
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write(source)
+        self.port = unused_port()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT, env.get('PYTHONPATH', '')]).rstrip(os.pathsep)
+        with open(os.devnull, 'w') as devnull:
+            self.master = subprocess.Popen(
+                [sys.executable, '-m', 'durotar.server',
+                 '--settings=serversettings', '--port=%d' % self.port,
+                 '--address=127.0.0.1', '--workers=2',
+                 '--graceful_timeout=2'],
+                cwd=self.tmpdir, env=env, stdout=devnull, stderr=devnull)
+        self.addCleanup(self.kill)
+
+    def kill(self):
+        if self.master.poll() is None:
+            self.master.kill()
+            self.master.wait()
+
+    def fetch(self, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return urllib_request.urlopen(
+                    'http://127.0.0.1:%d/' % self.port, timeout=1).read()
+            except Exception:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def worker_pids(self, count=20):
+        return set(self.fetch() for i in range(count))
+
+    def test_reload_and_stop(self):
+        before = self.worker_pids()
+        self.assertNotIn(str(self.master.pid).encode(), before)
+        self.master.send_signal(signal.SIGHUP)
+        # the new generation takes over
+        deadline = time.time() + 10
+        while self.worker_pids() & before:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.1)
+        self.master.send_signal(signal.SIGTERM)
+        deadline = time.time() + 10
+        while self.master.poll() is None:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        self.assertEqual(self.master.returncode, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the session stores of `durotar.session`."""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from durotar.session import (CachedSessionStore, MemorySessionStore,
+                             SQLiteSessionStore, Session)
+
+
+class StoreTests(object):
+    """Behaviour every `SessionStore` shares."""
+
+    def create_store(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.store = self.create_store()
+
+    def test_save_load(self):
+        self.assertIsNone(self.store.load('a'))
+        self.store.save('a', {'user': 1, 'tags': ['x']}, 60)
+        self.assertEqual(self.store.load('a'), {'user': 1, 'tags': ['x']})
+        self.store.save('a', {'user': 2}, 60)
+        self.assertEqual(self.store.load('a'), {'user': 2})
+
+    def test_delete(self):
+        self.store.save('a', {'user': 1}, 60)
+        self.store.delete('a')
+        self.store.delete('missing')
+        self.assertIsNone(self.store.load('a'))
+
+    def test_expiry(self):
+        self.store.save('old', {'user': 1}, -1)
+        self.store.save('new', {'user': 2}, 60)
+        self.assertIsNone(self.store.load('old'))
+        self.store.purge()
+        self.assertEqual(self.store.load('new'), {'user': 2})
+
+
+class MemorySessionStoreTest(StoreTests, unittest.TestCase):
+    def create_store(self):
+        return MemorySessionStore()
+
+    def test_max_size(self):
+        store = MemorySessionStore(max_size=2)
+        store.save('a', {}, 60)
+        store.save('b', {}, 60)
+        store.load('a')
+        store.save('c', {}, 60)
+        # the least recently used session is dropped
+        self.assertIsNone(store.load('b'))
+        self.assertEqual(store.load('a'), {})
+        self.assertEqual(store.load('c'), {})
+
+
+class SQLiteSessionStoreTest(StoreTests, unittest.TestCase):
+    def create_store(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        return SQLiteSessionStore(os.path.join(self.tmpdir, 'sessions.db'))
+
+    def test_shared_file(self):
+        self.store.save('a', {'user': 1}, 60)
+        other = SQLiteSessionStore(self.store.path)
+        self.assertEqual(other.load('a'), {'user': 1})
+
+
+class CachedSessionStoreTest(StoreTests, unittest.TestCase):
+    def create_store(self):
+        self.backend = MemorySessionStore()
+        return CachedSessionStore(self.backend, ttl=60)
+
+    def test_read_through(self):
+        self.backend.save('a', {'user': 1}, 60)
+        self.assertEqual(self.store.load('a'), {'user': 1})
+        # changed by another worker: stale until invalidated
+        self.backend.save('a', {'user': 2}, 60)
+        self.assertEqual(self.store.load('a'), {'user': 1})
+        self.store.invalidate('a')
+        self.assertEqual(self.store.load('a'), {'user': 2})
+        self.backend.save('a', {'user': 3}, 60)
+        self.store.invalidate(None)
+        self.assertEqual(self.store.load('a'), {'user': 3})
+
+    def test_writes_go_through(self):
+        self.store.save('a', {'user': 1}, 60)
+        self.assertEqual(self.backend.load('a'), {'user': 1})
+        self.store.delete('a')
+        self.assertIsNone(self.backend.load('a'))
+
+    def test_cache_ttl(self):
+        store = CachedSessionStore(self.backend, ttl=0.01)
+        self.backend.save('a', {'user': 1}, 60)
+        store.load('a')
+        self.backend.save('a', {'user': 2}, 60)
+        time.sleep(0.02)
+        self.assertEqual(store.load('a'), {'user': 2})
+
+
+class SessionTest(unittest.TestCase):
+    def test_modified(self):
+        sess = Session('a', {'user': 1})
+        self.assertFalse(sess.modified)
+        sess.get('user')
+        self.assertFalse(sess.modified)
+        sess.setdefault('cart', [])
+        self.assertTrue(sess.modified)
+
+    def test_regenerate(self):
+        sess = Session('a', {'user': 1})
+        sess.regenerate()
+        self.assertEqual(sess.discarded_sid, 'a')
+        self.assertIsNone(sess.sid)
+        self.assertTrue(sess.modified)
+        self.assertEqual(sess, {'user': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
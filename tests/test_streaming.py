@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the incremental body parsers of `durotar.streaming`."""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import unittest
+
+import tornado.web
+
+from durotar.streaming import StreamedBody
+
+
+MULTIPART = (b'preamble\r\n'
+             b'--XyZ\r\n'
+             b'Content-Disposition: form-data; name="title"\r\n\r\n'
+             b'hello\r\nworld\r\n'
+             b'--XyZ\r\n'
+             b'Content-Disposition: form-data; name="photo"; '
+             b'filename="a.png"\r\n'
+             b'Content-Type: image/png\r\n\r\n' +
+             b'\x89PNG' * 100 + b'\r\n'
+             b'--XyZ\r\n'
+             b'Content-Disposition: form-data; name="title"\r\n\r\n'
+             b'\r\n'
+             b'--XyZ--\r\n'
+             b'epilogue')
+
+
+def feed(body, data, size):
+    for i in range(0, len(data), size):
+        body.feed(data[i:i + size])
+    body.finish()
+    return body
+
+
+class UrlencodedTest(unittest.TestCase):
+    def parse(self, data, size, **kwargs):
+        return feed(StreamedBody('application/x-www-form-urlencoded',
+                                 **kwargs), data, size)
+
+    def test_chunks(self):
+        data = b'a=1&b=x+y&a=%E4%BD%A0&empty=&c=3'
+        for size in (1, 2, 5, len(data)):
+            body = self.parse(data, size)
+            self.assertEqual(body.arguments, {
+                'a': ['1', '\xe4\xbd\xa0'], 'b': ['x y'], 'empty': [''],
+                'c': ['3']})
+
+    def test_fields_size(self):
+        self.parse(b'a=12345', 3, max_fields_size=10)
+        self.assertRaises(tornado.web.HTTPError, self.parse,
+                          b'a=12345&b=67890', 3, max_fields_size=10)
+
+    def test_unterminated_field_size(self):
+        # a field without '&' must not grow the buffer past the limit
+        body = StreamedBody('application/x-www-form-urlencoded',
+                            max_fields_size=10)
+        body.feed(b'a=' + b'x' * 20)
+        with self.assertRaises(tornado.web.HTTPError) as cm:
+            body.finish()
+        self.assertEqual(cm.exception.status_code, 413)
+
+
+class MultipartTest(unittest.TestCase):
+    content_type = 'multipart/form-data; boundary="XyZ"'
+
+    def parse(self, data, size, **kwargs):
+        return feed(StreamedBody(self.content_type, **kwargs), data, size)
+
+    def test_chunks(self):
+        for size in (1, 3, 7, 64, len(MULTIPART)):
+            body = self.parse(MULTIPART, size, spool_size=100)
+            self.assertEqual(body.arguments,
+                             {'title': [b'hello\r\nworld', b'']})
+            upload = body.files['photo'][0]
+            self.assertEqual(upload.filename, 'a.png')
+            self.assertEqual(upload.content_type, 'image/png')
+            self.assertEqual(upload.size, 400)
+            self.assertEqual(upload.file.read(), b'\x89PNG' * 100)
+            body.close()
+
+    def test_missing_boundary(self):
+        self.assertRaises(tornado.web.HTTPError, StreamedBody,
+                          'multipart/form-data')
+
+    def test_truncated(self):
+        self.assertRaises(tornado.web.HTTPError, self.parse,
+                          MULTIPART[:-20], 10)
+
+    def test_invalid_disposition(self):
+        data = (b'--XyZ\r\nContent-Disposition: attachment\r\n\r\n'
+                b'x\r\n--XyZ--\r\n')
+        self.assertRaises(tornado.web.HTTPError, self.parse, data, 10)
+
+    def test_boundary_line_size(self):
+        body = StreamedBody(self.content_type)
+        body.feed(b'--XyZ' + b' ' * 2000)
+        with self.assertRaises(tornado.web.HTTPError) as cm:
+            body.finish()
+        self.assertEqual(cm.exception.status_code, 400)
+
+    def test_fields_size(self):
+        with self.assertRaises(tornado.web.HTTPError) as cm:
+            self.parse(MULTIPART, 5, max_fields_size=8)
+        self.assertEqual(cm.exception.status_code, 413)
+
+
+class SpoolTest(unittest.TestCase):
+    def test_other_content_type(self):
+        body = feed(StreamedBody('application/octet-stream', spool_size=4),
+                    b'0123456789', 3)
+        self.assertEqual(body.arguments, {})
+        self.assertEqual(body.body_file.read(), b'0123456789')
+        body.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
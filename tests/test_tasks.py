@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests the task queue of `durotar.tasks` against a fake connection."""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import contextlib
+import json
+import unittest
+
+from tornado import gen
+from tornado.log import app_log
+from tornado.testing import AsyncTestCase, ExpectLog, gen_test
+
+from durotar import tasks
+from durotar.tornpg import Row
+
+
+class FakeDB(object):
+    """Records statements; ``lost_locks`` holds the ids of tasks claimed
+    again by another worker.
+    """
+
+    def __init__(self):
+        self.log = []
+        self.batches = []
+        self.lost_locks = set()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.log.append('BEGIN')
+        yield
+        self.log.append('COMMIT')
+
+    def query(self, query, *parameters):
+        self.log.append(query.split()[0])
+        return self.batches.pop(0) if self.batches else []
+
+    def execute(self, query, *parameters):
+        self.log.append((query.split()[0],) + parameters)
+
+    def executemany(self, query, parameters):
+        self.log.append((query.split()[0], list(parameters)))
+
+    def execute_rowcount(self, query, task_id, attempts):
+        self.log.append(('LOCK', task_id))
+        return 0 if task_id in self.lost_locks else 1
+
+    def notify(self, channel, payload):
+        self.log.append(('NOTIFY', channel, payload))
+
+    def listen(self, channel, callback, io_loop=None):
+        pass
+
+    def unlisten(self, channel, callback, io_loop=None):
+        pass
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+def row(task_id, name, args=(), attempts=1):
+    return Row(id=task_id, name=name, args=json.dumps([list(args), {}]),
+               attempts=attempts)
+
+
+class TaskWorkerTest(AsyncTestCase):
+    def setUp(self):
+        super(TaskWorkerTest, self).setUp()
+        self.db = FakeDB()
+        self.worker = tasks.TaskWorker(self.db, batch_size=2,
+                                       io_loop=self.io_loop)
+        self.runs = []
+        self.register('test.record', self.record)
+        self.register('test.fail', self.fail, max_attempts=2)
+
+    def register(self, name, fn, **kwargs):
+        tasks.task(name, **kwargs)(fn)
+        self.addCleanup(tasks._tasks.pop, name)
+
+    def record(self, value):
+        # what the worker has done to the table when the task runs
+        self.runs.append((value, list(self.db.log)))
+
+    def fail(self):
+        raise ValueError("boom")
+
+    def deleted(self, log=None):
+        return [entry[1] for entry in (log or self.db.log)
+                if entry[0] == 'DELETE']
+
+    @gen_test
+    def test_deletes_each_finished_task(self):
+        yield self.worker._run_batch([row(1, 'test.record', ['a']),
+                                      row(2, 'test.record', ['b'])])
+        self.assertEqual([value for value, log in self.runs], ['a', 'b'])
+        # the first task is gone before the second one runs
+        self.assertEqual(self.deleted(self.runs[1][1]), [1])
+        self.assertEqual(self.deleted(), [1, 2])
+
+    @gen_test
+    def test_skips_task_claimed_again(self):
+        self.db.lost_locks.add(1)
+        with ExpectLog(app_log, "Task test.record \\(1\\) was claimed"):
+            yield self.worker._run_batch([row(1, 'test.record', ['a']),
+                                          row(2, 'test.record', ['b'])])
+        self.assertEqual([value for value, log in self.runs], ['b'])
+        self.assertEqual(self.deleted(), [2])
+
+    @gen_test
+    def test_failures(self):
+        with ExpectLog(app_log, "Task test"):
+            yield self.worker._run_batch([row(1, 'test.fail', attempts=1),
+                                          row(2, 'test.fail', attempts=2),
+                                          row(3, 'test.unknown')])
+        self.assertEqual(self.deleted(), [])
+        updates = [entry for entry in self.db.log if entry[0] == 'UPDATE']
+        self.assertEqual([entry[2] for entry in updates], [1, 2, 3])
+        self.assertIn("ValueError", updates[0][1])
+        self.assertIn("LookupError", updates[2][1])
+
+    def test_retry_delay(self):
+        t = tasks.Task(noop, 'test.delay', backoff=10, max_backoff=60)
+        self.assertEqual([t.retry_delay(n) for n in (1, 2, 3, 4)],
+                         [10, 20, 40, 60])
+
+    @gen_test
+    def test_drain(self):
+        self.db.batches = [[row(1, 'test.record', ['a']),
+                            row(2, 'test.record', ['b'])],
+                           [row(3, 'test.record', ['c'])]]
+        self.worker.start()
+        # a full batch is followed by another claim
+        while len(self.runs) < 3:
+            yield gen.moment
+        yield self.worker.stop()
+        self.assertEqual([value for value, log in self.runs],
+                         ['a', 'b', 'c'])
+        self.assertEqual(self.deleted(), [1, 2, 3])
+
+
+class EnqueueTest(unittest.TestCase):
+    def test_enqueue_many(self):
+        db = FakeDB()
+        t = tasks.Task(noop, 'test.send', queue='mail')
+        tasks.enqueue_many(db, t, [((1,), None), ((2,), {'x': 3})])
+        self.assertEqual(db.log[0], 'BEGIN')
+        self.assertEqual(db.log[1], ('INSERT', [
+            ('mail', 'test.send', json.dumps([[1], {}])),
+            ('mail', 'test.send', json.dumps([[2], {'x': 3}]))]))
+        self.assertEqual(db.log[2:], [('NOTIFY', tasks.CHANNEL, 'mail'),
+                                      'COMMIT'])
+
+    def test_enqueue_nothing(self):
+        db = FakeDB()
+        tasks.enqueue_many(db, tasks.Task(noop, 'test.send'), [])
+        self.assertEqual(db.log, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
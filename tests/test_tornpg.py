@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests `durotar.tornpg` against fake psycopg2 connections."""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import logging
+import os
+import time
+import unittest
+
+import psycopg2
+import psycopg2.extensions
+
+from tornado import gen
+from tornado.log import gen_log
+from tornado.testing import (AsyncHTTPTestCase, AsyncTestCase, ExpectLog,
+    gen_test)
+
+from durotar import tornpg
+from durotar import web
+from durotar.web import Application, RequestHandler
+
+
+IDLE = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+INTRANS = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+
+class FakeCursor(object):
+    description = [('x',)]
+    rowcount = 1
+    lastrowid = None
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, parameters=None):
+        conn = self.conn
+        conn.log.append(query)
+        if conn.lost:
+            conn.closed = 2
+            raise tornpg.OperationalError("server closed the connection")
+        if query == 'CANCELED':
+            raise tornpg.QueryCanceledError("statement timeout")
+        if query == 'DUPLICATE':
+            raise tornpg.IntegrityError("duplicate key")
+        if not conn.autocommit:
+            conn.status = INTRANS
+
+    def __iter__(self):
+        return iter([(1,)])
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """Records statements, commits and rollbacks in a shared ``log``."""
+
+    def __init__(self, log):
+        self.log = log
+        self.closed = 0
+        self.lost = False
+        self.status = IDLE
+        self._autocommit = False
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        # like psycopg2, which refuses it inside a transaction
+        assert self.status == IDLE
+        self._autocommit = value
+
+    def get_transaction_status(self):
+        assert not self.closed
+        return self.status
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.log.append('COMMIT')
+        self.status = IDLE
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+        self.status = IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionTestCase(unittest.TestCase):
+    autocommit = True
+
+    def setUp(self):
+        self.log = []
+        self.connections = []
+        self.refuse = False
+        connect = tornpg.psycopg2.connect
+
+        def fake_connect(**kwargs):
+            if self.refuse:
+                raise tornpg.OperationalError("connection refused")
+            conn = FakeConnection(self.log)
+            self.connections.append(conn)
+            return conn
+        tornpg.psycopg2.connect = fake_connect
+        self.addCleanup(setattr, tornpg.psycopg2, 'connect', connect)
+        self.db = tornpg.Connection('localhost', 'test', keepalives_idle=0,
+                                    autocommit=self.autocommit,
+                                    reconnect_backoff=0.01,
+                                    max_reconnect_backoff=0.01)
+        self.addCleanup(self.db.close)
+
+
+class TransactionTest(ConnectionTestCase):
+    autocommit = False
+
+    def test_commit(self):
+        with self.db.transaction():
+            self.assertEqual(self.db.transaction_depth, 1)
+            self.db.execute('INSERT 1')
+        self.assertEqual(self.log, ['INSERT 1', 'COMMIT'])
+        self.assertEqual(self.db.transaction_depth, 0)
+        self.assertFalse(self.db.in_transaction)
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.execute('INSERT 1')
+                raise ValueError()
+        self.assertEqual(self.log, ['INSERT 1', 'ROLLBACK'])
+        self.assertEqual(self.db.transaction_depth, 0)
+
+    def test_savepoint(self):
+        with self.db.transaction():
+            self.db.execute('INSERT 1')
+            try:
+                with self.db.savepoint():
+                    self.db.execute('DUPLICATE')
+            except tornpg.IntegrityError:
+                pass
+            with self.db.transaction():
+                self.assertEqual(self.db.transaction_depth, 2)
+                self.db.execute('INSERT 2')
+        self.assertEqual(self.log, [
+            'INSERT 1',
+            'SAVEPOINT durotar_savepoint_1', 'DUPLICATE',
+            'ROLLBACK TO SAVEPOINT durotar_savepoint_1',
+            'SAVEPOINT durotar_savepoint_1', 'INSERT 2',
+            'RELEASE SAVEPOINT durotar_savepoint_1',
+            'COMMIT'])
+
+    def test_savepoint_outside_of_transaction(self):
+        with self.db.savepoint():
+            self.db.execute('INSERT 1')
+        self.assertEqual(self.log, ['INSERT 1', 'COMMIT'])
+
+    def test_implicit_transaction(self):
+        self.db.query('SELECT 1')
+        self.assertTrue(self.db.in_transaction)
+        self.assertFalse(self.db.pending_transaction)
+        self.db.execute('INSERT 1')
+        self.assertTrue(self.db.pending_transaction)
+        self.db.commit()
+        self.assertFalse(self.db.in_transaction)
+        self.assertFalse(self.db.pending_transaction)
+
+    def test_transaction_after_reads(self):
+        self.db.query('SELECT 1')
+        with self.db.transaction():
+            self.db.execute('INSERT 1')
+        # the reads' transaction is not joined
+        self.assertEqual(self.log, ['SELECT 1', 'ROLLBACK', 'INSERT 1',
+                                    'COMMIT'])
+
+    def test_transaction_refuses_uncommitted_writes(self):
+        self.db.execute('INSERT 1')
+        with self.assertRaises(tornpg.TransactionOpen):
+            with self.db.transaction():
+                self.db.execute('INSERT 2')
+        self.assertEqual(self.log, ['INSERT 1'])
+        self.assertEqual(self.db.transaction_depth, 0)
+        self.db.rollback()
+        with self.db.transaction():
+            self.db.execute('INSERT 2')
+        self.assertEqual(self.log[1:], ['ROLLBACK', 'INSERT 2', 'COMMIT'])
+
+
+class AutocommitTransactionTest(ConnectionTestCase):
+    def test_default(self):
+        self.assertTrue(tornpg.Connection('localhost', 'test').autocommit)
+
+    def test_statements_commit_at_once(self):
+        self.db.execute('INSERT 1')
+        self.assertFalse(self.db.in_transaction)
+        self.assertFalse(self.db.pending_transaction)
+
+    def test_transaction_begun_by_hand(self):
+        self.connections[-1].status = INTRANS
+        self.assertTrue(self.db.pending_transaction)
+        with self.assertRaises(tornpg.TransactionOpen):
+            with self.db.transaction():
+                pass
+
+    def test_transaction_restores_autocommit(self):
+        conn = self.connections[-1]
+        with self.db.transaction():
+            self.assertFalse(conn.autocommit)
+            self.db.execute('INSERT 1')
+            self.assertTrue(self.db.in_transaction)
+        self.assertTrue(conn.autocommit)
+        self.assertEqual(self.log, ['INSERT 1', 'COMMIT'])
+
+
+
+class RetryTest(ConnectionTestCase):
+    def test_select_retried_on_new_connection(self):
+        self.connections[-1].lost = True
+        self.assertEqual(self.db.query('SELECT 1'), [{'x': 1}])
+        self.assertEqual(len(self.connections), 2)
+
+    def test_write_not_retried(self):
+        self.connections[-1].lost = True
+        self.assertRaises(tornpg.OperationalError, self.db.execute,
+                          'INSERT 1')
+        self.assertEqual(len(self.connections), 1)
+
+    def test_canceled_query_keeps_connection(self):
+        conn = self.connections[-1]
+        self.assertRaises(tornpg.QueryCanceledError, self.db.query,
+                          'CANCELED')
+        self.assertEqual(len(self.connections), 1)
+        self.assertIs(self.db._db, conn)
+
+    def test_select_in_transaction_not_retried(self):
+        with self.assertRaises(tornpg.OperationalError):
+            with self.db.transaction():
+                self.db.execute('INSERT 1')
+                self.connections[-1].lost = True
+                self.db.query('SELECT 1')
+        self.assertEqual(len(self.connections), 1)
+
+    def test_reconnect_without_ioloop(self):
+        self.connections[-1].lost = True
+        self.refuse = True
+        self.assertRaises(tornpg.OperationalError, self.db.query, 'SELECT 1')
+        # the background attempt is pending
+        self.assertRaises(tornpg.NotConnected, self.db.query, 'SELECT 1')
+        self.refuse = False
+        # no IOLoop runs here: once the attempt is overdue, the next
+        # statement makes it
+        time.sleep(0.02)
+        self.assertEqual(self.db.query('SELECT 1'), [{'x': 1}])
+        self.assertEqual(len(self.connections), 2)
+        self.assertIsNone(self.db._reconnect_timeout)
+
+    def test_probe(self):
+        self.db._last_use_time = time.time() - 60
+        self.db._probe(30)
+        self.assertIn('SELECT 1', self.log)
+        self.connections[-1].lost = True
+        with ExpectLog(logging.getLogger(), "Lost connection"):
+            self.db._probe(30)
+        self.assertIsNone(self.db._db)
+        self.assertIsNotNone(self.db._reconnect_timeout)
+
+
+class ImplicitTransactionRetryTest(RetryTest):
+    autocommit = False
+
+    def test_select_after_reads_retried(self):
+        self.db.query('SELECT 1')
+        self.connections[-1].lost = True
+        self.assertEqual(self.db.query('SELECT 2'), [{'x': 1}])
+        self.assertEqual(len(self.connections), 2)
+
+    def test_select_after_writes_not_retried(self):
+        self.db.execute('INSERT 1')
+        self.connections[-1].lost = True
+        self.assertRaises(tornpg.OperationalError, self.db.query,
+                          'SELECT 1')
+        self.assertEqual(len(self.connections), 1)
+
+    def test_probe_ends_reads(self):
+        self.db.query('SELECT 1')
+        self.db._last_use_time = time.time() - 60
+        self.db._probe(30)
+        self.assertEqual(self.log, ['SELECT 1', 'SELECT 1', 'ROLLBACK'])
+        self.assertFalse(self.db.in_transaction)
+
+    def test_probe_skips_writes(self):
+        self.db.execute('INSERT 1')
+        self.db._last_use_time = time.time() - 60
+        self.db._probe(30)
+        self.assertEqual(self.log, ['INSERT 1'])
+        self.assertTrue(self.db.pending_transaction)
+
+
+class LatencyTest(ConnectionTestCase):
+    def test_latency(self):
+        self.assertEqual(self.db.latency, 0)
+        self.db._observe(0.5)
+        self.db._observe(0.5)
+        self.assertAlmostEqual(self.db.latency, 0.18, places=2)
+        self.db.query('SELECT 1')
+        self.assertLess(self.db.latency, 0.18)
+        # decays while no statement runs
+        self.db._latency_time -= 10
+        self.assertLess(self.db.latency, 0.001)
+
+
+class LeakHandler(RequestHandler):
+    def get(self):
+        db = self.application.db
+        if self.get_argument('write', None):
+            db.execute('INSERT 1')
+        else:
+            db.query('SELECT 1')
+        self.finish('ok')
+
+
+class LeakApplication(Application):
+    handlers = [('/', LeakHandler)]
+
+    def _connect_db(self, config):
+        self.db = self.settings['test_db']
+
+
+class OpenTransactionTest(AsyncHTTPTestCase, ConnectionTestCase):
+    autocommit = False
+
+    def get_app(self):
+        return LeakApplication(test_db=self.db)
+
+    def reported(self):
+        return web._OPEN_TRANSACTIONS.snapshot().get(('LeakHandler',), 0)
+
+    def test_reads_not_reported(self):
+        before = self.reported()
+        self.fetch('/')
+        self.assertTrue(self.db.in_transaction)
+        self.assertEqual(self.reported(), before)
+
+    def test_uncommitted_write_reported(self):
+        before = self.reported()
+        with ExpectLog(gen_log, "LeakHandler finished with a database "
+                       "transaction open"):
+            self.fetch('/?write=1')
+        self.assertEqual(self.reported(), before + 1)
+
+
+class FakeListenerConnection(object):
+    """Polls a pipe; writing to it makes ``poll`` fail once ``lost``."""
+
+    def __init__(self, log):
+        self.log = log
+        self.closed = 0
+        self.lost = False
+        self.notifies = []
+        self._read, self._write = os.pipe()
+
+    def set_isolation_level(self, level):
+        pass
+
+    def fileno(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        return self._read
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.log.append(statement)
+
+    def poll(self):
+        os.read(self._read, 1)
+        if self.lost:
+            self.closed = 2
+            raise tornpg.OperationalError("server closed the connection")
+
+    def close(self):
+        self.closed = 1
+        os.close(self._read)
+        os.close(self._write)
+
+
+class ListenerTest(AsyncTestCase):
+    def setUp(self):
+        super(ListenerTest, self).setUp()
+        self.log = []
+        self.conns = []
+        connect = tornpg.psycopg2.connect
+        tornpg.psycopg2.connect = self.connect
+        self.addCleanup(setattr, tornpg.psycopg2, 'connect', connect)
+        self.listener = tornpg.Listener({'host': 'localhost'},
+                                        io_loop=self.io_loop,
+                                        reconnect_interval=0.01)
+
+    def tearDown(self):
+        # before the IOLoop closes the handler fds
+        self.listener.close()
+        super(ListenerTest, self).tearDown()
+
+    def connect(self, **kwargs):
+        conn = FakeListenerConnection(self.log)
+        self.conns.append(conn)
+        return conn
+
+    @gen_test
+    def test_reconnect_after_closed_connection(self):
+        payloads = []
+        self.listener.subscribe('jobs', payloads.append)
+        self.assertEqual(self.log, ['LISTEN "jobs"'])
+        conn = self.conns[0]
+        conn.lost = True
+        with ExpectLog(logging.getLogger(),
+                       "Listener connection to Postgresql lost"):
+            os.write(conn._write, b'x')
+            while not payloads:
+                yield gen.moment
+        # the closed connection was unregistered and closed
+        self.assertEqual(conn.closed, 1)
+        self.assertEqual(len(self.conns), 2)
+        self.assertEqual(self.log, ['LISTEN "jobs"'] * 2)
+        self.assertEqual(payloads, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
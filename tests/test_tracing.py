@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Stoneopus Technologies Co., Ltd.
+# <http://stoneopus.com>
+
+"""Tests request tracing: spans, their propagation across callbacks and
+the web, tornpg and auth hooks.
+"""
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+import functools
+import unittest
+
+import psycopg2.extensions
+from tornado import gen, stack_context
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase
+
+from durotar import tracing
+from durotar.auth import _auth_fetch
+from durotar.web import Application, RequestHandler
+
+
+class RequestTraceTest(unittest.TestCase):
+    def test_summary(self):
+        trace = tracing.RequestTrace('home')
+        trace.add_span('db', 10.0, 10.002)
+        trace.add_span('render', 10.002, 10.012)
+        trace.add_span('db', 10.012, 10.015)
+        trace.start_span('unfinished')
+        self.assertEqual([(name, count, round(total, 6))
+                          for name, count, total in trace.summary()],
+                         [('db', 2, 0.005), ('render', 1, 0.01)])
+        self.assertEqual(trace.server_timing(),
+                         'db;dur=5.00;desc="2x", render;dur=10.00')
+        self.assertEqual(trace.log_fields(),
+                         'db=5.00ms/2 render=10.00ms/1')
+
+    def test_span_finishes_once(self):
+        span = tracing.Span('db', start=1.0)
+        span.finish(2.0)
+        span.finish(5.0)
+        self.assertEqual(span.duration, 1.0)
+
+    def test_sampling(self):
+        self.assertIsNone(tracing.Tracer(0).begin('home'))
+        self.assertFalse(tracing.Tracer(0).enabled)
+        self.assertEqual(tracing.Tracer(1).begin('home').name, 'home')
+
+    def test_untraced_spans(self):
+        self.assertIsNone(tracing.current())
+        with tracing.span('db') as span:
+            pass
+        self.assertIs(span, tracing.start_span('auth'))
+
+
+class PropagationTest(AsyncTestCase):
+    def test_stack_context(self):
+        trace = tracing.RequestTrace('home')
+        seen = []
+
+        def callback():
+            seen.append(tracing.current())
+            with tracing.span('later'):
+                pass
+            self.stop()
+        with stack_context.StackContext(
+                functools.partial(tracing.activate, trace)):
+            self.io_loop.add_callback(callback)
+        self.assertIsNone(tracing.current())
+        self.wait()
+        self.assertEqual(seen, [trace])
+        self.assertEqual([span.name for span in trace.spans], ['later'])
+
+
+class TracedHandler(RequestHandler):
+    @gen.coroutine
+    def get(self):
+        yield gen.Task(IOLoop.current().add_callback)
+        with tracing.span('work'):
+            pass
+        self.finish('ok')
+
+
+class TracedApplication(Application):
+    handlers = [('/', TracedHandler)]
+
+
+class WebTracingTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.exported = []
+        return TracedApplication(
+            trace_sample_rate=1, trace_server_timing=True,
+            trace_exporter=lambda handler, trace:
+                self.exported.append(trace))
+
+    def test_traced_request(self):
+        response = self.fetch('/')
+        self.assertEqual(response.body, b'ok')
+        timing = response.headers['Server-Timing']
+        self.assertIn('route;dur=', timing)
+        self.assertIn('work;dur=', timing)
+        self.assertEqual(len(self.exported), 1)
+        self.assertEqual(self.exported[0].name, 'TracedHandler')
+
+
+class UntracedWebTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return TracedApplication()
+
+    def test_untraced_request(self):
+        response = self.fetch('/')
+        self.assertNotIn('Server-Timing', response.headers)
+
+
+class FakeCursor(object):
+    description = [('x',)]
+    lastrowid = None
+
+    def execute(self, query, parameters=None):
+        pass
+
+    def __iter__(self):
+        return iter([(1,)])
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    autocommit = True
+    closed = 0
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor()
+
+    def close(self):
+        pass
+
+
+class StubHTTPClient(object):
+    def fetch(self, url, callback, **kwargs):
+        IOLoop.current().add_callback(callback, None)
+
+
+class HookTest(AsyncTestCase):
+    def test_tornpg(self):
+        from durotar import tornpg
+        connect = tornpg.psycopg2.connect
+        tornpg.psycopg2.connect = lambda **kwargs: FakeConnection()
+        self.addCleanup(setattr, tornpg.psycopg2, 'connect', connect)
+        db = tornpg.Connection('localhost', 'test', keepalives_idle=0)
+        trace = tracing.RequestTrace('home')
+        with tracing.activate(trace):
+            db.query('SELECT 1')
+            db.execute('UPDATE t SET x = 1')
+        self.assertEqual(trace.summary()[0][:2], ('db', 2))
+
+    def test_auth(self):
+        trace = tracing.RequestTrace('login')
+        with stack_context.StackContext(
+                functools.partial(tracing.activate, trace)):
+            _auth_fetch(StubHTTPClient(), 'http://wechat/token', None,
+                        lambda response: self.stop())
+        self.wait()
+        self.assertEqual([span.name for span in trace.spans], ['auth'])
+        self.assertIsNotNone(trace.spans[0].duration)
+
+
+if __name__ == '__main__':
+    unittest.main()